@@ -13,26 +13,10 @@ import os
 import time
 import json
 from datetime import date
-from io import StringIO
 import pandas as pd
-import boto3
-
-
-def write_dataframe_to_csv_on_s3(dataframe, filename, bucket):
-    """ Write a dataframe to a CSV on S3 """
-
-    # Create buffer
-    csv_buffer = StringIO()
-
-    # Write dataframe to buffer
-    dataframe.to_csv(csv_buffer, index=False)
-
-    # Create S3 object
-    s3_resource = boto3.resource("s3")
-
-    # Write buffer to S3 object
-    s3_resource.Object(bucket, f'{filename}').put(
-        Body=csv_buffer.getvalue(), ServerSideEncryption="aws:kms")
+from ipac import metrics
+from ipac import profiling
+from ipac import storage
 
 
 def check_creationtimefile():
@@ -51,11 +35,7 @@ def check_creationtimefile():
     key = os.environ['CREATIONTIME_JOBS']
     bucket = os.environ['FEEDBACK_BUCKET']
 
-    s3_client = boto3.client('s3')
-    csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-    body = csv_obj['Body']
-    csv_string = body.read().decode('utf-8')
-    dataframe = pd.read_csv(StringIO(csv_string))
+    dataframe = storage.read_csv(bucket, key)
     mrns = []
     prs = []
 
@@ -70,7 +50,7 @@ def check_creationtimefile():
         if dataframe.loc[i, 'status'] == 'incomplete':
         
             # getting the date from creation_time
-            creation_time = pd.Timestamp(pd.to_datetime(df.loc[i,
+            creation_time = pd.Timestamp(pd.to_datetime(dataframe.loc[i,
             'CreationTime'])).to_pydatetime().date()
             
             # finding the number of days difference between
@@ -78,11 +58,12 @@ def check_creationtimefile():
             time_diff = (my_date - creation_time).days
             # if the time difference is larger than 10 days
             if time_diff > 9:
-                MRNS.append(dataframe.loc[i, 'MRN'])
-                PRS.append(dataframe.loc[i, 'PR'])
-    return MRNS, PRS
+                mrns.append(dataframe.loc[i, 'MRN'])
+                prs.append(dataframe.loc[i, 'PR'])
+    return mrns, prs
 
 
+@metrics.timed('ledger_update')
 def removerow_creationtime(mrn, previously_reviewed):
     '''
     Given an MRN and PR it will remove
@@ -92,17 +73,10 @@ def removerow_creationtime(mrn, previously_reviewed):
     key = os.environ['CREATIONTIME_JOBS']
     bucket = os.environ['FEEDBACK_BUCKET']
 
-    s3_client = boto3.client('s3')
     mrn = int(float(mrn))
 
-    # getting file object
-    csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-    # extracting the csv
-    body = csv_obj['Body']
-    # reading and decodying the csv by utf-8
-    csv_string = body.read().decode('utf-8')
-    # converting csv to stringIO and pandaslayer dataframe
-    dataframe = pd.read_csv(StringIO(csv_string))
+    # reading the csv into a pandas dataframe
+    dataframe = storage.read_csv(bucket, key)
     # finding the rows tha have matching MRN and PR
     indexnames = dataframe[
         (dataframe['MRN'] == mrn) & (
@@ -112,22 +86,24 @@ def removerow_creationtime(mrn, previously_reviewed):
     # removing rows in the indexnames
     dataframe.drop(indexnames, inplace=True)
     # rewritng the dataframe to s3
-    write_dataframe_to_csv_on_s3(dataframe, key, bucket)
+    storage.write_csv(bucket, key, dataframe)
     print('removed fileTime')
 
 
+@profiling.profile('keep_job_alive')
+@metrics.instrument('keep_job_alive')
 def lambda_handler(event, context):
     '''
     This lambda is triggered using Cron job
     every 1 minutes (EventBridge CloudWatch Event).
     It requires S3 read/write access to "Production Bucket"
+    The stage metrics are printed as one line (ipac.metrics).
 
     '''
     print(context)
     print(event)
     # finding MRNs with creation days older than  10 days
     mrns, prs = check_creationtimefile()
-    s3_client = boto3.client('s3')
 
     for i, _ in enumerate(mrns):
         mrn = mrns[i]
@@ -137,15 +113,12 @@ def lambda_handler(event, context):
 
         # reading the patient file from source-csv
         key = f'source-csv/{mrn}.csv'
-        csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-
-        body = csv_obj['Body']
-        csv_string = body.read().decode('utf-8')
-        dataframe = pd.read_csv(StringIO(csv_string))
+        # the file is copied as it is, without parsing
+        body = storage.read_bytes(bucket, key)
         # removing that MRN and PR from timeline.csv file
         removerow_creationtime(mrn, previously_reviewed)
         # writing the file back to s3 , inorder to trigger job creation lambda
-        write_dataframe_to_csv_on_s3(dataframe, key, bucket)
+        storage.write_bytes(bucket, key, body)
         print('rewrote to csv')
 
     return {
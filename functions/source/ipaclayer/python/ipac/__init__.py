@@ -0,0 +1,4 @@
+"""
+Shared code of the IPAC-CLABSI lambda functions, deployed as the
+ipaclayer Lambda layer and imported as the ipac package.
+"""
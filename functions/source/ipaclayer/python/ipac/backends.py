@@ -0,0 +1,234 @@
+"""
+Storage backends of the IPAC-CLABSI lambda functions.
+Purpose
+-------
+Every object read and written by the handlers goes through one backend,
+selected by the IPAC_STORAGE_BACKEND environment variable:
+
+* s3 (default) - the S3 buckets, through the pooled client of ipac.clients
+* local - a directory tree, IPAC_STORAGE_ROOT/{bucket}/{key}, so the
+  pipeline can run and be profiled off-cloud
+
+Backends work on bytes only, without pandas, so they can be used by the
+functions deployed without the pandas layer. Every request is counted
+in ipac.metrics.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from ipac import clients
+from ipac import metrics
+
+storage_backend = os.environ.get('IPAC_STORAGE_BACKEND', 's3')
+storage_root = os.environ.get('IPAC_STORAGE_ROOT', '/tmp/ipac-storage')
+
+
+class NoSuchKey(KeyError):
+    """ The object does not exist """
+
+
+class S3Backend:
+    """
+    Objects stored in S3.
+    """
+
+    def get_object(self, bucket, key):
+        """
+        Open an object.
+
+        Returns
+        -------
+        dictionary, 'Body': readable stream, 'ETag': string
+        """
+        s3_client = clients.get_client('s3')
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+        except s3_client.exceptions.NoSuchKey as error:
+            metrics.count_s3('GetObject')
+            raise NoSuchKey(f'{bucket}/{key}') from error
+        metrics.count_s3('GetObject', response.get('ContentLength', 0))
+        return response
+
+    def head_object(self, bucket, key):
+        """
+        Metadata of an object, without its content.
+
+        Returns
+        -------
+        dictionary, 'ETag': string, 'ContentLength': int
+        """
+        s3_client = clients.get_client('s3')
+        metrics.count_s3('HeadObject')
+        try:
+            return s3_client.head_object(Bucket=bucket, Key=key)
+        except s3_client.exceptions.ClientError as error:
+            # HEAD responses have no body, only the status code
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise NoSuchKey(f'{bucket}/{key}') from error
+            raise
+
+    def put_object(self, bucket, key, body, **kwargs):
+        """
+        Write an object, kwargs are further put_object arguments.
+        """
+        metrics.count_s3('PutObject', len(body))
+        return clients.get_client('s3').put_object(
+            Bucket=bucket, Key=key, Body=body, **kwargs)
+
+    def delete_object(self, bucket, key):
+        """
+        Delete an object, a missing object is not an error.
+        """
+        metrics.count_s3('DeleteObject')
+        return clients.get_client('s3').delete_object(Bucket=bucket, Key=key)
+
+    def list_keys(self, bucket, prefix=''):
+        """
+        Keys of all objects under a prefix, every page is read.
+        """
+        paginator = clients.get_client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            metrics.count_s3('ListObjectsV2')
+            for content in page.get('Contents', []):
+                yield content['Key']
+
+
+class LocalBackend:
+    """
+    Objects stored as files, root/{bucket}/{key}.
+    The ETag is the md5 of the content, like S3 for single part uploads,
+    put_object arguments such as ServerSideEncryption are ignored.
+    ----------
+    fieldname : root
+        directory of the buckets
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise ValueError(f'{bucket}/{key} is outside of the bucket')
+        return path
+
+    def get_object(self, bucket, key):
+        """
+        Open an object.
+
+        Returns
+        -------
+        dictionary, 'Body': file, 'ETag': string
+        """
+        metrics.count_s3('GetObject')
+        response = self._open(bucket, key)
+        metrics.count_s3('GetObject', response['ContentLength'], requests=0)
+        return response
+
+    def _open(self, bucket, key):
+        path = self._path(bucket, key)
+        try:
+            body = open(path, 'rb')
+        except FileNotFoundError as error:
+            raise NoSuchKey(f'{bucket}/{key}') from error
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: body.read(1024 * 1024), b''):
+            md5.update(chunk)
+        body.seek(0)
+        return {'Body': body, 'ETag': f'"{md5.hexdigest()}"',
+                'ContentLength': os.fstat(body.fileno()).st_size}
+
+    def head_object(self, bucket, key):
+        """
+        Metadata of an object, without its content.
+
+        Returns
+        -------
+        dictionary, 'ETag': string, 'ContentLength': int
+        """
+        metrics.count_s3('HeadObject')
+        response = self._open(bucket, key)
+        response.pop('Body').close()
+        return response
+
+    def put_object(self, bucket, key, body, **kwargs):
+        """
+        Write an object, the file is replaced atomically.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        metrics.count_s3('PutObject', len(body))
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.put-')
+        try:
+            with os.fdopen(handle, 'wb') as temporary_file:
+                temporary_file.write(body)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        return {'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())}
+
+    def delete_object(self, bucket, key):
+        """
+        Delete an object, a missing object is not an error.
+        """
+        metrics.count_s3('DeleteObject')
+        try:
+            os.remove(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_keys(self, bucket, prefix=''):
+        """
+        Keys of all objects under a prefix, in key order like S3.
+        """
+        bucket_path = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, filenames in os.walk(bucket_path):
+            for filename in filenames:
+                if filename.startswith('.put-'):
+                    continue
+                key = os.path.relpath(
+                    os.path.join(directory, filename), bucket_path)
+                key = key.replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        # S3 returns up to 1000 keys per request
+        metrics.count_s3(
+            'ListObjectsV2', requests=max(1, -(-len(keys) // 1000)))
+        yield from sorted(keys)
+
+
+_backend = None
+_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Storage backend selected by IPAC_STORAGE_BACKEND, created once.
+    """
+    global _backend
+    with _lock:
+        if _backend is None:
+            if storage_backend == 's3':
+                _backend = S3Backend()
+            elif storage_backend == 'local':
+                _backend = LocalBackend(os.path.abspath(storage_root))
+            else:
+                raise ValueError(
+                    f'Unknown IPAC_STORAGE_BACKEND {storage_backend!r}')
+        return _backend
+
+
+def set_backend(backend):
+    """
+    Use the given backend instead of the configured one, e.g. in tools.
+    """
+    global _backend
+    with _lock:
+        _backend = backend
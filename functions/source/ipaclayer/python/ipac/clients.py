@@ -0,0 +1,68 @@
+"""
+Pooled boto3 clients shared by the IPAC-CLABSI lambda functions.
+Purpose
+-------
+A client is created lazily on first use, once per service, and kept at
+module level, so warm invocations reuse its session and connection pool.
+boto3 clients are thread safe, their creation is not: it is serialized.
+A forked worker process creates its own clients.
+"""
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Size of the connection pool of each client
+max_pool_connections = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '16'))
+# botocore retry mode ('legacy', 'standard' or 'adaptive') and attempts
+retry_mode = os.environ.get('CLIENT_RETRY_MODE', 'standard')
+max_attempts = int(os.environ.get('CLIENT_MAX_ATTEMPTS', '5'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Pooled client of an AWS service.
+    ----------
+    fieldname : service_name
+        e.g. 's3', 'sagemaker'
+
+    Returns
+    -------
+    boto3 client
+    """
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+    with _lock:
+        if service_name not in _clients:
+            config = Config(
+                max_pool_connections=max_pool_connections,
+                retries={'mode': retry_mode, 'max_attempts': max_attempts},
+            )
+            _clients[service_name] = boto3.session.Session().client(
+                service_name, config=config)
+        return _clients[service_name]
+
+
+def set_client(service_name, client):
+    """
+    Use the given client for a service, e.g. a stand-in in tools.
+    """
+    with _lock:
+        _clients[service_name] = client
+
+
+def reset():
+    """
+    Drop the pooled clients, they are created again on next use.
+    """
+    global _lock
+    _clients.clear()
+    _lock = threading.Lock()
+
+
+# The connections of the parent's pools must not be shared by a child
+os.register_at_fork(after_in_child=reset)
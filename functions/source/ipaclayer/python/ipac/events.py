@@ -0,0 +1,168 @@
+"""
+Dispatcher of the S3 event notification records.
+Purpose
+-------
+S3 may deliver several records in one notification, and replayed events
+can carry many. Every record of the event is passed to a record handler,
+records are processed concurrently by a bounded pool of threads, and a
+failing record does not stop the others.
+
+Once every record was processed, dispatch returns a summary listing
+the result of every record, and a 'retry' event holding only the
+failed records:
+
+    summary = {
+        'records': [
+            {'bucket': bucket, 'key': key, 'status': 'succeeded',
+             'result': result},
+            {'bucket': bucket, 'key': key, 'status': 'failed',
+             'error': error},
+        ],
+        'succeeded': 1,
+        'failed': 1,
+        'retry': {'Records': [failed records]},
+    }
+
+The asynchronous S3 invoke discards the returned summary, and raising
+would make Lambda retry the whole event, the succeeded records too.
+The handler instead passes the summary to redrive, which invokes the
+function again, asynchronously, with the 'retry' event only. After
+EVENT_REDRIVES re-drives the error is raised: the function has no
+Lambda retries (MaximumRetryAttempts 0) and the event, by then only
+the failed records, goes to its on-failure destination, the event
+dead-letter queue of the stack. The failed records are also printed
+as an event that can be replayed alone.
+"""
+import os
+import json
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from ipac import clients
+
+# Default number of records processed concurrently
+event_workers = int(os.environ.get('EVENT_WORKERS', '4'))
+# Asynchronous invokes of the failed records of an event, see redrive
+event_redrives = int(os.environ.get('EVENT_REDRIVES', '2'))
+
+
+def s3_location(record):
+    """
+    Bucket and object key of an S3 event notification record,
+    the key is url decoded.
+    ----------
+    fieldname : record
+        one element of event['Records']
+
+    Returns
+    -------
+    bucket, key
+    """
+    bucket = record['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(
+        record['s3']['object']['key'], encoding='utf-8')
+    return bucket, key
+
+
+def _handle(handle_record, record):
+    """
+    Run the record handler, the error is returned instead of raised.
+    """
+    bucket, key = s3_location(record)
+    try:
+        result = handle_record(record)
+    except Exception as error:
+        print('Record {}/{} failed: {!r}'.format(bucket, key, error))
+        return {'bucket': bucket, 'key': key, 'status': 'failed',
+                'error': repr(error)}, error
+    return {'bucket': bucket, 'key': key, 'status': 'succeeded',
+            'result': result}, None
+
+
+def dispatch(event, handle_record, workers=None, raise_on_failure=False):
+    """
+    Process every record of an S3 event notification.
+    ----------
+    fieldname : event
+        Lambda event with the 'Records' list
+    fieldname: handle_record
+        function called with each record, its return value
+        is kept in the summary, it has to be thread safe
+    fieldname: workers
+        maximum number of records processed at once,
+        default: EVENT_WORKERS environment variable
+    fieldname: raise_on_failure
+        raise the error of the first failed record, after every record
+         was processed. By default the summary is returned, its 'retry'
+         event holds the failed records, see redrive
+
+    Returns
+    -------
+    dictionary, the per record summary
+    """
+    records = event.get('Records', [])
+    if workers is None:
+        workers = event_workers
+    workers = max(1, min(workers, len(records)))
+    if workers == 1:
+        outcomes = [_handle(handle_record, record) for record in records]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(
+                lambda record: _handle(handle_record, record), records))
+    summary = {
+        'records': [result for result, _ in outcomes],
+        'succeeded': 0,
+        'failed': 0,
+        'retry': {'Records': []},
+    }
+    errors = []
+    for record, (result, error) in zip(records, outcomes):
+        summary[result['status']] += 1
+        if error is not None:
+            errors.append(error)
+            summary['retry']['Records'].append(record)
+    print('Processed {} records, {} failed'.format(
+        len(records), summary['failed']))
+    if errors:
+        print('Failed records: {}'.format(json.dumps(summary['retry'])))
+        if raise_on_failure:
+            raise errors[0]
+    return summary
+
+
+def redrive(event, summary, context):
+    """
+    Invoke the function again, asynchronously, with the 'retry' event
+    of the summary, its 'redrive' key counts the re-drives. Once the
+    event was re-driven EVENT_REDRIVES times, or without a Lambda
+    context to invoke, a RuntimeError is raised instead, so the event
+    goes to the on-failure destination of the function.
+    ----------
+    fieldname : event
+        Lambda event the summary is of
+    fieldname: summary
+        dictionary, summary of dispatch
+    fieldname: context
+        Lambda context, None when called outside Lambda
+
+    Returns
+    -------
+    dictionary, the summary, with the 'redrive' count of the invoked
+     'retry' event when records failed
+    """
+    retry = summary['retry']
+    if not retry['Records']:
+        return summary
+    redrives = event.get('redrive', 0)
+    if redrives >= event_redrives or context is None:
+        raise RuntimeError('{} records failed after {} re-drives'.format(
+            len(retry['Records']), redrives))
+    retry = dict(retry, redrive=redrives + 1)
+    clients.get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(retry).encode('utf-8'))
+    print('Re-drove {} failed records, re-drive {} of {}'.format(
+        len(retry['Records']), retry['redrive'], event_redrives))
+    summary['redrive'] = retry['redrive']
+    return summary
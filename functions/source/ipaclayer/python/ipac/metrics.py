@@ -0,0 +1,256 @@
+"""
+Per invocation metrics of the IPAC-CLABSI lambda functions.
+Purpose
+-------
+Named stages of a handler are measured with spans, S3 requests are
+counted by the storage backends. At the end of the invocation one JSON
+line is printed in the CloudWatch embedded metric format (EMF), so
+CloudWatch Logs extracts the metrics without any API call:
+
+    @metrics.instrument('preprocess')
+    def lambda_handler(event, context):
+        with metrics.span('workbook_parse'):
+            ...
+
+For every stage the line has the number of spans, the wall time and
+the CPU time of the measuring thread, summed over the spans, and the
+peak RSS of the process when the stage ended. Spans of concurrent
+threads and worker processes are summed, so a stage can take longer
+than the invocation, which is the 'invocation' stage. A forked worker
+starts with empty metrics and sends its snapshot to the parent, which
+merges it.
+"""
+import os
+import json
+import time
+import resource
+import functools
+import threading
+import contextlib
+
+# CloudWatch namespace of the metrics
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'IPAC-CLABSI')
+
+_lock = threading.Lock()
+_stages = {}
+_s3 = {}
+_counts = {}
+_observations = {}
+
+
+def reset():
+    """
+    Forget the metrics, called when an invocation starts.
+    """
+    with _lock:
+        _stages.clear()
+        _s3.clear()
+        _counts.clear()
+        _observations.clear()
+
+
+def _after_fork():
+    global _lock
+    _lock = threading.Lock()
+    reset()
+
+
+# The child reports its own work only, the lock may have been held
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in megabytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def record(name, wall, cpu, count=1, rss=None):
+    """
+    Add a measurement to a stage.
+    ----------
+    fieldname : name
+        stage name
+    fieldname: wall, cpu
+        float, seconds
+    fieldname: count
+        int, number of spans measured
+    fieldname: rss
+        float, peak RSS in megabytes, default: the current peak
+    """
+    if rss is None:
+        rss = peak_rss()
+    with _lock:
+        stage = _stages.setdefault(
+            name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0.0})
+        stage['count'] += count
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['peak_rss'] = max(stage['peak_rss'], rss)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Measure the wall and CPU time of a block as a stage.
+    """
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+def timed(name):
+    """
+    Decorator measuring every call of a function as a stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_s3(operation, size=0, requests=1):
+    """
+    Count S3 requests and the bytes of their bodies.
+    ----------
+    fieldname : operation
+        e.g. 'GetObject', 'PutObject', 'ListObjectsV2'
+    fieldname: size
+        int, bytes read or written
+    """
+    with _lock:
+        counter = _s3.setdefault(operation, {'requests': 0, 'bytes': 0})
+        counter['requests'] += requests
+        counter['bytes'] += size
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the invocation, e.g. throttled requests.
+    """
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + value
+
+
+def observe(name, value, unit='Count'):
+    """
+    Record one value of a metric, e.g. a queue depth or a wait time,
+    every value is emitted.
+    ----------
+    fieldname : unit
+        CloudWatch unit, e.g. 'Count', 'Seconds'
+    """
+    with _lock:
+        _observations.setdefault(name, {'unit': unit, 'values': []})[
+            'values'].append(value)
+
+
+def snapshot():
+    """
+    Copy of the metrics, which can be pickled and merged.
+    """
+    with _lock:
+        return {
+            'stages': {name: dict(stage) for name, stage in _stages.items()},
+            's3': {name: dict(counter) for name, counter in _s3.items()},
+            'counts': dict(_counts),
+            'observations': {
+                name: {'unit': observation['unit'],
+                       'values': list(observation['values'])}
+                for name, observation in _observations.items()},
+        }
+
+
+def merge(other):
+    """
+    Add the snapshot of another process, e.g. a forked worker.
+    """
+    for name, stage in other['stages'].items():
+        record(name, stage['wall'], stage['cpu'], stage['count'],
+               stage['peak_rss'])
+    for operation, counter in other['s3'].items():
+        count_s3(operation, counter['bytes'], counter['requests'])
+    for name, value in other['counts'].items():
+        count(name, value)
+    for name, observation in other['observations'].items():
+        for value in observation['values']:
+            observe(name, value, observation['unit'])
+
+
+def emit(function_name, request_id=None):
+    """
+    Print the metrics as one CloudWatch embedded metric format line.
+
+    Returns
+    -------
+    dictionary, the printed document
+    """
+    metrics = snapshot()
+    document = {'Function': function_name, 'RequestId': request_id,
+                'PeakRSS': peak_rss()}
+    definitions = [{'Name': 'PeakRSS', 'Unit': 'Megabytes'}]
+    for name, stage in sorted(metrics['stages'].items()):
+        document[f'{name}.count'] = stage['count']
+        document[f'{name}.wall'] = round(stage['wall'] * 1000, 3)
+        document[f'{name}.cpu'] = round(stage['cpu'] * 1000, 3)
+        document[f'{name}.peak_rss'] = round(stage['peak_rss'], 1)
+        definitions += [
+            {'Name': f'{name}.count', 'Unit': 'Count'},
+            {'Name': f'{name}.wall', 'Unit': 'Milliseconds'},
+            {'Name': f'{name}.cpu', 'Unit': 'Milliseconds'},
+            {'Name': f'{name}.peak_rss', 'Unit': 'Megabytes'},
+        ]
+    for operation, counter in sorted(metrics['s3'].items()):
+        document[f'S3.{operation}.requests'] = counter['requests']
+        definitions.append(
+            {'Name': f'S3.{operation}.requests', 'Unit': 'Count'})
+        # Only these requests transfer an object body
+        if operation in ('GetObject', 'PutObject'):
+            document[f'S3.{operation}.bytes'] = counter['bytes']
+            definitions.append(
+                {'Name': f'S3.{operation}.bytes', 'Unit': 'Bytes'})
+    for name, value in sorted(metrics['counts'].items()):
+        document[name] = value
+        definitions.append({'Name': name, 'Unit': 'Count'})
+    for name, observation in sorted(metrics['observations'].items()):
+        # EMF takes up to 100 values of a metric as an array
+        values = observation['values'][-100:]
+        document[name] = values[0] if len(values) == 1 else values
+        definitions.append({'Name': name, 'Unit': observation['unit']})
+    # EMF allows at most 100 metrics per directive
+    document['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [
+            {'Namespace': metrics_namespace,
+             'Dimensions': [['Function']],
+             'Metrics': definitions[start:start + 100]}
+            for start in range(0, len(definitions), 100)],
+    }
+    print(json.dumps(document))
+    return document
+
+
+def instrument(function_name):
+    """
+    Decorator of a lambda handler: the metrics are reset, the handler
+    is measured as the 'invocation' stage and the metrics are emitted,
+    also when the handler raises.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            reset()
+            try:
+                with span('invocation'):
+                    return handler(event, context)
+            finally:
+                emit(function_name, getattr(context, 'aws_request_id', None))
+        return wrapper
+    return decorator
@@ -0,0 +1,199 @@
+"""
+On demand profiling of the IPAC-CLABSI lambda handlers.
+Purpose
+-------
+A slow workbook or patient can be profiled where it is slow, in the
+deployed function. Profiling is off by default, it is switched on for
+every invocation by the PROFILE environment variable, or for one
+invocation by a 'profile' flag in the event:
+
+    {"Records": [...], "profile": true}
+    {"Records": [...], "profile": {"tracemalloc": true}}
+
+The handler runs under cProfile, and tracemalloc when asked for, then
+the reports are written to PROFILE_BUCKET, tagged with the request id:
+
+    {PROFILE_PREFIX}{function}/{request id}/{name}.pstats
+    {PROFILE_PREFIX}{function}/{request id}/{name}.txt
+    {PROFILE_PREFIX}{function}/{request id}/{name}-allocations.txt
+
+The name is 'handler' for the handler process, forked workers which run
+their work in profiling.capture write their own reports. Without
+PROFILE_BUCKET the text reports are printed. Load the .pstats with
+pstats.Stats or snakeviz. Like ipac.backends this module does not need
+pandas.
+"""
+import os
+import io
+import uuid
+import pstats
+import cProfile
+import marshal
+import functools
+import contextlib
+import tracemalloc
+from ipac import backends
+
+# Profile every invocation
+profile_enabled = os.environ.get('PROFILE', '0').lower() in ('1', 'true')
+# Also trace the memory allocations, with this number of frames
+profile_tracemalloc = os.environ.get(
+    'PROFILE_TRACEMALLOC', '0').lower() in ('1', 'true')
+tracemalloc_frames = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '1'))
+# Location of the reports, number of entries of the text reports
+profile_bucket = os.environ.get('PROFILE_BUCKET')
+profile_prefix = os.environ.get('PROFILE_PREFIX', 'profiles/')
+profile_top = int(os.environ.get('PROFILE_TOP', '40'))
+
+# Capture in progress in this process, inherited by forked workers
+_active = None
+
+
+def requested(event):
+    """
+    Profiling options of an invocation.
+    ----------
+    fieldname : event
+        Lambda event
+
+    Returns
+    -------
+    None when profiling is off, else dictionary with 'tracemalloc'
+    """
+    flag = event.get('profile') if isinstance(event, dict) else None
+    if not (flag or profile_enabled):
+        return None
+    options = {'tracemalloc': profile_tracemalloc}
+    if isinstance(flag, dict):
+        options['tracemalloc'] = bool(
+            flag.get('tracemalloc', options['tracemalloc']))
+    return options
+
+
+def profile_report(profiler):
+    """
+    Top functions by cumulative time, as text.
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(profile_top)
+    return stream.getvalue()
+
+
+def allocation_report(snapshot):
+    """
+    Top source lines by allocated memory still held, as text.
+    """
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['Traced memory: current {:.1f} MiB, peak {:.1f} MiB'.format(
+        current / 2 ** 20, peak / 2 ** 20)]
+    statistics = snapshot.statistics('traceback')
+    lines.append('Top {} of {} allocation sites:'.format(
+        min(profile_top, len(statistics)), len(statistics)))
+    for statistic in statistics[:profile_top]:
+        lines.append('{:.1f} KiB in {} blocks'.format(
+            statistic.size / 1024, statistic.count))
+        lines.extend('    ' + line for line in statistic.traceback.format())
+    return '\n'.join(lines) + '\n'
+
+
+def write_reports(name, profiler, snapshot=None):
+    """
+    Write the reports of the active capture, errors are printed only,
+    a failing upload must not fail the invocation.
+    """
+    profiler.create_stats()
+    # Same format as cProfile.Profile.dump_stats, serialized first
+    # because pstats.Stats takes the stats out of the profiler
+    pstats_body = marshal.dumps(profiler.stats)
+    reports = {f'{name}.txt': profile_report(profiler).encode('utf-8')}
+    if snapshot is not None:
+        reports[f'{name}-allocations.txt'] = \
+            allocation_report(snapshot).encode('utf-8')
+    if not profile_bucket:
+        print('PROFILE_BUCKET is not set, profile of {} {}:'.format(
+            _active['function_name'], _active['request_id']))
+        for body in reports.values():
+            print(body.decode('utf-8'))
+        return
+    reports[f'{name}.pstats'] = pstats_body
+    location = '{}{}/{}/'.format(
+        profile_prefix, _active['function_name'], _active['request_id'])
+    for filename, body in reports.items():
+        try:
+            backends.get_backend().put_object(
+                profile_bucket, location + filename, body,
+                ServerSideEncryption='aws:kms')
+        except Exception as error:
+            print('Profile {} not written: {!r}'.format(filename, error))
+    print('Profile written to s3://{}/{}{}'.format(
+        profile_bucket, location, name))
+
+
+@contextlib.contextmanager
+def capture(name):
+    """
+    Profile a block as a separate report, when a capture is active,
+    e.g. the work of a forked worker process. Else a no-op.
+    """
+    if _active is None:
+        yield
+        return
+    # The profiler of the parent was copied by the fork
+    _active['profiler'].disable()
+    tracing = _active['tracemalloc']
+    if tracing:
+        tracemalloc.clear_traces()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot() if tracing else None
+        write_reports(name, profiler, snapshot)
+
+
+def profile(function_name):
+    """
+    Decorator of a lambda handler, profiles the invocations
+    for which profiling is switched on, see requested.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _active
+            options = requested(event)
+            if options is None:
+                return handler(event, context)
+            started_tracing = False
+            if options['tracemalloc'] and not tracemalloc.is_tracing():
+                tracemalloc.start(tracemalloc_frames)
+                started_tracing = True
+            profiler = cProfile.Profile()
+            _active = {
+                'function_name': function_name,
+                'request_id': getattr(
+                    context, 'aws_request_id', None) or uuid.uuid4().hex,
+                'profiler': profiler,
+                'tracemalloc': tracemalloc.is_tracing(),
+            }
+            profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                profiler.disable()
+                snapshot = None
+                if _active['tracemalloc']:
+                    snapshot = tracemalloc.take_snapshot()
+                write_reports('handler', profiler, snapshot)
+                if started_tracing:
+                    tracemalloc.stop()
+                _active = None
+        return wrapper
+    return decorator
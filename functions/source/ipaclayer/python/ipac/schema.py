@@ -0,0 +1,302 @@
+"""
+Column schema of the IPAC-CLABSI workbook sheets and patient csv files.
+Purpose
+-------
+Give the known columns compact dtypes when they are read, in preprocess,
+job_creation and loop_lambda:
+
+* low cardinality text columns are categoricals
+* integer identifiers are downcast to the smallest integer dtype
+* the *_dt_tm columns are datetime64
+
+Columns missing from a dataframe are skipped, unknown columns keep the
+dtype pandas gave them.
+
+The *_COLUMN_NAMES lists of the patient csv are the column contract
+between the stages: preprocess writes PATIENT_CSV_COLUMN_NAMES,
+loop_lambda adds REVIEW_COLUMN_NAMES, job_creation reads only the
+TABLE_COLUMN_NAMES and REVIEW_COLUMN_NAMES.
+
+collection_labels gives the keys of the blood collections in the input
+manifest table and the reviewer's collection_class, 'YYYY-MM-DD_n'.
+The plot index of a patient, PLOT_INDEX_KEY, maps these labels to the
+IWP plots preprocess rendered, so job_creation does not list them.
+"""
+import pandas as pd
+
+# Collection label of the rows without a (shown) collection date
+NO_COLLECTION_LABEL = 'DateNotAvailable'
+
+# Plot index of a patient, written by preprocess before the patient csv:
+# {'mrn': mrn,
+#  'timeline': {'uri': s3 uri, 'sha256': hex digest of the png},
+#  'iwp_plots': {collection label: {'uri': ..., 'sha256': ...}}}
+PLOT_INDEX_KEY = 'images/{mrn}/plot_index.json'
+
+# Datetime columns of the patient sheet (Sheet1)
+DATETIME_COLUMN_NAMES = [
+    'beg_effective_dt_tm',
+    'end_effective_dt_tm',
+    'collection_dt_tm',
+    'admit_dt_tm',
+    'disch_dt_tm',
+    'first_activity_start_dt_tm',
+    'last_activity_end_dt_tm',
+]
+# Datetime columns of the temperature sheet (Sheet2)
+TEMPERATURE_DATETIME_COLUMN_NAMES = [
+    'collection_dt_tm',
+    'event_end_dt_tm',
+]
+# Columns of the temperature and organism sheets used by the later stages,
+# the patient sheet (Sheet1) is read with PATIENT_CSV_COLUMN_NAMES
+TEMPERATURE_COLUMN_NAMES = [
+    'mrn',
+    'collection_dt_tm',
+    'event_end_dt_tm',
+    'result_val',
+]
+ORGANISM_COLUMN_NAMES = [
+    'mrn',
+    'encntr_num',
+    'organism_desc_src',
+]
+# Columns of the patient csv (source-csv/{mrn}.csv) per pipeline stage:
+# shown in the labeling UI table by job_creation
+TABLE_COLUMN_NAMES = [
+    'name_first',
+    'name_last',
+    'birth_date_id',
+    'bc_phn',
+    'mrn',
+    'encntr_num',
+    'organism',
+    'nursing_unit_short_desc',
+    'beg_effective_dt_tm',
+    'end_effective_dt_tm',
+    'facility_name_src',
+    'collection_dt_tm',
+    'encntr_type_desc_src_at_collection',
+    'admit_dt_tm',
+    'disch_dt_tm',
+    'disch_disp_desc_src',
+    'clinical_event_code_desc_src',
+    'lab_result',
+    'loc_room_desc_src_at_collection',
+    'loc_bed_desc_src_at_collection',
+    'med_service_desc_src_at_collection',
+    'nursing_unit_desc_at_collection',
+    'nursing_unit_short_desc_at_collection',
+    'result_interpretation_desc_src',
+    'specimen_type_desc_src',
+    'doc_set_name_result',
+    'first_activity_start_dt_tm',
+    'last_activity_end_dt_tm',
+    'first_catheter_type_result',
+    'first_dressing_type_result',
+    'first_site_result',
+    'line_tube_drain_insertion_seq',
+]
+# kept only for the reporting files written by loop_lambda,
+# for_reporting_aggregated and for_reporting_analytic
+REPORTING_COLUMN_NAMES = [
+    'encntr_id',
+    'gender_desc_src',
+    'home_addr_patient_postal_code_forward_sortation_area',
+    'collection_date_id',
+    'transfer_in_to_collect',
+    'transfer_out_to_collect',
+    'ce_dynamic_label_id',
+    'line_insert_to_collection',
+    'line_remove_to_collect',
+]
+# written by preprocess, the workbook columns handed to the later stages
+PATIENT_CSV_COLUMN_NAMES = TABLE_COLUMN_NAMES + REPORTING_COLUMN_NAMES
+# added by loop_lambda after a review round, read back by job_creation
+REVIEW_COLUMN_NAMES = [
+    'PR',
+    'MRN',
+    'decision',
+    'clabsi',
+    'comment',
+    'new_comment',
+    'comment_on_pathogen',
+    'pathogen',
+    'other_pathogen',
+    'BSI_type',
+    'BSI_subtype',
+    'commonnocasereason',
+    'alternate_diagnosis',
+    'IWP_comment',
+    'send_to_physician',
+    'first_reviewer_id',
+    'second_reviewer_id',
+    'job_creation_date',
+]
+# Integer identifiers and counters
+INTEGER_COLUMN_NAMES = [
+    'mrn',
+    'encntr_num',
+    'encntr_id',
+    'collection_date_id',
+    'birth_date_id',
+    'ce_dynamic_label_id',
+    'transfer_in_to_collect',
+    'transfer_out_to_collect',
+    'line_insert_to_collection',
+    'line_remove_to_collect',
+    'line_tube_drain_insertion_seq',
+]
+# Text columns with few distinct values, repeated on every row
+CATEGORY_COLUMN_NAMES = [
+    'nursing_unit_short_desc',
+    'facility_name_src',
+    'encntr_type_desc_src_at_collection',
+    'clinical_event_code_desc_src',
+    'loc_room_desc_src_at_collection',
+    'disch_disp_desc_src',
+    'lab_result',
+    'med_service_desc_src_at_collection',
+    'nursing_unit_desc_at_collection',
+    'nursing_unit_short_desc_at_collection',
+    'result_interpretation_desc_src',
+    'specimen_type_desc_src',
+    'doc_set_name_result',
+    'first_catheter_type_result',
+    'first_dressing_type_result',
+    'first_site_result',
+    'gender_desc_src',
+    'home_addr_patient_postal_code_forward_sortation_area',
+    'organism_desc_src',
+]
+
+
+def apply_schema(dataframe, datetime_column_names=None):
+    """
+    Convert the known columns of a dataframe to their compact dtype.
+    Unparsable datetimes become NaT, integer columns with missing or
+    non numeric values are left as they are.
+    ----------
+    fieldname : dataframe
+        Pandas dataframe, column names in lower case
+    fieldname: datetime_column_names
+        list of column names, default: DATETIME_COLUMN_NAMES
+
+    Returns
+    -------
+    dataframe with converted columns
+    """
+    if datetime_column_names is None:
+        datetime_column_names = DATETIME_COLUMN_NAMES
+    for column_name in datetime_column_names:
+        if column_name not in dataframe.columns:
+            continue
+        if pd.api.types.is_datetime64_any_dtype(dataframe[column_name]):
+            continue
+        dataframe[column_name] = pd.to_datetime(
+            dataframe[column_name], errors='coerce',
+            infer_datetime_format=True)
+    for column_name in INTEGER_COLUMN_NAMES:
+        if column_name not in dataframe.columns:
+            continue
+        if not pd.api.types.is_integer_dtype(dataframe[column_name]):
+            continue
+        dataframe[column_name] = pd.to_numeric(
+            dataframe[column_name], downcast='integer')
+    for column_name in CATEGORY_COLUMN_NAMES:
+        if column_name not in dataframe.columns:
+            continue
+        if dataframe[column_name].dtype != object:
+            continue
+        dataframe[column_name] = dataframe[column_name].astype('category')
+    return dataframe
+
+
+def project(dataframe, *column_name_lists):
+    """
+    Select the columns of a stage projection, missing columns are
+    skipped and the column order of the dataframe is kept.
+    ----------
+    fieldname : dataframe
+        Pandas dataframe
+    fieldname: column_name_lists
+        lists of column names, e.g. PATIENT_CSV_COLUMN_NAMES
+
+    Returns
+    -------
+    dataframe with the projected columns
+    """
+    column_names = set().union(*column_name_lists)
+    return dataframe[[
+        column_name for column_name in dataframe.columns
+        if column_name in column_names]]
+
+
+def usecols(*column_name_lists):
+    """
+    usecols argument of read_csv for a stage projection,
+    columns missing from the file are not an error.
+    """
+    return set().union(*column_name_lists).__contains__
+
+
+def read_csv(filepath_or_buffer, **kwargs):
+    """
+    Read a patient csv, the categorical columns are built while parsing.
+    ----------
+    fieldname : filepath_or_buffer
+        path or file like object, as for pd.read_csv
+    fieldname: kwargs
+        passed to pd.read_csv
+
+    Returns
+    -------
+    dataframe with the schema applied
+    """
+    dtype = {column_name: 'category' for column_name in CATEGORY_COLUMN_NAMES}
+    dtype.update(kwargs.pop('dtype', {}))
+    dataframe = pd.read_csv(filepath_or_buffer, dtype=dtype, **kwargs)
+    return apply_schema(dataframe)
+
+
+def fillna(dataframe, value):
+    """
+    dataframe.fillna which also fills the categorical columns,
+    value is added to their categories when needed.
+    ----------
+    fieldname : dataframe
+        Pandas dataframe
+    fieldname: value
+        scalar fill value
+
+    Returns
+    -------
+    dataframe without missing values
+    """
+    for column_name in dataframe.columns:
+        column = dataframe[column_name]
+        if (pd.api.types.is_categorical_dtype(column)
+                and value not in column.cat.categories
+                and column.isna().any()):
+            dataframe[column_name] = column.cat.add_categories([value])
+    return dataframe.fillna(value)
+
+
+def collection_labels(collection_dt_tm):
+    """
+    Label every blood collection 'YYYY-MM-DD_n', n numbers the
+    collections of the same day from 1, in the order of the rows.
+    Rows without a collection date are labelled NO_COLLECTION_LABEL.
+    ----------
+    fieldname : collection_dt_tm
+        Pandas series of the collection dates, sorted
+
+    Returns
+    -------
+    Pandas series of strings, with the index of collection_dt_tm
+    """
+    dates = pd.to_datetime(collection_dt_tm).dt.normalize()
+    # cumcount leaves the rows without a date out of the groups
+    numbers = dates.groupby(dates).cumcount().fillna(0).astype(int) + 1
+    labels = dates.dt.strftime('%Y-%m-%d') + '_' + numbers.astype(str)
+    return labels.where(dates.notna(), NO_COLLECTION_LABEL)
@@ -0,0 +1,172 @@
+"""
+Storage helpers shared by the IPAC-CLABSI lambda functions.
+Purpose
+-------
+Read and write the csv, json and image objects of the pipeline through
+the configured storage backend (ipac.backends, S3 by default). Objects
+are written with KMS server side encryption unless encrypt=False is
+given.
+"""
+import io
+import json
+import pandas as pd
+from ipac import backends
+from ipac import schema
+
+KMS_ENCRYPTION = {'ServerSideEncryption': 'aws:kms'}
+
+
+def get_object(bucket, key):
+    """
+    Open an object, its 'Body' is a stream.
+    Raises ipac.backends.NoSuchKey if the object does not exist.
+    """
+    return backends.get_backend().get_object(bucket, key)
+
+
+def read_bytes(bucket, key, missing_ok=False):
+    """
+    Content of an object.
+    ----------
+    fieldname : bucket, key
+        location of the object
+    fieldname: missing_ok
+        return None instead of raising when the object does not exist
+
+    Returns
+    -------
+    bytes
+    """
+    try:
+        body = get_object(bucket, key)['Body']
+    except backends.NoSuchKey:
+        if missing_ok:
+            return None
+        raise
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+
+def head_object(bucket, key, missing_ok=False):
+    """
+    Metadata of an object, e.g. its 'ETag', without its content.
+    ----------
+    fieldname: missing_ok
+        return None instead of raising when the object does not exist
+    """
+    try:
+        return backends.get_backend().head_object(bucket, key)
+    except backends.NoSuchKey:
+        if missing_ok:
+            return None
+        raise
+
+
+def write_bytes(bucket, key, body, encrypt=True, **kwargs):
+    """
+    Write an object.
+    ----------
+    fieldname : bucket, key
+        location of the object
+    fieldname: body
+        bytes or str
+    fieldname: kwargs
+        further put_object arguments, e.g. ContentType
+
+    Returns
+    -------
+    put_object response
+    """
+    if encrypt:
+        kwargs.update(KMS_ENCRYPTION)
+    return backends.get_backend().put_object(bucket, key, body, **kwargs)
+
+
+def read_csv(bucket, key, typed=False, **kwargs):
+    """
+    Read a csv object into a dataframe.
+    ----------
+    fieldname : bucket, key
+        location of the object
+    fieldname: typed
+        apply ipac.schema while reading (schema.read_csv)
+    fieldname: kwargs
+        passed to pd.read_csv
+
+    Returns
+    -------
+    dataframe
+    """
+    body = io.BytesIO(read_bytes(bucket, key))
+    if typed:
+        return schema.read_csv(body, **kwargs)
+    return pd.read_csv(body, **kwargs)
+
+
+def write_csv(bucket, key, dataframe, index=False, **kwargs):
+    """
+    Write a dataframe as a csv object, without the index by default.
+    """
+    return write_bytes(
+        bucket, key, dataframe.to_csv(index=index).encode('utf-8'), **kwargs)
+
+
+def read_json(bucket, key, missing_ok=False):
+    """
+    Read a json object, None if it does not exist and missing_ok.
+    """
+    body = read_bytes(bucket, key, missing_ok)
+    if body is None:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def write_json(bucket, key, data, default=None, **kwargs):
+    """
+    Write data as a json object, default is passed to json.dumps.
+    """
+    return write_bytes(
+        bucket, key, json.dumps(data, default=default).encode('utf-8'),
+        **kwargs)
+
+
+def read_json_lines(bucket, key):
+    """
+    Read a json lines object, e.g. a Ground Truth manifest,
+    one json document per line.
+
+    Returns
+    -------
+    list of the documents
+    """
+    lines = read_bytes(bucket, key).decode('utf-8').splitlines()
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def write_json_lines(bucket, key, documents, default=None, **kwargs):
+    """
+    Write documents as a json lines object, see read_json_lines.
+    """
+    body = '\n'.join(
+        json.dumps(document, default=default) for document in documents)
+    return write_bytes(bucket, key, body.encode('utf-8'), **kwargs)
+
+
+def delete_object(bucket, key):
+    """
+    Delete an object, deleting a missing object is not an error.
+    """
+    return backends.get_backend().delete_object(bucket, key)
+
+
+def list_keys(bucket, prefix=''):
+    """
+    Keys of all objects under a prefix.
+
+    Returns
+    -------
+    generator of keys
+    """
+    return backends.get_backend().list_keys(bucket, prefix)
@@ -8,19 +8,46 @@
             'source-ref': mrn_id,
             }
 """
-import json
-import urllib.parse
 import os
 import time
-from io import StringIO
+import hashlib
+import threading
 from datetime import date
 import numpy as np
 import pandas as pd
 from botocore.exceptions import ClientError
-import boto3
+from ipac import clients
+from ipac import events
+from ipac import metrics
+from ipac import profiling
+from ipac import schema
+from ipac import storage
+import scheduler
 
 print('Job creation lambda function')
 
+# Batching mode: the data objects of the patient csv files are staged
+# under JOB_PENDING_PREFIX and the scheduled flush submits one labeling
+# job per JOB_BATCH_SIZE patients, 1 (default) creates one job per csv
+job_batch_size = int(os.environ.get('JOB_BATCH_SIZE', '1'))
+# A batch smaller than JOB_BATCH_SIZE is submitted once its oldest
+# patient waited this long
+job_batch_window = int(os.environ.get('JOB_BATCH_WINDOW_SECONDS', '900'))
+job_pending_prefix = os.environ.get(
+    'JOB_PENDING_PREFIX', 'manifests/pending/')
+
+# Reference UI templates of this (warm) Lambda container,
+# key: (bucket, path), see reference_template
+template_cache = {}
+template_lock = threading.Lock()
+template_cache_ttl = float(os.environ.get('TEMPLATE_CACHE_TTL_SECONDS', '60'))
+template_render_prefix = os.environ.get(
+    'TEMPLATE_RENDER_PREFIX', 'templates/rendered/')
+
+# Serializes the updates of the job creation time file
+# by the records processed concurrently
+timeline_lock = threading.Lock()
+
 
 def convert(value):
     '''
@@ -35,6 +62,8 @@ def convert(value):
 def get_table_fields():
     """
     This function defines the fields presented on the front end table.
+    The patient csv columns read by this lambda are listed in
+    ipac.schema.TABLE_COLUMN_NAMES, keep both lists in sync.
     """
     fields = [
         ('name_first', 'Given name(s)'),
@@ -147,9 +176,12 @@ def map_pathogen_name_to_id(pathogen_name):
 def modify_template_content(template, tablekeys):
     """
     Ground Truth has limitation on the number of nested loops. Correct that.
+    A section is shown only when the table has its key, the template of
+    a batch has the keys of all its patients.
 
     """
     section = '''
+        $3 if task.input.table.{date} $4
         <div class="card-body encounter-table {date}">
             <label>Information for blood collection on {date}</label>
             <div id="table" name="table" class="table-editable">
@@ -167,10 +199,11 @@ def modify_template_content(template, tablekeys):
                 </table>
             </div>
         </div>
+        $3 endif $4
         '''
-    html = ''
-    for collection_date in tablekeys:
-        html = ''.join((html, section.format(**{'date': collection_date})))
+    html = ''.join(
+        section.format(**{'date': collection_date})
+        for collection_date in tablekeys)
 
     html = html.replace('$3', '{%').replace('$4', '%}').\
         replace('$1', '{{').replace('$2', '}}')
@@ -179,72 +212,122 @@ def modify_template_content(template, tablekeys):
     return template
 
 
-def handle_template(data_table, bucket, reference_template_path,
-                    patient_template_path):
+def reference_template(bucket, reference_template_path):
+    """
+    Reference template, cached across warm invocations. The cached copy
+    is validated by its ETag, at most every TEMPLATE_CACHE_TTL_SECONDS.
+
+    Returns
+    -------
+    dictionary, 'etag', 'content' and 'rendered': the rendered template
+     keys by collection key layout
+    """
+    cache_key = (bucket, reference_template_path)
+    with template_lock:
+        cached = template_cache.get(cache_key)
+        if cached and time.monotonic() - cached['validated'] < \
+                template_cache_ttl:
+            return cached
+        etag = storage.head_object(bucket, reference_template_path)['ETag']
+        if cached is None or cached['etag'] != etag:
+            obj = storage.get_object(bucket, reference_template_path)
+            try:
+                content = obj['Body'].read().decode('utf-8')
+            finally:
+                obj['Body'].close()
+            # The ETag of the content read, in case it changed meanwhile
+            cached = {'etag': obj['ETag'], 'content': content,
+                      'rendered': {}}
+            template_cache[cache_key] = cached
+        cached['validated'] = time.monotonic()
+        return cached
+
+
+def handle_template(data_table, bucket, reference_template_path):
     """
     Handle all html template related changes.
+    The template depends only on the collection keys of the table, the
+    rendered templates are content addressed,
+    {TEMPLATE_RENDER_PREFIX}{sha256 of the html}.liquid.html, so the
+    patients with the same layout share one object, written once.
+
+    Returns
+    -------
+    S3 uri of the rendered template
     """
     # Read the reference template
-    template_object = boto3.resource('s3').\
-        Object(bucket, reference_template_path)
-    template_content = template_object.get()['Body'].read().decode('utf-8')
-
-    # Modify the template
-    complete_template = modify_template_content(template_content,
-                                                data_table.keys())
-
-    # Save the new template
-    s3object = boto3.resource('s3').Object(bucket, patient_template_path)
-    s3object.put(
-        Body=(complete_template.encode('UTF-8')),
-        ServerSideEncryption="aws:kms",
-    )
+    reference = reference_template(bucket, reference_template_path)
+    layout = tuple(data_table.keys())
+    with template_lock:
+        rendered_path = reference['rendered'].get(layout)
+    if rendered_path is None:
+        # Modify the template
+        complete_template = modify_template_content(
+            reference['content'], layout).encode('UTF-8')
+        rendered_path = '{}{}.liquid.html'.format(
+            template_render_prefix,
+            hashlib.sha256(complete_template).hexdigest())
+
+        # Save the new template, unless an earlier invocation did
+        if storage.head_object(
+                bucket, rendered_path, missing_ok=True) is None:
+            storage.write_bytes(bucket, rendered_path, complete_template)
+        with template_lock:
+            reference['rendered'][layout] = rendered_path
 
     # Return the complete template path
-    return "s3://{}/{}".format(bucket, patient_template_path)
-
-
-def write_dataframe_to_csv_on_s3(dataframe, filename, bucket):
-    """ Write a dataframe to a CSV on S3 """
+    return "s3://{}/{}".format(bucket, rendered_path)
 
-    # Create buffer
-    csv_buffer = StringIO()
 
-    # Write dataframe to buffer
-    dataframe.to_csv(csv_buffer, index=False)
-
-    # Create S3 object
-    s3_resource = boto3.resource("s3")
+def ui_template(tables):
+    """
+    UI template of a labeling job, rendered by handle_template for the
+    collection keys of the tables of its data objects, in sorted order,
+    from the reference template TEMPLATE_PATH.
+    ----------
+    fieldname : tables
+        list of the 'table' of the data objects
 
-    # Write buffer to S3 object
-    s3_resource.Object(bucket, filename).put(
-        Body=csv_buffer.getvalue(), ServerSideEncryption="aws:kms")
+    Returns
+    -------
+    S3 uri of the rendered template
+    """
+    layout = sorted(set().union(*tables))
+    return handle_template(
+        dict.fromkeys(layout), os.environ['PRODUCTION'],
+        os.environ['TEMPLATE_PATH'])
 
 
-def write_timeline(mrn, previously_reviewed):
+@metrics.timed('ledger_update')
+def write_timeline(mrn, previously_reviewed, job_name):
     '''
     writes patient MRN, PR and creationtime to JobCreationTime file,
-    in order to track label job creation times
+    in order to track label job creation times.
+    The rows are keyed by job name and MRN, a replayed record or batch
+    does not write its rows again.
 
     '''
     key = os.environ['CREATIONTIME_JOBS']
     bucket = os.environ['PRODUCTION']
     source_csv = f's3://{bucket}/source-csv/{mrn}.csv'
 
-    s3_client = boto3.client('s3')
-    csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-    body = csv_obj['Body']
-    csv_string = body.read().decode('utf-8')
-    dataframe = pd.read_csv(StringIO(csv_string))
-
-    current_time = time.localtime(time.time())
-    timestamp = time.mktime(current_time)
-    currenttime = date.fromtimestamp(timestamp)
-    dictionary = {'MRN': mrn, 'PR': previously_reviewed,
-                  'CreationTime': currenttime,
-                  'SourceCSV': source_csv}
-    dataframe = dataframe.append(dictionary, ignore_index=True)
-    write_dataframe_to_csv_on_s3(dataframe, key, bucket)
+    with timeline_lock:
+        dataframe = storage.read_csv(bucket, key)
+        if 'JobName' in dataframe.columns and (
+                (dataframe['JobName'] == job_name)
+                & (dataframe['MRN'].astype(str) == str(mrn))).any():
+            print('time line has', mrn, 'of', job_name)
+            return
+
+        current_time = time.localtime(time.time())
+        timestamp = time.mktime(current_time)
+        currenttime = date.fromtimestamp(timestamp)
+        dictionary = {'MRN': mrn, 'PR': previously_reviewed,
+                      'CreationTime': currenttime,
+                      'SourceCSV': source_csv,
+                      'JobName': job_name}
+        dataframe = dataframe.append(dictionary, ignore_index=True)
+        storage.write_csv(bucket, key, dataframe)
 
     print('finished writing time line')
 
@@ -271,57 +354,56 @@ def get_table(dataframe):
     ----
     Because of the payload limit of the input manifest file,
     the table size is restricted (max_record_number)
+    The encounter dates are the ipac.schema.collection_labels.
     """
     dataframe['collection_dt_tm'] = pd.to_datetime(
         dataframe['collection_dt_tm'])
     max_record_number = 11
-    # Sort by collection dates
-    dataframe.sort_values(['collection_dt_tm'], inplace=True)
+    # Sort by collection dates, same day collections keep the csv order
+    dataframe.sort_values(
+        ['collection_dt_tm'], kind='mergesort', inplace=True)
     if len(dataframe) > max_record_number:
-        dataframe = dataframe.loc[:max_record_number]
+        # object columns, the categorical and datetime columns
+        # can not hold the empty overflow row
+        dataframe = dataframe.loc[:max_record_number].astype(object)
         dataframe.loc[max_record_number, :] = ""
         dataframe.loc[max_record_number, 'name_first'] = \
             'Patient has too many collection dates,\
             please check Cerner to for more details!'
     # Generate a label for collection count, if there are multiple collections
-    # on the same day
-    count = 0
-    collection_date = ''
-    for index in dataframe.index:
-        if index < max_record_number - 1:
-            print(f'index :{index}')
-            print(dataframe['collection_dt_tm'])
-            if collection_date == dataframe.loc[index, 'collection_dt_tm']:
-                count += 1
-            else:
-                count = 1
-            collection_date = dataframe.loc[index, 'collection_dt_tm']
-            dataframe.loc[index, 'collection_count'] = \
-                '{collection_date}_{number}'.format(
-                    collection_date=pd.to_datetime(dataframe.loc[
-                        index, 'collection_dt_tm']).strftime('%Y-%m-%d'),
-                    number=count,
-            )
-        else:
-            dataframe.loc[index, 'collection_count'] = "DateNotAvailable"
-
-    dataframe = dataframe.set_index('collection_count')
-    # Transform into a dictionary
-    table_dict = dataframe.astype(str).T.to_dict()
-
+    # on the same day, the rows from the 10th on are not labelled
+    collection_counts = schema.collection_labels(
+        dataframe['collection_dt_tm']).to_numpy()
+    collection_counts[max_record_number - 1:] = schema.NO_COLLECTION_LABEL
+
+    # Transform into a dictionary, column by column
+    columns = [
+        (humanname, dataframe[fieldname].astype(str).to_numpy())
+        for fieldname, humanname in get_table_fields()
+        if fieldname in dataframe.columns]
     table = {}
-    for collection_date in table_dict:
-        table[collection_date] = []
-        for fieldname, humanname in get_table_fields():
-            try:
-                table[collection_date].append(
-                    [humanname, table_dict[collection_date][fieldname]]
-                    )
-            except KeyError:
-                pass
+    for position, collection_date in enumerate(collection_counts):
+        table[collection_date] = [
+            [humanname, values[position]] for humanname, values in columns]
     return table
 
 
+def listed_plot_index(bucket, mrn_id, table):
+    """
+    Plot index of a patient without ipac.schema.PLOT_INDEX_KEY, the IWP
+    plots are listed and matched to the sorted table keys by position.
+    """
+    print(f'No plot index for {mrn_id}, listing its plots')
+    plots = sorted(set(storage.list_keys(
+        bucket, prefix=f'images/{mrn_id}/IWP/plots_')))
+    return {
+        'timeline': {'uri': f's3://{bucket}/images/{mrn_id}/timeline.png'},
+        'iwp_plots': {
+            collection_time: {'uri': f's3://{bucket}/{plot}'}
+            for collection_time, plot in zip(sorted(table), plots)},
+    }
+
+
 def gen_data_dict(dataframe, bucket):
     """
     Generate input manifest content.
@@ -344,27 +426,11 @@ def gen_data_dict(dataframe, bucket):
                 data[column] = dataframe[column][0]
 
     if 'clabsi' in dataframe.columns:
-        data['collection_class'] = []
-        count = 0
-        collection_date = ''
-        for index in dataframe.index:
-
-            if collection_date == dataframe.loc[index, 'collection_dt_tm']:
-                count += 1
-            else:
-                count = 1
-            collection_date = dataframe.loc[index, 'collection_dt_tm']
-
-            collection_count = '{collection_date}_{number}'.format(
-                collection_date=pd.to_datetime(dataframe.loc[
-                    index, 'collection_dt_tm']).strftime('%Y-%m-%d'),
-                number=count,
-                )
-
-            if str(dataframe.loc[index, 'clabsi']).lower() =='true':
-                print('i passed true test!', dataframe.loc[index, 'clabsi'].astype(str))
-
-                data['collection_class'].append((collection_count))
+        # The dataframe was sorted by get_table
+        collection_counts = schema.collection_labels(
+            dataframe['collection_dt_tm'])
+        selected = dataframe['clabsi'].astype(str).str.lower() == 'true'
+        data['collection_class'] = collection_counts[selected].tolist()
 
         print(data['collection_class'])
     if 'comment' in dataframe.columns:
@@ -378,214 +444,397 @@ def gen_data_dict(dataframe, bucket):
             data['comment'] = " ".join([data['comment'], "----", str(
                 dataframe['new_comment'][0])])
 
-    data['sourcetimelineimg'] = f's3://{bucket}/images/{mrn_id}/timeline.png'
     data['source-ref'] = str(mrn_id)
-
-    # Listing all the plots existing under patient mrn folder in s3
-    responses = boto3.client('s3').list_objects(
-        Bucket=bucket,
-        Delimiter=f'images/{mrn_id}/IWP/plots_',
-        Prefix=f'images/{mrn_id}/IWP/plots_',
-    )
-
-    plot_list = []
-    for response in responses['Contents']:
-        plot_list.append(response['Key'])
-
-    # Creating a list for Infection Window plots
+    plot_index = storage.read_json(
+        bucket, schema.PLOT_INDEX_KEY.format(mrn=mrn_id), missing_ok=True)
+    if plot_index is None:
+        # Patient preprocessed before the plot index was written
+        plot_index = listed_plot_index(bucket, mrn_id, data['table'])
+    data['sourcetimelineimg'] = plot_index['timeline']['uri']
+
+    # Infection Window plots of the table rows, matched by collection
+    # label, the overflow row of a long table has no plot
     data['iwp_plots'] = {}
-    plots = sorted(list(set(plot_list)))
-
-    for index, collection_time in enumerate(
-            sorted(list(data['table'].keys()))):
-        data['iwp_plots'][collection_time] = f's3://{bucket}/{plots[index]}'
+    for collection_time in data['table']:
+        plot = plot_index['iwp_plots'].get(collection_time)
+        if plot is not None:
+            data['iwp_plots'][collection_time] = plot['uri']
 
     print(data['iwp_plots'])
 
     return data
 
 
-def lambda_handler(event, context):
+def build_data_object(bucket, key):
     """
-    Recieves event, by getting triggered with addition of
-     files to s3://ipac-clabsi-production/source-csv/.
-    Creates a input manifest file from the context of dataframe.
-    Sends a request to sagemaker client for Label job creation.
-
+    Read a patient csv and build its data object of the input manifest.
     ----------
-    fieldname : Event
-        AWS Lambda uses this parameter to pass in event data to the handler.
-        This parameter is usually of the Python dict type.
-        It can also be list, str, int, float, or NoneType type.
-        When you invoke your function,
-        you determine the content and structure of the event.
-        When an AWS service invokes your function,
-        the event structure varies by service.
-        For details, see Using AWS Lambda with other services.
-
-    fieldname: context
-        AWS Lambda uses this parameter to
-         provide runtime information to your handler
-
+    fieldname : bucket, key
+        location of the patient csv
 
     Returns
     -------
-        Sagemaker labeling job status description
+    data object, dictionary
+    worker_id, string, the reviewer or review round of the task
     """
-    print(context)
-    s3_client = boto3.client('s3')
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'],
-                                    encoding='utf-8')
-    filename = os.path.basename(key)
-    manifest_path = 'manifests/' + filename + '.manifest'
-    mrn = filename.split(".")[0]
-
-    try:
-        # read csv file
-        csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-        body = csv_obj['Body']
-        csv_string = body.read().decode('utf-8')
-
-        # initialize the data dictionary
-        # Grab the header and turn it into json
-        dataframe = pd.read_csv(StringIO(csv_string))
+    # read csv file
+    # initialize the data dictionary
+    # Grab the header and turn it into json
+    with metrics.span('patient_csv_read'):
+        dataframe = storage.read_csv(
+            bucket, key, typed=True, usecols=schema.usecols(
+                schema.TABLE_COLUMN_NAMES, schema.REVIEW_COLUMN_NAMES))
 
         # Remove NaN from the dataframe, because json can not handle NaN
-        dataframe.fillna('None', inplace=True)
-
-        # tracking the number of previews reviews
-        dataframe.drop(columns=[
-            i for i in dataframe.columns if i[:3] == 'Unn'], inplace=True)
-        # PR mean previously reviewed.
-        # If this dataframe has been previously through the job creation
-        # pipeline it will have the column PR
-        # We will increase the value of PR by 1 to
-        # track the number of times this case has been reviewed.
-
-        if 'PR' in dataframe.columns:
-            print('increasing pr by 1')
-            dataframe.loc[:, 'PR'] += 1
-        else:
-            dataframe.loc[:, 'PR'] = 0
-        previously_reviewed = dataframe['PR'].max()
-
-        if 'mrn' in dataframe.columns:
-            mrn_id = dataframe.mrn[0]
-        if 'MRN' in dataframe.columns:
-            mrn_id = dataframe.MRN[0]
-        mrn_id = str(mrn_id)
-
+        dataframe = schema.fillna(dataframe, 'None')
+
+    # tracking the number of previews reviews
+    dataframe.drop(columns=[
+        i for i in dataframe.columns if i[:3] == 'Unn'], inplace=True)
+    # PR mean previously reviewed.
+    # If this dataframe has been previously through the job creation
+    # pipeline it will have the column PR
+    # We will increase the value of PR by 1 to
+    # track the number of times this case has been reviewed.
+
+    if 'PR' in dataframe.columns:
+        print('increasing pr by 1')
+        dataframe.loc[:, 'PR'] += 1
+    else:
+        dataframe.loc[:, 'PR'] = 0
+    previously_reviewed = dataframe['PR'].max()
+
+    if 'mrn' in dataframe.columns:
+        mrn_id = dataframe.mrn[0]
+    if 'MRN' in dataframe.columns:
+        mrn_id = dataframe.MRN[0]
+    mrn_id = str(mrn_id)
+
+    with metrics.span('manifest_build'):
         data = gen_data_dict(dataframe, bucket)
 
         data['csv_bucket'] = os.environ['PRODUCTION']
         data['csv_path'] = key
         data['pr'] = previously_reviewed
         data['mrn'] = mrn_id
-        # Write our manifest file if going through groundstation
-        s3write = boto3.resource('s3')
-        s3object = s3write.Object(bucket, manifest_path)
-        s3object.put(Body=(bytes(json.dumps(
-            data, default=convert).encode('UTF-8'))),
-            ServerSideEncryption="aws:kms")
-
-        # Handle UI template
-        complete_template_path_uri = "s3://{}/{}".format(
-            os.environ['PRODUCTION'],
-            os.environ['TEMPLATE_PATH'],
-        )
-        # Writing the patient MRN to CreationTime file,
-        #  so it can be tracked, and relunched if expired.
-        write_timeline(mrn_id, dataframe['PR'][0])
-        if 'second_reviewer_id' in dataframe.columns:
-            worker_id = dataframe['second_reviewer_id'][0]
+
+    if 'second_reviewer_id' in dataframe.columns:
+        worker_id = dataframe['second_reviewer_id'][0]
+    else:
+        if 'first_reviewer_id' in dataframe.columns:
+            worker_id = dataframe['first_reviewer_id'][0]
         else:
-            if 'first_reviewer_id' in dataframe.columns:
-                worker_id = dataframe['first_reviewer_id'][0]
-            else:
-                worker_id = 'Ready_for_ICP_review'
+            worker_id = 'Ready_for_ICP_review'
+
+    if dataframe['PR'][0] >= 1:
+        worker_id = 'Ready-for-physician-review'
 
+    return data, str(worker_id)
 
-        if dataframe['PR'][0] >= 1:
-            worker_id = 'Ready-for-physician-review'
 
-        # Job name is the name in the Ground Truth queue, it has to be unique
+def labeling_job_request(job_name, task_name, input_manifest_uri,
+                         output_manifest_uri, ui_template_uri):
+    """
+    Ground Truth labeling job request, the task settings
+    come from the environment variables.
+    ----------
+    fieldname : ui_template_uri
+        S3 uri of the UI template, see ui_template
+    """
+    # Ground Truth job request building
+    human_task_config = {
+        "AnnotationConsolidationConfig": {
+            "AnnotationConsolidationLambdaArn":
+            os.environ['POST_LABEL_ARN'],
+        },
+        "PreHumanTaskLambdaArn": os.environ['PRE_LABEL_ARN'],
+        "MaxConcurrentTaskCount": int(os.environ[
+            'MAX_CONCURRENT_TASK_COUNT']),
+        # 200 texts will be sent at a time to the workteam.
+        "NumberOfHumanWorkersPerDataObject": int(os.environ[
+            'NUMBER_OF_HUMAN_WORKERS_PER_DATA_OBJECT']),
+        # 1 workers will be enough to label each text.
+        "TaskAvailabilityLifetimeInSeconds": int(os.environ[
+            'TASK_AVAILABILITY_LIFE_TIME_IN_SECONDS']),
+        # Your work team has 6 hours to complete all pending tasks.
+        "TaskDescription": task_name,
+        "TaskTimeLimitInSeconds": int(os.environ[
+            'TASK_TIME_LIMIT_IN_SECONDS']),
+        # Each text must be labeled within 5 minutes.
+        "TaskTitle": task_name,
+        "UiConfig": {
+            "UiTemplateS3Uri": ui_template_uri,
+        },
+    }
+
+    human_task_config["WorkteamArn"] = os.environ['PRIVATE_WORK_TEAM_ARN']
+    # Creating the Ground truth label job request
+    return {
+        "InputConfig": {
+            "DataSource": {
+                "S3DataSource": {
+                    "ManifestS3Uri": input_manifest_uri,
+                },
+            },
+            "DataAttributes": {
+                "ContentClassifiers": [
+                    "FreeOfPersonallyIdentifiableInformation",
+                    "FreeOfAdultContent",
+                ]
+            },
+        },
+        "OutputConfig": {
+            "S3OutputPath": output_manifest_uri,
+        },
+        "HumanTaskConfig": human_task_config,
+        "LabelingJobName": job_name,
+        "RoleArn": os.environ['GROUNDTRUTH_ROLE'],
+        "LabelAttributeName": "category",
+    }
+
+
+def submit_labeling_job(ground_truth_request):
+    """
+    Submit a Ground Truth labeling job, called by the scheduler.
+    The job is not described after its creation, a second API call
+    per job only adds to the throttling.
+
+    Returns
+    -------
+        Sagemaker labeling job ARN
+    """
+    sagemaker_client = clients.get_client('sagemaker')
+    with metrics.span('labeling_job'):
+        return sagemaker_client.create_labeling_job(
+            **ground_truth_request)['LabelingJobArn']
+
+
+def job_time(record):
+    """
+    Creation time in the labeling job name, the time of the S3 event,
+    or the current time if the record has none.
+
+    Returns
+    -------
+    string, %Y-%m-%d-%H-%M-%S
+    """
+    if record.get('eventTime'):
+        return pd.Timestamp(record['eventTime']).strftime('%Y-%m-%d-%H-%M-%S')
+    return time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(time.time()))
+
+
+def create_job(record):
+    """
+    Create the labeling job of the patient csv of one S3 event record,
+    see lambda_handler. In batching mode (JOB_BATCH_SIZE above 1) the
+    data object is only staged, see flush_pending. A replayed record
+    has the job name of its first attempt, see job_time.
+
+    Returns
+    -------
+        Sagemaker labeling job ARN, 'Queued' when the submission is
+         left to the scheduled drain (see scheduler), 'Staged' in
+         batching mode
+    """
+    # Get the object from the event and show its content type
+    bucket, key = events.s3_location(record)
+    filename = os.path.basename(key)
+    manifest_path = 'manifests/' + filename + '.manifest'
+    mrn = filename.split(".")[0]
+
+    try:
+        data, worker_id = build_data_object(bucket, key)
+        mrn_id = data['mrn']
+
+        if job_batch_size > 1:
+            # A csv posted again replaces the staged data object
+            storage.write_json(
+                bucket, f'{job_pending_prefix}{mrn}.json', {
+                    'staged_at': time.time(),
+                    'worker_id': worker_id,
+                    'data_object': data,
+                }, default=convert)
+            print('Staged', mrn_id, 'for', worker_id)
+            return 'Staged'
+
+        # Write our manifest file if going through groundstation
+        with metrics.span('manifest_build'):
+            storage.write_json(bucket, manifest_path, data, default=convert)
+
+        # Job name is the name in the Ground Truth queue, it has to be
+        # unique. It is made of the event time, a replayed record is
+        # then a duplicate of the job it already created (see scheduler)
         job_name = 'MRN-{mrn_id}-reviewed-{review_number}-times-{creation_time}'. \
             format(**{
                     'mrn_id': mrn_id,
-                    'review_number': dataframe["PR"][0],
-                    'creation_time': time.strftime('%Y-%m-%d-%H-%M',
-                     time.localtime(time.time()))})
+                    'review_number': data['pr'],
+                    'creation_time': job_time(record)})
         print('Job_name', job_name)
 
         # Task name is the job name and description on the user UI
         task_name = 'mrn:{}-- Number of previous reviews:{}--{}'\
-            .format(mrn_id, dataframe["PR"][0], worker_id)
+            .format(mrn_id, data['pr'], worker_id)
         print('Task name:', task_name)
 
         # Manifest file paths
         input_manifest_uri = "s3://{}/{}".format(bucket, manifest_path)
         output_manifest_uri = 's3://{}/output/{}'.format(bucket, mrn)
 
-        # Ground Truth job request building
-        human_task_config = {
-            "AnnotationConsolidationConfig": {
-                "AnnotationConsolidationLambdaArn":
-                os.environ['POST_LABEL_ARN'],
-            },
-            "PreHumanTaskLambdaArn": os.environ['PRE_LABEL_ARN'],
-            "MaxConcurrentTaskCount": int(os.environ[
-                'MAX_CONCURRENT_TASK_COUNT']),
-            # 200 texts will be sent at a time to the workteam.
-            "NumberOfHumanWorkersPerDataObject": int(os.environ[
-                'NUMBER_OF_HUMAN_WORKERS_PER_DATA_OBJECT']),
-            # 1 workers will be enough to label each text.
-            "TaskAvailabilityLifetimeInSeconds": int(os.environ[
-                'TASK_AVAILABILITY_LIFE_TIME_IN_SECONDS']),
-            # Your work team has 6 hours to complete all pending tasks.
-            "TaskDescription": task_name,
-            "TaskTimeLimitInSeconds": int(os.environ[
-                'TASK_TIME_LIMIT_IN_SECONDS']),
-            # Each text must be labeled within 5 minutes.
-            "TaskTitle": task_name,
-            "UiConfig": {
-                "UiTemplateS3Uri": complete_template_path_uri,
-            },
-        }
-
-        human_task_config["WorkteamArn"] = os.environ['PRIVATE_WORK_TEAM_ARN']
-        # Creating the Ground truth label job request
-        ground_truth_request = {
-            "InputConfig": {
-                "DataSource": {
-                    "S3DataSource": {
-                        "ManifestS3Uri": input_manifest_uri,
-                    },
-                },
-                "DataAttributes": {
-                    "ContentClassifiers": [
-                        "FreeOfPersonallyIdentifiableInformation",
-                        "FreeOfAdultContent",
-                    ]
-                },
-            },
-            "OutputConfig": {
-                "S3OutputPath": output_manifest_uri,
-            },
-            "HumanTaskConfig": human_task_config,
-            "LabelingJobName": job_name,
-            "RoleArn": os.environ['GROUNDTRUTH_ROLE'],
-            "LabelAttributeName": "category",
-        }
-
-        # Submit ground truth job
-        sagemaker_client = boto3.client('sagemaker')
-        sagemaker_client.create_labeling_job(**ground_truth_request)
+        # Submit ground truth job, through the rate limited queue
+        result = scheduler.submit(
+            os.environ['PRODUCTION'],
+            labeling_job_request(
+                job_name, task_name, input_manifest_uri,
+                output_manifest_uri, ui_template([data['table']])),
+            submit_labeling_job)
 
-        return sagemaker_client.describe_labeling_job(
-            LabelingJobName=job_name)['LabelingJobStatus']
+        # Writing the patient MRN to CreationTime file once the job is
+        #  queued, so it can be tracked, and relunched if expired.
+        write_timeline(mrn_id, data['pr'], job_name)
+        return result
 
     except Exception as error:
         print(error)
-        raise error
\ No newline at end of file
+        raise error
+
+
+def ready_batches(pending, now, force=False):
+    """
+    Split the staged data objects into labeling job batches.
+    Objects of the same review round (worker_id) are batched together,
+    oldest first, at most JOB_BATCH_SIZE per batch. A smaller batch is
+    ready when its oldest object waited JOB_BATCH_WINDOW_SECONDS.
+    ----------
+    fieldname : pending
+        list of (key, staged object) pairs
+    fieldname: now
+        float, epoch seconds
+    fieldname: force
+        bool, every batch is ready
+
+    Returns
+    -------
+    list of (worker_id, list of (key, staged object)), the ready batches
+    """
+    rounds = {}
+    for key, staged in sorted(
+            pending, key=lambda item: item[1]['staged_at']):
+        rounds.setdefault(staged['worker_id'], []).append((key, staged))
+    batches = []
+    for worker_id, staged_objects in rounds.items():
+        for start in range(0, len(staged_objects), job_batch_size):
+            batch = staged_objects[start:start + job_batch_size]
+            if (force or len(batch) == job_batch_size
+                    or now - batch[0][1]['staged_at'] >= job_batch_window):
+                batches.append((worker_id, batch))
+    return batches
+
+
+def flush_pending(bucket, force=False):
+    """
+    Queue one labeling job per ready batch of staged data objects,
+    the scheduler submits them. The input manifest has one line per
+    patient, with the source-ref, csv_path and pr loop_lambda routes
+    the result by. The staged objects are deleted once their job is
+    queued and written to the job creation time file.
+    ----------
+    fieldname : bucket
+        string, bucket of the staged objects and manifests
+    fieldname: force
+        bool, submit the batches smaller than JOB_BATCH_SIZE too
+
+    Returns
+    -------
+    dictionary, key: job name, value: 'Queued' or error
+    """
+    pending = [
+        (key, storage.read_json(bucket, key))
+        for key in storage.list_keys(bucket, job_pending_prefix)
+        if key.endswith('.json')]
+    queued = {}
+    batches = ready_batches(pending, time.time(), force)
+    for worker_id, batch in batches:
+        data_objects = [staged['data_object'] for _, staged in batch]
+        # Job name is the name in the Ground Truth queue, it has to be
+        # unique, the digest tells apart the batches of the same second.
+        # It is made of the staging time of the oldest object, a batch
+        # flushed again keeps its name (and its job creation time rows)
+        creation_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(
+            batch[0][1]['staged_at']))
+        digest = hashlib.sha1(','.join(
+            '{mrn}:{pr}'.format(**data) for data in data_objects
+        ).encode('utf-8')).hexdigest()[:8]
+        job_name = 'batch-{}-{}-patients-{}'.format(
+            creation_time, digest, len(batch))
+        manifest_path = f'manifests/batches/{job_name}.manifest'
+        task_name = 'batch of {} patients--{}'.format(len(batch), worker_id)
+        print('Job_name', job_name)
+        try:
+            with metrics.span('manifest_build'):
+                storage.write_json_lines(
+                    bucket, manifest_path, data_objects, default=convert)
+            scheduler.enqueue(bucket, labeling_job_request(
+                job_name, task_name,
+                's3://{}/{}'.format(bucket, manifest_path),
+                's3://{}/output/batches'.format(bucket),
+                ui_template([data['table'] for data in data_objects])))
+            for data in data_objects:
+                write_timeline(data['mrn'], data['pr'], job_name)
+            queued[job_name] = 'Queued'
+        except Exception as error:
+            print('Batch {} failed: {!r}'.format(job_name, error))
+            queued[job_name] = repr(error)
+            continue
+        for key, _ in batch:
+            storage.delete_object(bucket, key)
+    print('Queued {} batches, {} objects still staged'.format(
+        len(queued),
+        len(pending) - sum(len(batch) for _, batch in batches)))
+    return queued
+
+
+@profiling.profile('job_creation')
+@metrics.instrument('job_creation')
+def lambda_handler(event, context):
+    """
+    Recieves event, by getting triggered with addition of
+     files to s3://ipac-clabsi-production/source-csv/.
+    Creates a input manifest file from the context of dataframe.
+    Sends a request to sagemaker client for Label job creation.
+    Every record of the event is processed, see create_job.
+
+    ----------
+    fieldname : Event
+        AWS Lambda uses this parameter to pass in event data to the handler.
+        This parameter is usually of the Python dict type.
+        It can also be list, str, int, float, or NoneType type.
+        When you invoke your function,
+        you determine the content and structure of the event.
+        When an AWS service invokes your function,
+        the event structure varies by service.
+        For details, see Using AWS Lambda with other services.
+
+    fieldname: context
+        AWS Lambda uses this parameter to
+         provide runtime information to your handler
+
+
+    Returns
+    -------
+        per record summary of ipac.events.dispatch, with the
+         result of create_job for each record, the failed records
+         are re-driven by ipac.events.redrive,
+         the stage metrics are printed as one line (ipac.metrics)
+    """
+    print(context)
+    # Scheduled flush of the staged data objects, see flush_pending,
+    # {"flush": true} also submits the batches smaller than JOB_BATCH_SIZE,
+    # then the queued submissions are drained at the sustainable rate
+    if event.get('source') == 'aws.events' or event.get('flush'):
+        batches = flush_pending(
+            os.environ['PRODUCTION'], force=bool(event.get('flush')))
+        summary = scheduler.drain(
+            os.environ['PRODUCTION'], submit_labeling_job)
+        summary['batches'] = batches
+        return summary
+    return events.redrive(event, events.dispatch(event, create_job), context)
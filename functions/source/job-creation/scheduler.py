@@ -0,0 +1,331 @@
+"""
+Rate limited submission of the Ground Truth labeling jobs.
+Purpose
+-------
+A large preprocess run writes hundreds of patient csv files within
+seconds, and create_labeling_job is throttled when they are all
+submitted at once. Every labeling job request is first written to a
+persistent queue, JOB_QUEUE_PREFIX in the production bucket, then
+the scheduled invocation drains the queue for at most
+JOB_DRAIN_SECONDS, at JOB_SUBMIT_RATE requests per second (token
+bucket of JOB_SUBMIT_BURST tokens). It is the only invocation
+submitting, which caps the concurrency to one, whatever the number of
+concurrent job creation invocations.
+
+JOB_SUBMIT_DIRECT=1 also lets the invocation which queued a request try
+it once. The token bucket is per container, so this is only safe when
+few csv files arrive at once, a throttled request stays queued.
+
+A throttled request is retried after a jittered exponential backoff
+until it is accepted. A transient error, a server or connection error,
+is retried the same way at most JOB_MAX_ATTEMPTS times. Any other
+error is permanent, e.g. a ValidationException or a missing role. The
+request is then moved to JOB_DEAD_LETTER_PREFIX with its error, and
+reported (JobQueue.dead_lettered). Fix the cause and move the entry
+back to JOB_QUEUE_PREFIX to retry it.
+
+Queue entry, {JOB_QUEUE_PREFIX}{enqueued at in ms}-{job name}.json:
+
+    {
+        'enqueued_at': epoch seconds,
+        'attempts': failed attempts,
+        'not_before': epoch seconds of the next attempt,
+        'last_error': string,
+        'request': create_labeling_job arguments,
+        'dead_lettered_at': epoch seconds, dead-letter entries only,
+    }
+
+The queue depth, the wait of the submitted requests and the number of
+throttled, failed and dead-lettered attempts are recorded in
+ipac.metrics (JobQueue.*).
+"""
+import os
+import time
+import random
+import threading
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from botocore.exceptions import HTTPClientError
+from ipac import metrics
+from ipac import storage
+
+job_queue_prefix = os.environ.get('JOB_QUEUE_PREFIX', 'manifests/queue/')
+# Requests which failed permanently, or too many times
+job_dead_letter_prefix = os.environ.get(
+    'JOB_DEAD_LETTER_PREFIX', 'manifests/dead-letter/')
+# Attempts of a request failing with a transient error
+job_max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+# Try the request once in the invocation which queued it,
+# every concurrent invocation then calls create_labeling_job
+submit_direct = os.environ.get('JOB_SUBMIT_DIRECT', '0') == '1'
+# Sustainable create_labeling_job rate, requests per second, and burst
+submit_rate = float(os.environ.get('JOB_SUBMIT_RATE', '0.5'))
+submit_burst = int(os.environ.get('JOB_SUBMIT_BURST', '2'))
+# Jittered exponential backoff of the failed requests, seconds
+backoff_base = float(os.environ.get('JOB_BACKOFF_BASE_SECONDS', '2'))
+backoff_cap = float(os.environ.get('JOB_BACKOFF_CAP_SECONDS', '300'))
+# Time budget of the scheduled drain, below the schedule period
+drain_seconds = float(os.environ.get('JOB_DRAIN_SECONDS', '240'))
+
+# Error codes of the throttled and limited requests
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'ResourceLimitExceeded',
+    'LimitExceededException',
+}
+# Error codes of the server side errors, retried
+TRANSIENT_ERROR_CODES = {
+    'InternalFailure',
+    'InternalServerError',
+    'ServiceUnavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+# The job exists, it was submitted by an earlier attempt
+DUPLICATE_ERROR_CODES = {'ResourceInUse'}
+# Result of a request moved to the dead-letter prefix
+DEAD_LETTERED = 'DeadLettered'
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, thread safe.
+    ----------
+    fieldname : rate
+        float, tokens added per second
+    fieldname: capacity
+        int, maximum number of tokens, the burst size
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """
+        Take a token, waiting at most timeout seconds (None: forever).
+
+        Returns
+        -------
+        bool, False if no token was available in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+# Shared by the submissions of this (warm) Lambda container
+token_bucket = TokenBucket(submit_rate, submit_burst)
+
+
+def error_code(error):
+    """ AWS error code of a botocore ClientError, else None """
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+
+def error_kind(error):
+    """
+    Retry class of a failed request.
+
+    Returns
+    -------
+    'throttled', 'transient' or 'permanent'
+    """
+    code = error_code(error)
+    if code in THROTTLING_ERROR_CODES:
+        return 'throttled'
+    status = getattr(error, 'response', {}).get(
+        'ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    if (code in TRANSIENT_ERROR_CODES or status >= 500
+            or isinstance(error, (BotoConnectionError, HTTPClientError))):
+        return 'transient'
+    return 'permanent'
+
+
+def backoff_delay(attempts):
+    """
+    Full jitter exponential backoff: a random delay between 0 and
+    min(JOB_BACKOFF_CAP_SECONDS, JOB_BACKOFF_BASE_SECONDS * 2 ** attempts).
+    """
+    return random.uniform(
+        0, min(backoff_cap, backoff_base * 2 ** min(attempts, 32)))
+
+
+def enqueue(bucket, request):
+    """
+    Write a labeling job request to the queue.
+
+    Returns
+    -------
+    key, entry of the queue
+    """
+    now = time.time()
+    key = '{}{:013d}-{}.json'.format(
+        job_queue_prefix, int(now * 1000), request['LabelingJobName'])
+    entry = {'enqueued_at': now, 'attempts': 0, 'not_before': now,
+             'request': request}
+    storage.write_json(bucket, key, entry)
+    return key, entry
+
+
+def dead_letter(bucket, key, entry):
+    """
+    Move a queued request to the dead-letter prefix.
+    """
+    entry['dead_lettered_at'] = time.time()
+    storage.write_json(
+        bucket, job_dead_letter_prefix + key[len(job_queue_prefix):], entry)
+    storage.delete_object(bucket, key)
+    metrics.count('JobQueue.dead_lettered')
+    print('Submission of {} moved to {} after {} attempts: {}'.format(
+        entry['request']['LabelingJobName'], job_dead_letter_prefix,
+        entry['attempts'], entry['last_error']))
+
+
+def pending(bucket):
+    """
+    Queued entries, oldest first.
+
+    Returns
+    -------
+    list of (key, entry)
+    """
+    return [
+        (key, storage.read_json(bucket, key))
+        for key in sorted(storage.list_keys(bucket, job_queue_prefix))
+        if key.endswith('.json')]
+
+
+def attempt(bucket, key, entry, submit):
+    """
+    Submit a queued request once. It is removed from the queue when it
+    was accepted. A throttled or transient failure is recorded with its
+    backoff, a permanent failure, or the last transient one, moves the
+    request to the dead-letter prefix.
+
+    Returns
+    -------
+    result of submit, DEAD_LETTERED or None if the request failed
+    the error of the failed request, else None
+    """
+    now = time.time()
+    try:
+        result = submit(entry['request'])
+    except Exception as error:
+        if error_code(error) not in DUPLICATE_ERROR_CODES:
+            entry['attempts'] += 1
+            entry['last_error'] = repr(error)
+            kind = error_kind(error)
+            if kind == 'permanent' or (
+                    kind == 'transient'
+                    and entry['attempts'] >= job_max_attempts):
+                dead_letter(bucket, key, entry)
+                return DEAD_LETTERED, error
+            delay = backoff_delay(entry['attempts'])
+            entry['not_before'] = now + delay
+            storage.write_json(bucket, key, entry)
+            metrics.count('JobQueue.throttled' if kind == 'throttled'
+                          else 'JobQueue.failed')
+            print('Submission of {} failed, attempt {}, retry in {:.1f} s:'
+                  ' {!r}'.format(entry['request']['LabelingJobName'],
+                                 entry['attempts'], delay, error))
+            return None, error
+        result = 'Duplicate'
+    storage.delete_object(bucket, key)
+    metrics.observe('JobQueue.wait', now - entry['enqueued_at'], 'Seconds')
+    metrics.count('JobQueue.submitted')
+    return result, None
+
+
+def submit(bucket, request, submit_request):
+    """
+    Queue a labeling job request and, with JOB_SUBMIT_DIRECT, try it
+    once if a token is available.
+    ----------
+    fieldname : bucket
+        string, bucket of the queue
+    fieldname: request
+        create_labeling_job arguments
+    fieldname: submit_request
+        function submitting a request
+
+    Returns
+    -------
+    result of submit_request, DEAD_LETTERED,
+     or 'Queued' when it is left to the drain
+    """
+    key, entry = enqueue(bucket, request)
+    if submit_direct and token_bucket.acquire(timeout=0):
+        result, _ = attempt(bucket, key, entry, submit_request)
+        if result is not None:
+            return result
+    return 'Queued'
+
+
+def drain(bucket, submit_request, budget=None):
+    """
+    Submit the queued requests whose backoff has passed, oldest first,
+    at the token bucket rate. A throttled request also backs off the
+    drain, so the next requests are not sent into the throttling.
+    ----------
+    fieldname : bucket
+        string, bucket of the queue
+    fieldname: submit_request
+        function submitting a request
+    fieldname: budget
+        float, seconds, default JOB_DRAIN_SECONDS
+
+    Returns
+    -------
+    dictionary, 'submitted', 'dead_lettered': job names,
+     'queued': queue depth left
+    """
+    deadline = time.monotonic() + (
+        drain_seconds if budget is None else budget)
+    entries = pending(bucket)
+    submitted = []
+    dead_lettered = []
+    for key, entry in entries:
+        if entry['not_before'] > time.time():
+            continue
+        if not token_bucket.acquire(
+                timeout=max(0, deadline - time.monotonic())):
+            break
+        result, error = attempt(bucket, key, entry, submit_request)
+        if error is None:
+            submitted.append(entry['request']['LabelingJobName'])
+        elif result == DEAD_LETTERED:
+            dead_lettered.append(entry['request']['LabelingJobName'])
+        elif error_kind(error) == 'throttled':
+            time.sleep(max(0, min(entry['not_before'] - time.time(),
+                                  deadline - time.monotonic())))
+        if time.monotonic() >= deadline:
+            break
+    depth = len(entries) - len(submitted) - len(dead_lettered)
+    metrics.observe('JobQueue.depth', depth)
+    print('Submitted {} queued jobs, {} dead-lettered, {} still queued'
+          .format(len(submitted), len(dead_lettered), depth))
+    return {'submitted': submitted, 'dead_lettered': dead_lettered,
+            'queued': depth}
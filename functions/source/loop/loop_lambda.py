@@ -39,38 +39,43 @@ outputmanifest schematics:
 
 """
 import os
-import json
-import urllib.parse
-from io import StringIO
-import boto3
+import functools
 import pandas as pd
 import time
+import threading
 from datetime import date
+from ipac import events
+from ipac import metrics
+from ipac import profiling
+from ipac import schema
+from ipac import storage
+
+# Serializes the read-modify-write updates of the shared files (job
+# creation time file, reporting aggregates) by concurrent records
+shared_file_lock = threading.Lock()
+
+
+def serialized(function):
+    """ Run the function holding shared_file_lock """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with shared_file_lock:
+            return function(*args, **kwargs)
+    return wrapper
+
 
 def write_dataframe_to_csv_on_s3(dataframe, filename, bucket):
-    """ Write a dataframe to a CSV on S3 """
+    """ Write a dataframe to a CSV on S3, without the unnamed columns """
 
-    # Create buffer
-    csv_buffer = StringIO()
-    
-    
     for c in dataframe.columns:
         if c[:3].lower() == 'unn':
             dataframe.drop(columns =c, inplace=True)
-    
-
-    # Write dataframe to buffer
-    dataframe.to_csv(csv_buffer, index=False)
-
-    # Create S3 object
-    s3_resource = boto3.resource("s3")
 
-    # Write buffer to S3 object
-    s3_resource.Object(
-        bucket, f'{filename}').put(
-        Body=csv_buffer.getvalue(), ServerSideEncryption="aws:kms")
+    storage.write_csv(bucket, filename, dataframe)
 
 
+@metrics.timed('ledger_update')
+@serialized
 def update_timeline(mrn, status, previously_reviewed):
 
     '''
@@ -80,11 +85,7 @@ def update_timeline(mrn, status, previously_reviewed):
     mrn = int(mrn)
     key = os.environ['CREATIONTIME_JOBS']
     bucket = os.environ['FEEDBACK_BUCKET']
-    s3_client = boto3.client('s3')
-    csv_obj = s3_client.get_object(Bucket=bucket, Key=key)
-    body = csv_obj['Body']
-    csv_string = body.read().decode('utf-8')
-    dataframe = pd.read_csv(StringIO(csv_string))
+    dataframe = storage.read_csv(bucket, key)
     print('update time line')
     indexes = dataframe.loc[dataframe['MRN'] == mrn].index
     dataframe.loc[indexes, 'status'] = status
@@ -179,6 +180,7 @@ def map_pathogen_id_to_name(pathogen_id):
     return pathogen
 
 
+@metrics.timed('review_write')
 def write_json_on_s3(bucket, object_path, data, dataframe):
 
     """
@@ -310,34 +312,18 @@ def write_json_on_s3(bucket, object_path, data, dataframe):
             print('collection_class is found')
             collection_class = data['category']['caseInfo']['collection_class']
 
-            # Sort by collection dates
-            dataframe.sort_values(['collection_dt_tm'], inplace=True)
+            # Sort by collection dates, as job_creation.get_table
+            dataframe.sort_values(
+                ['collection_dt_tm'], kind='mergesort', inplace=True)
 
-            # Iterate through each row and generate the name: "<collection>_2"
-            count = 0
-            collection_date = ''
-            for index in dataframe.index:
-                if collection_date == dataframe.loc[index, 'collection_dt_tm']:
-                    count += 1
-                else:
-                    count = 1
-                collection_date = dataframe.loc[index, 'collection_dt_tm']
-
-                collection_count = '{collection_date}_{number}'.format(
-                    collection_date=pd.to_datetime(dataframe.loc[
-                        index, 'collection_dt_tm']).strftime('%Y-%m-%d'),
-                    number=count,
-                    )
-
-                # Figure out whether this collection_class was selected
-                if collection_count in collection_class:
-                    checkmark = collection_class[collection_count]
-                else:
-                    checkmark = False
-
-                # Record it in the dataframe
-                print(collection_count, checkmark)
-                dataframe.loc[index, 'clabsi'] = checkmark
+            # Generate the name of each row: "<collection>_2", and
+            # figure out whether this collection_class was selected
+            collection_counts = schema.collection_labels(
+                dataframe['collection_dt_tm'])
+            dataframe['clabsi'] = [
+                collection_class.get(collection_count, False)
+                for collection_count in collection_counts]
+            print(dict(zip(collection_counts, dataframe['clabsi'])))
 
     except KeyError:
         print('output.manifest format problem,\
@@ -353,6 +339,8 @@ def write_json_on_s3(bucket, object_path, data, dataframe):
 
 
 
+@metrics.timed('aggregate_write')
+@serialized
 def write_csv_aggregate(bucket, dataframe, month, year, patient):
     ''' writes csv to augmented reporting folder for the final review
     '''
@@ -362,7 +350,6 @@ def write_csv_aggregate(bucket, dataframe, month, year, patient):
     dataframe['mrn'] = patient
     if "MRN" in dataframe.columns:
         dataframe.drop(columns='MRN', inplace=True)
-    client = boto3.client('s3')
     # setting up the final reporting file name scheme
     # aggregate_filename = f'for_reporting_aggregate/{year}/{month}.csv'
     
@@ -377,27 +364,11 @@ def write_csv_aggregate(bucket, dataframe, month, year, patient):
 
         print(aggregate_filename)
         print(analytic_filename)
-        aggregate_file = client.get_object(
-            Bucket=bucket, Key=aggregate_filename)
-        # parsing it
-        body = aggregate_file['Body']
-        # decodig it
-        csv_string = body.read().decode('utf-8')
-        print(csv_string)
-        # convertingit to csv
-        df_aggregate = pd.read_csv(StringIO(csv_string))
+        df_aggregate = storage.read_csv(bucket, aggregate_filename)
         # making a list of aggregate dataframe and new dataframe
         new_dataframe_aggregate = create_aggregate(dataframe)
         
-        analytic_file = client.get_object(
-            Bucket=bucket, Key=analytic_filename)
-        # parsing it
-        body_analytic = analytic_file['Body']
-        print(body_analytic)
-        # decodig it
-        csv_string_analytic = body_analytic.read().decode('utf-8')
-        # convertingit to csv
-        df_analytic = pd.read_csv(StringIO(csv_string_analytic))
+        df_analytic = storage.read_csv(bucket, analytic_filename)
 
         df_aggregate_total= pd.concat([df_aggregate,new_dataframe_aggregate],  ignore_index=True, sort=False)
         df_analytic_total = pd.concat([df_analytic, dataframe], ignore_index=True, sort=False )
@@ -427,46 +398,66 @@ def write_csv_aggregate(bucket, dataframe, month, year, patient):
 
 
 
-def lambda_handler(event, context):
+def handle_output_manifest(record):
     """
-    This function is called every time an output.manifest is generated.
-
-    It reads in the output manifest file and depending the review selection,
-    either feed the data back for labelling or push the information for
-    reporting.
+    Route the review results of the output manifest of one S3 event
+    record, see lambda_handler. The manifest has one line per reviewed
+    patient, a batched labeling job has several, each is routed by
+    handle_review and a failing patient does not stop the others.
+
+    Returns
+    -------
+    None, raises RuntimeError listing the failed patients
     """
-    print(context)
-    s3_client = boto3.client('s3')
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    event_time = event['Records'][0]['eventTime']
+    bucket, key = events.s3_location(record)
+    event_time = record['eventTime']
     year = event_time.split("-")[0]
     month = event_time.split("-")[1]
 
     # Load the output manifest
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
     # filename = os.path.basename(key)
 
     # Read ['category-metadata']['job-name']in the output.manifest data
-    output_manifest_object = s3_client.get_object(Bucket=bucket, Key=key)
-    output_manifest_body = output_manifest_object['Body']
-    manifest_data = json.loads(
-        output_manifest_body.read().decode('utf-8'))
-
-    # Output manifest contains information about the input csv
-    if 'csv_bucket' in manifest_data and 'csv_path' in manifest_data:
-        print(
-            'Loading input csv datafile',
-            manifest_data['csv_bucket'],
-            manifest_data['csv_path'])
-        # read csv file
-        csv_obj = s3_client.get_object(
-            Bucket=manifest_data['csv_bucket'],
-            Key=manifest_data['csv_path'],
-        )
-        body = csv_obj['Body']
-        dataframe = pd.read_csv(StringIO(body.read().decode('utf-8')))
+    with metrics.span('manifest_read'):
+        manifests = storage.read_json_lines(bucket, key)
+
+    failures = {}
+    for manifest_data in manifests:
+        try:
+            handle_review(manifest_data, bucket, year, month)
+        except Exception as error:
+            patient = manifest_data.get('mrn', manifest_data.get(
+                'source-ref'))
+            print('Routing patient {} failed: {!r}'.format(patient, error))
+            failures[str(patient)] = repr(error)
+    if failures:
+        raise RuntimeError('Failed patients: {}'.format(failures))
+
+
+def handle_review(manifest_data, bucket, year, month):
+    """
+    Route the review result of one patient of an output manifest,
+    either feed the data back for labelling or push it for reporting.
+    ----------
+    fieldname : manifest_data
+        dictionary, one line of the output manifest
+    fieldname: bucket
+        string, bucket of the output manifest
+    fieldname: year, month
+        strings, date of the output manifest event
+    """
+    with metrics.span('manifest_read'):
+        # Output manifest contains information about the input csv
+        if 'csv_bucket' in manifest_data and 'csv_path' in manifest_data:
+            print(
+                'Loading input csv datafile',
+                manifest_data['csv_bucket'],
+                manifest_data['csv_path'])
+            # read csv file
+            dataframe = storage.read_csv(
+                manifest_data['csv_bucket'], manifest_data['csv_path'],
+                typed=True)
 
     # finding patient MRN
     patient = manifest_data['mrn']
@@ -600,4 +591,22 @@ def lambda_handler(event, context):
                 status = 'incomplete'
                 update_timeline(patient, status,
                                 previously_reviewed)
-        print("Decision was:", decision)
\ No newline at end of file
+        print("Decision was:", decision)
+
+
+@profiling.profile('loop')
+@metrics.instrument('loop')
+def lambda_handler(event, context):
+    """
+    This function is called every time an output.manifest is generated.
+
+    It reads in the output manifest file and depending the review selection,
+    either feed the data back for labelling or push the information for
+    reporting. Every record of the event is processed,
+    see handle_output_manifest, the failed records are re-driven
+    by ipac.events.redrive.
+    The stage metrics are printed as one line (ipac.metrics).
+    """
+    print(context)
+    return events.redrive(
+        event, events.dispatch(event, handle_output_manifest), context)
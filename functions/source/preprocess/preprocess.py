@@ -14,44 +14,162 @@ Patient files are saved as {mrn}.csv in source-csv folder, will generate
 """
 import os
 import json
+import hashlib
+import functools
+import multiprocessing
 from datetime import timedelta
-import datetime
 import io
-from io import StringIO
+import pickle
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
 from matplotlib.pylab import plt
+import matplotlib.colors as mcolors
+import matplotlib.dates as mdates
+import numpy as np
 import pandas as pd
-import boto3
+import openpyxl
+from botocore.exceptions import ClientError
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+from ipac import events
+from ipac import metrics
+from ipac import profiling
+from ipac import schema
+from ipac import storage
 
 s3_path = os.environ.get('S3_raw')
 patient_processed = os.environ.get('patient_bucket')
+# Number of worker processes rendering patient plots, 1 renders serially
+render_workers = int(os.environ.get('RENDER_WORKERS', '1'))
+# Number of upload threads (and pooled S3 connections) per render process
+upload_workers = int(os.environ.get('UPLOAD_WORKERS', '8'))
+# Timeline level of detail (LOD) mode, switched on above this number of
+# collections: same day collections are merged, the figure size is capped
+# and the tick labels are thinned
+timeline_lod_threshold = int(os.environ.get('TIMELINE_LOD_THRESHOLD', '40'))
+timeline_max_height = float(os.environ.get('TIMELINE_MAX_HEIGHT', '12'))
+timeline_max_ticks = int(os.environ.get('TIMELINE_MAX_TICKS', '40'))
+# Workbook reader: 'pandas' loads the whole workbook in memory,
+# 'stream' spools it to disk and reads it row by row
+workbook_reader = os.environ.get('WORKBOOK_READER', 'pandas')
+# On-disk patient buckets of the streaming reader, sized to hold about
+# WORKBOOK_BUCKET_ROWS patient and temperature rows each,
+# WORKBOOK_BUCKETS fixes their number instead
+workbook_bucket_rows = int(os.environ.get('WORKBOOK_BUCKET_ROWS', '20000'))
+workbook_buckets = int(os.environ.get('WORKBOOK_BUCKETS', '0'))
+# Number of workbooks of one event processed at once, the plots are
+# drawn with pyplot which is not thread safe, RENDER_WORKERS forks instead
+event_workers = int(os.environ.get('EVENT_WORKERS', '1'))
+# Prefix of the parsed workbook cache in the patient bucket, empty disables,
+# the cache is Parquet only, it is disabled when pyarrow is not installed.
+# The objects hold patient data, a lifecycle rule of the bucket expires them
+workbook_cache_prefix = os.environ.get(
+    'WORKBOOK_CACHE_PREFIX', 'cache/workbooks/')
+# Workbook cache lookups of this (warm) Lambda container
+workbook_cache_stats = {'hit': 0, 'miss': 0}
+# Columns read from each workbook sheet, the organism column of the
+# patient csv is joined from Sheet3
+SHEET_USECOLS = {
+    'Sheet1': schema.usecols(schema.PATIENT_CSV_COLUMN_NAMES),
+    'Sheet2': schema.usecols(schema.TEMPERATURE_COLUMN_NAMES),
+    'Sheet3': schema.usecols(schema.ORGANISM_COLUMN_NAMES),
+}
 
 
-def write_dataframe_to_csv_on_s3(dataframe, filename, bucket):
+class Uploader:
     """
-    Write a dataframe to a CSV on S3
+    Background upload stage for the rendered plots and patient csv files.
+    Finished byte buffers are put to S3 by a bounded thread pool sharing
+    the pooled client of ipac.clients, thus rendering and network I/O
+    overlap.
+    put blocks while max_pending uploads are in flight, this back-pressure
+    keeps the memory held by buffers flat.
     ----------
-    fieldname : dataframe
-        Pandas dataframe
-    fieldname: filename:
+    fieldname : bucket
         string
-    filename: bucket
-        string
-
+    fieldname: workers
+        int, number of upload threads, at most the pool size of the client
+         (CLIENT_MAX_POOL_CONNECTIONS)
+    fieldname: max_pending
+        int, maximum number of buffers queued or being uploaded
     """
-    # Create buffer
-    csv_buffer = StringIO()
 
-    # Write dataframe to buffer
-    dataframe.to_csv(csv_buffer)
+    def __init__(self, bucket, workers=8, max_pending=None):
+        self.bucket = bucket
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._errors = {}
 
-    # Create S3 object
-    s3_resource = boto3.resource("s3")
+    def put(self, key, body, after=()):
+        """
+        Queue an upload, blocks while the pipeline is full.
+        ----------
+        fieldname : key
+            string
+        fieldname: body
+            bytes
+        fieldname: after
+            futures of uploads that have to succeed before this one starts
 
-    # Write buffer to S3 object
-    s3_resource.Object(bucket, filename).put(
-        Body=csv_buffer.getvalue(),
-        ServerSideEncryption="aws:kms",
-    )
+        Returns
+        -------
+        concurrent.futures.Future of the upload, its 'key' and 'sha256'
+         attributes are the key and the hex digest of the body
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._put, key, body, after)
+        except Exception:
+            self._slots.release()
+            raise
+        future.key = key
+        future.sha256 = digest
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(functools.partial(self._done, key))
+        return future
+
+    def _put(self, key, body, after):
+        try:
+            # The uploads this one depends on were submitted earlier, the
+            # executor hands out work in FIFO order, so they are already
+            # running on other threads and waiting here can not deadlock.
+            for dependency in futures_wait(after).done:
+                if dependency.exception() is not None:
+                    raise RuntimeError(
+                        f'{key} not uploaded, a dependency failed')
+            with metrics.span('upload'):
+                storage.write_bytes(self.bucket, key, body)
+        finally:
+            self._slots.release()
+
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors[key] = repr(future.exception())
+
+    def wait(self):
+        """
+        Wait for all queued uploads, raise if any of them failed.
+        """
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            futures_wait(pending)
+        self._executor.shutdown(wait=True)
+        if self._errors:
+            raise RuntimeError('Failed uploads: {}'.format(self._errors))
 
 
 def relative_time_in_days(end_date, start_date):
@@ -65,9 +183,15 @@ def relative_time_in_days(end_date, start_date):
     return difference
 
 
-def plot_timeline(dataframe, patient):
+@metrics.timed('timeline_render')
+def plot_timeline(dataframe, patient, uploader, lod=None):
     """
-    Generate the timeline plot for a patient
+    Generate the timeline plot for a patient,
+    the png is queued on the uploader and its upload future returned.
+    With lod (level of detail) the collections of a day are merged into
+    one marker labelled with their count, the figure height and
+    resolution are capped and the x tick labels are thinned. When lod is
+    None it is switched on above TIMELINE_LOD_THRESHOLD collections.
     Columns
     =======
         ['encntr_num', 'nursing_unit_short_desc',
@@ -110,155 +234,144 @@ def plot_timeline(dataframe, patient):
     - last_activity_end_dt_tm = Catheter removal
     """
     print('Generating timeline plot for {}'.format(patient))
-    # Convert all datetime values to datetime
-    datetime_column_names = [
-        'beg_effective_dt_tm',
-        'end_effective_dt_tm',
-        'collection_dt_tm',
-        'admit_dt_tm',
-        'disch_dt_tm',
-        'first_activity_start_dt_tm',
-        'last_activity_end_dt_tm',
+    # The datetime columns are already converted by normalize_dataframe
+    # Calcululate the relative dates from admission for all records
+    admission = dataframe['admit_dt_tm'].min()
+    day = {
+        key: (dataframe[key] - admission).dt.days.to_numpy()
+        for key in schema.DATETIME_COLUMN_NAMES
+    }
+    date = {
+        key: list(dataframe[key]) for key in schema.DATETIME_COLUMN_NAMES}
+    collection_count = dataframe['collection_dt_tm'].nunique(dropna=False)
+    if lod is None:
+        lod = collection_count > timeline_lod_threshold
+    if lod:
+        collection_count = len(np.unique(day['collection_dt_tm']))
+        fig, axis = plt.subplots(figsize=(
+            12, min(3 + collection_count / 4, timeline_max_height)), dpi=150)
+    else:
+        fig, axis = plt.subplots(figsize=(
+            12, 3 + collection_count / 4), dpi=300)
+    # 3 bar graphs: patient visit, nuring unit, central line
+    bar_graphs = [
+        {
+            'start': 'admit_dt_tm',
+            'stop': 'disch_dt_tm',
+            'y': 0,
+            'color': [0.8, 0.8, 0.8],
+        },
+        {
+            'start': 'beg_effective_dt_tm',
+            'stop': 'end_effective_dt_tm',
+            'y': 1,
+            'color': [0.6, 0.6, 0.6],
+        },
+        {
+            'start': 'first_activity_start_dt_tm',
+            'stop': 'last_activity_end_dt_tm',
+            'y': 2,
+            'color': [0.4, 0.4, 0.4],
+        },
     ]
-    # Convert all date to to datetime format, the input data is mm-dd-yyyy
-    for column_name in datetime_column_names:
-        dataframe[column_name] = pd.to_datetime(
-            dataframe[column_name], errors='coerce', format='%m/%d/%Y')
-    #
-    fig, axis = plt.subplots(figsize=(
-        12, 3 + len(dataframe['collection_dt_tm'].unique()) / 4), dpi=300)
-    collection_times = []
-    plotted_organisms = []
-    x_scale_label = {}
-    y_scale_label = []
-    dates = {}
-    # Generate a list of organisms,
+    # One type of markers for the positive blood collection dates
+    marker_graph = {
+        'start': 'collection_dt_tm',
+        'y': 0,
+    }
+    nursing_units = dataframe['nursing_unit_short_desc'].astype(str)
+    # Generate a color for each organism from its first record,
     # thus same organism found can be shown as the same color
-    unique_organisms = []
-    for index in dataframe.index:
-        organism = dataframe.loc[index, 'organism']
-        unique_organisms.append(organism)
-    # Iterate through all records and add them to the plot
-    for index in dataframe.index:
-        # Organism found for this record
-        organism = dataframe.loc[index, 'organism']
-
-        # Calcululate the relative date from admission
-        day = {
-            key: relative_time_in_days(
-                dataframe.loc[index, key], sorted(dataframe['admit_dt_tm'])[0])
-            for key in datetime_column_names
-        }
-        # 3 bar graph plots: patient visit, nuring unit, central line
-        bar_graphs = {
-            'Patient visit': {
-                'start': 'admit_dt_tm',
-                'stop': 'disch_dt_tm',
-                'y': 0,
-                'color': [0.8, 0.8, 0.8],
-            },
-            dataframe.loc[index, 'nursing_unit_short_desc']: {
-                'start': 'beg_effective_dt_tm',
-                'stop': 'end_effective_dt_tm',
-                'y': 1,
-                'color': [0.6, 0.6, 0.6],
-            },
-            'Central line': {
-                'start': 'first_activity_start_dt_tm',
-                'stop': 'last_activity_end_dt_tm',
-                'y': 2,
-                'color': [0.4, 0.4, 0.4],
-            },
-        }
-        # One type of markers for the positive blood collection dates
-        marker_graphs = {
-            'Blood collection': {
-                'start': 'collection_dt_tm',
-                'y': 0,
-                'color': [0.8, 0.2, 0.2],
-            },
-        }
-        # bar graphs: patient visit, nuring unit, central line
-        for label in bar_graphs:
-            period = (
-                dataframe.loc[index, bar_graphs[label]['start']],
-                dataframe.loc[index, bar_graphs[label]['stop']]
-            )
+    organism_colors = {}
+    for position, organism in enumerate(dataframe['organism']):
+        organism_colors.setdefault(organism, plt.cm.tab10(position))
+    periods = set()
+    bars = [[] for _ in bar_graphs]
+    collection_times = {}
+    x_scale_label = {}
+    y_scale_label = {}
+    # Iterate through all records once, dropping the repeated periods
+    for position, organism in enumerate(dataframe['organism']):
+        labels = (
+            'Patient visit', nursing_units.iat[position], 'Central line')
+        for label, bar_graph, bar in zip(labels, bar_graphs, bars):
+            y_scale_label.setdefault(label)
+            start = bar_graph['start']
+            stop = bar_graph['stop']
             # Do not plot the same period twice
-            if label not in dates:
-                dates[label] = []
-            if period not in dates[label]:
-                # Bar plot for the period
-                axis.bar(
-                    [day[bar_graphs[label]['start']]],
-                    [0.8],
-                    width=day[bar_graphs[label]['stop']] -
-                    day[bar_graphs[label]['start']],
-                    bottom=bar_graphs[label]['y'] + 0.1,
-                    color=bar_graphs[label]['color'],
-                    # edgecolor='w',
-                    # linewidth=4,
-                    align='edge',
-                )
-                # Put marker to the start and stop date, thus if there is
-                # a missing date it can still be seen.
-                axis.plot(
-                    [day[bar_graphs[label]['start']]],
-                    [bar_graphs[label]['y'] + 0.5],
-                    'k>',
-                )
-                axis.plot(
-                    [day[bar_graphs[label]['stop']]],
-                    [bar_graphs[label]['y'] + 0.5],
-                    'k<',
-                )
-                dates[label].append(period)
-                x_scale_label[day[bar_graphs[label]['start']]] = dataframe.loc[
-                    index, bar_graphs[label]['start']]
-                x_scale_label[day[bar_graphs[label]['stop']]] = dataframe.loc[
-                    index, bar_graphs[label]['stop']]
-            if label not in y_scale_label:
-                y_scale_label.append(label)
-        for label in marker_graphs:
-            # Blood collection
-            if float(
-                    day[marker_graphs[
-                        label]['start']]) not in collection_times:
-                if organism not in plotted_organisms:
-                    axis.plot(
-                        [day[marker_graphs[label]['start']]],
-                        [marker_graphs[label]['y'] + 0.5],
-                        marker='o',
-                        markersize=14,
-                        linestyle='',
-                        color=plt.cm.tab10(unique_organisms.index(organism)),
-                        label=organism.replace(', ',"\n"),
-                    )
-                    plotted_organisms.append(organism)
-                else:
-                    axis.plot(
-                        [day[marker_graphs[label]['start']]],
-                        [marker_graphs[label]['y'] + 0.5],
-                        marker='o',
-                        markersize=14,
-                        linestyle='',
-                        color=plt.cm.tab10(unique_organisms.index(organism)),
-                    )
-                axis.plot(
-                    [day[marker_graphs[label]['start']]],
-                    [marker_graphs[label]['y'] + 0.5],
-                    'wo',
-                    markersize=5,
-                    color='0.8'
-                )
-                collection_times.append(
-                    float(day[marker_graphs[label]['start']]))
-                x_scale_label[day[
-                    marker_graphs[label]['start']]] = dataframe.loc[
-                    index, marker_graphs[label]['start']]
-            if label not in dates:
-                dates[label] = []
-            dates[label].append(day[marker_graphs[label]['start']])
+            period = (label, date[start][position], date[stop][position])
+            if period in periods:
+                continue
+            periods.add(period)
+            bar.append((day[start][position], day[stop][position]))
+            x_scale_label[day[start][position]] = date[start][position]
+            x_scale_label[day[stop][position]] = date[stop][position]
+        # Blood collection, one marker per day, counting the collections
+        collection_day = day[marker_graph['start']][position]
+        if collection_day not in collection_times:
+            collection_times[collection_day] = [collection_day, organism, 0]
+            x_scale_label[collection_day] = date[
+                marker_graph['start']][position]
+        collection_times[collection_day][2] += 1
+    # Bar graphs, all periods of a track in a single call
+    for bar_graph, bar in zip(bar_graphs, bars):
+        bar = np.array(bar, dtype=float).reshape(-1, 2)
+        complete = ~np.isnan(bar).any(axis=1)
+        axis.broken_barh(
+            [(start, stop - start) for start, stop in bar[complete]],
+            (bar_graph['y'] + 0.1, 0.8),
+            facecolors=[bar_graph['color']],
+        )
+        # Put marker to the start and stop date, thus if there is
+        # a missing date it can still be seen.
+        axis.plot(
+            bar[:, 0], [bar_graph['y'] + 0.5] * len(bar), 'k>',
+            linestyle='')
+        axis.plot(
+            bar[:, 1], [bar_graph['y'] + 0.5] * len(bar), 'k<',
+            linestyle='')
+    # Blood collection markers, one call per organism
+    organism_days = {}
+    for collection_day, organism, _ in collection_times.values():
+        organism_days.setdefault(organism, []).append(collection_day)
+    for organism, days in organism_days.items():
+        axis.plot(
+            days,
+            [marker_graph['y'] + 0.5] * len(days),
+            marker='o',
+            markersize=14,
+            linestyle='',
+            color=organism_colors[organism],
+            label=str(organism).replace(', ', "\n"),
+        )
+    single_days = [
+        collection_day
+        for collection_day, _, count in collection_times.values()
+        if count == 1 or not lod]
+    axis.plot(
+        single_days,
+        [marker_graph['y'] + 0.5] * len(single_days),
+        marker='o',
+        markersize=5,
+        linestyle='',
+        color='0.8',
+    )
+    # Merged collections show their count instead of the inner marker
+    for collection_day, _, count in collection_times.values():
+        if count > 1 and lod:
+            axis.text(
+                collection_day, marker_graph['y'] + 0.5, str(count),
+                ha='center', va='center', size=7, color='w',
+            )
+    x_scale_label = {
+        key: value for key, value in x_scale_label.items()
+        if not np.isnan(key)}
+    if lod and len(x_scale_label) > timeline_max_ticks:
+        # Keep every step-th tick label in date order,
+        # thus they do not overlap
+        step = -(-len(x_scale_label) // timeline_max_ticks)
+        x_scale_label = dict(sorted(x_scale_label.items())[::step])
+    y_scale_label = list(y_scale_label)
     axis.set_yticks([value + 0.5 for value in range(len(y_scale_label))])
     axis.set_yticklabels(y_scale_label)
     axis.set_ylim(0, len(y_scale_label))
@@ -267,22 +380,18 @@ def plot_timeline(dataframe, patient):
         str(value)[:10] for value in x_scale_label.values()], rotation=90)
     axis.set_xlabel('Date')
     axis.set_axisbelow(True)
-    plt.legend(
+    axis.legend(
         bbox_to_anchor=(1.04, 1), loc='upper left',
         ncol=1, title='Positive blood sample')
-    plt.tight_layout()
+    fig.tight_layout()
     buf = io.BytesIO()
     fig.savefig(buf, format="png")
-    buf.seek(0)
-    image = buf.read()
-    s3_resource = boto3.resource("s3")
+    plt.close(fig)
     # saving the patient total timeline
     # plots to processed/images/patient/timeline.png
     filename = f'images/{patient}/timeline.png'
-    bucket = os.environ['patient_bucket']
     print('Timeline plot path for patient {}: {}'.format(patient, filename))
-    s3_resource.Object(bucket, filename).put(
-        Body=image, ServerSideEncryption="aws:kms")
+    return uploader.put(filename, buf.getvalue())
 
 
 def get_start_end_time(dataframe):
@@ -333,182 +442,198 @@ def estimate_text_size(text):
     return fontsize
 
 
-def generate_iwp_plot(dataframe, temperature, plot_index, patient):
+class IwpRenderer:
     """
-    Generate individual IWP plot for each positive blood collection.
+    Renderer of the Infection Window Period (IWP) plots of one patient.
+    The two axis figure and its static parts (fever limit, axis labels,
+    tick labels) are created once, each collection only updates the data
+    artists. Close the renderer, or use it as a context manager, to
+    release the figure when the patient is done.
+    ----------
+    fieldname : temperature
+        Pandas dataframe, temperature information of the patient
     """
-    dataframe = dataframe.copy()
-    # Convert all datetime values to datetime
-    datetime_column_names = [
-        'beg_effective_dt_tm',
-        'end_effective_dt_tm',
-        'collection_dt_tm',
-        'admit_dt_tm',
-        'disch_dt_tm',
-        'first_activity_start_dt_tm',
-        'last_activity_end_dt_tm',
-    ]
-    # Convert all date to to datetime format, the input data is mm-dd-yyyy
-    for column_name in datetime_column_names:
-        dataframe[column_name] = pd.to_datetime(
-            dataframe[column_name], errors='coerce',
-            # format='%m/%d/%Y',
-        )
-    collection_date = dataframe.loc[plot_index, 'collection_dt_tm']
-    day3 = pd.Timedelta(days=3)
-    fig, axis = plt.subplots(
-        2, 1, True, False,
-        figsize=(7, 7), dpi=150,
-        gridspec_kw={'height_ratios': [1, 2.5]},
-    )
-    # Generate the temperature plot - top portion
-    # Fever limit, above limit the
+    # Fever limit, above limit the marker is red
     temperature_limit = 38.0
-    # Mark the temperature limit (38 C) with a solid line
-    axis[0].plot_date(
-        [collection_date - day3, collection_date + day3],
-        [temperature_limit, temperature_limit],
-        'k-',
-        color='0.4',
-    )
+    normal_color = mcolors.to_rgba('0.4')
+    fever_color = mcolors.to_rgba([0.8, 0.2, 0.2])
 
-    # Plot all temperature information
-
-    for temperature_index in temperature.index:
-        temp_date = temperature.loc[temperature_index, 'event_end_dt_tm']
-        value = temperature.loc[temperature_index, 'result_val']
-        try:
-            # Above limit the marker is red
-            if value < temperature_limit:
-                markercolor = '0.4'
-            else:
-                markercolor = [0.8, 0.2, 0.2]
-            # Plot the dates - temperature information
-            axis[0].plot_date(
-                temp_date, value, 'wo',
-                markeredgecolor=markercolor,
-                markersize=6,
-                markeredgewidth=4,
-            )
-        except ValueError:
-            print('failure in plotting temperature')
-
-    # Plot catheter start and end
-    if not (pd.isnull(dataframe.loc[plot_index, 'first_activity_start_dt_tm'])
-            or pd.isnull(dataframe.loc[
-                plot_index, 'last_activity_end_dt_tm'])):
-        axis[1].plot_date(
-            [dataframe.loc[plot_index, 'first_activity_start_dt_tm'],
-                dataframe.loc[plot_index, 'last_activity_end_dt_tm']],
-            [0.1, 0.1],
-            'k-',
-            color='0.8',
-            linewidth=60,
+    def __init__(self, temperature):
+        self.figure, self.axis = plt.subplots(
+            2, 1, sharex=True, sharey=False,
+            figsize=(7, 7), dpi=150,
+            gridspec_kw={'height_ratios': [1, 2.5]},
         )
-    catheter_information = ' - '.join((
-        str(dataframe.loc[plot_index, 'first_site_result']),
-        str(dataframe.loc[plot_index, 'first_catheter_type_result']),
-    ))
-    axis[1].text(
-        collection_date - pd.Timedelta(days=2),
-        0.09,
-        catheter_information,
-        size=estimate_text_size(catheter_information),
-    )
-    # Plot nursing unit start and end
-    if not (pd.isnull(dataframe.loc[plot_index, 'beg_effective_dt_tm'])
-            or pd.isnull(dataframe.loc[plot_index, 'end_effective_dt_tm'])):
-        axis[1].plot_date(
-            [dataframe.loc[plot_index, 'beg_effective_dt_tm'],
-                dataframe.loc[plot_index, 'end_effective_dt_tm']],
-            [0.3, 0.3],
-            'k-',
-            color='0.8',
-            linewidth=60,
-        )
-    nursing_inforamtion = ' - '.join((
-        str(dataframe.loc[plot_index,
-            'nursing_unit_short_desc_at_collection']),
-        str(dataframe.loc[plot_index,
-            'med_service_desc_src_at_collection']),
-    ))
-    axis[1].text(
-        collection_date - pd.Timedelta(days=2),
-        0.29,
-        nursing_inforamtion,
-        size=estimate_text_size(nursing_inforamtion),
-    )
-    # Helper line for organism and collection dates
-    axis[1].plot_date(
-        [dataframe.loc[plot_index, 'collection_dt_tm'] for _ in range(2)],
-        [0.5, 0.63],
-        'k-',
-        color='0.8',
-    )
-    # Plot all collection dates
-    for index in dataframe.index:
-        axis[1].plot_date(
-            [dataframe.loc[index, 'collection_dt_tm']],
-            [0.5],
-            'ko',
-            color='0.4',
-            markersize=16
+        self._layout_done = False
+        axis = self.axis
+        axis[1].xaxis_date()
+        # Generate the temperature plot - top portion
+        # Mark the temperature limit (38 C) with a solid line
+        axis[0].axhline(self.temperature_limit, color='0.4')
+        # Temperatures are sorted once, each plot draws the readings
+        # inside its window, found by binary search, as one scatter
+        temperature = temperature.dropna(
+            subset=['event_end_dt_tm', 'result_val']).sort_values(
+                'event_end_dt_tm', kind='mergesort')
+        self._temperature_dates = mdates.date2num(
+            temperature['event_end_dt_tm'].to_numpy())
+        self._temperature_values = temperature['result_val'].to_numpy(
+            dtype=float)
+        self._temperature_markers = axis[0].scatter(
+            [], [], s=36, facecolors='w', linewidths=4, zorder=2)
+        # Data artists of the bottom portion, updated for every collection
+        self._catheter_line, = axis[1].plot(
+            [], [], '-', color='0.8', linewidth=60)
+        self._nursing_line, = axis[1].plot(
+            [], [], '-', color='0.8', linewidth=60)
+        # Helper line for organism and collection dates
+        self._helper_line, = axis[1].plot([], [], '-', color='0.8')
+        self._collection_markers, = axis[1].plot(
+            [], [], 'o', color='0.4', markersize=16)
+        self._catheter_text = axis[1].text(0, 0.09, '')
+        self._nursing_text = axis[1].text(0, 0.29, '')
+        self._organism_text = axis[1].text(0, 0.65, '', size=12)
+        # Axis settings
+        axis[0].set_ylabel('Temperature /C')
+        axis[0].set_ylim(35, 41)
+        axis[0].set_yticks(range(35, 42))
+        axis[0].set_yticklabels(
+            ['{}.0'.format(value) for value in range(35, 42)])
+        axis[0].grid(axis='y', linestyle='-')
+        axis[1].set_ylim(0, 0.8)
+        axis[1].set_yticks([0.1, 0.3, 0.5, 0.7])
+        axis[1].set_yticklabels([
+            'Central line',
+            'Nursing unit',
+            'Blood sample',
+            'Organism',
+        ])
+        axis[1].tick_params(axis='x', labelrotation=90)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Release the figure.
+        """
+        plt.close(self.figure)
+
+    def _set_temperature_window(self, start, end):
+        """
+        Show the temperature readings between the start and end date,
+        both included like the axis limits, above the limit the marker
+        is red.
+        """
+        lower = np.searchsorted(self._temperature_dates, start, side='left')
+        upper = np.searchsorted(self._temperature_dates, end, side='right')
+        values = self._temperature_values[lower:upper]
+        self._temperature_markers.set_offsets(np.column_stack(
+            (self._temperature_dates[lower:upper], values)))
+        self._temperature_markers.set_edgecolors(np.where(
+            (values >= self.temperature_limit)[:, np.newaxis],
+            self.fever_color, self.normal_color))
+
+    @staticmethod
+    def _set_period(line, start, end, height):
+        """
+        Show the period as a thick line, or hide it if a date is missing.
+        """
+        if pd.isnull(start) or pd.isnull(end):
+            line.set_data([], [])
+        else:
+            line.set_data(mdates.date2num([start, end]), [height, height])
+
+    @metrics.timed('iwp_render')
+    def render(self, dataframe, plot_index, patient, uploader):
+        """
+        Generate individual IWP plot for a positive blood collection,
+        the png is queued on the uploader and its upload future returned.
+        A collection without date has no window to plot, None is returned.
+        """
+        # The datetime columns are already converted by normalize_dataframe
+        row = dataframe.loc[plot_index]
+        collection_date = row['collection_dt_tm']
+        if pd.isnull(collection_date):
+            print('No collection date for IWP plot {} of patient {}'.format(
+                plot_index, patient))
+            return None
+        day3 = pd.Timedelta(days=3)
+        text_date = mdates.date2num(collection_date - pd.Timedelta(days=2))
+        # Plot catheter start and end
+        self._set_period(
+            self._catheter_line, row['first_activity_start_dt_tm'],
+            row['last_activity_end_dt_tm'], 0.1)
+        catheter_information = ' - '.join((
+            str(row['first_site_result']),
+            str(row['first_catheter_type_result']),
+        ))
+        self._catheter_text.set_position((text_date, 0.09))
+        self._catheter_text.set_text(catheter_information)
+        self._catheter_text.set_fontsize(
+            estimate_text_size(catheter_information))
+        # Plot nursing unit start and end
+        self._set_period(
+            self._nursing_line, row['beg_effective_dt_tm'],
+            row['end_effective_dt_tm'], 0.3)
+        nursing_inforamtion = ' - '.join((
+            str(row['nursing_unit_short_desc_at_collection']),
+            str(row['med_service_desc_src_at_collection']),
+        ))
+        self._nursing_text.set_position((text_date, 0.29))
+        self._nursing_text.set_text(nursing_inforamtion)
+        self._nursing_text.set_fontsize(
+            estimate_text_size(nursing_inforamtion))
+        self._helper_line.set_data(
+            mdates.date2num([collection_date, collection_date]), [0.5, 0.63])
+        # Plot all collection dates
+        collection_dates = dataframe['collection_dt_tm'].dropna()
+        self._collection_markers.set_data(
+            mdates.date2num(collection_dates.to_numpy()),
+            [0.5] * len(collection_dates))
+        # Corresponding organism
+        self._organism_text.set_position((
+            mdates.date2num(collection_date - pd.Timedelta(days=1.2)), 0.65))
+        self._organism_text.set_text(row['organism'])
+        window = (
+            mdates.date2num((collection_date - day3).normalize()),
+            mdates.date2num((collection_date + day3).normalize()),
         )
-    # Corresponding organism
-    organism_information = dataframe.loc[plot_index, 'organism']
-
-    axis[1].text(
-        collection_date - datetime.timedelta(days=1.2),
-        0.65,
-        organism_information,
-        size=12,
-    )
-    # Axis settings
-    axis[0].set_ylabel('Temperature /C')
-    axis[0].set_ylim(35, 41)
-    axis[0].set_yticks(range(35, 42))
-    axis[0].set_yticklabels(['{}.0'.format(value) for value in range(35, 42)])
-    axis[0].grid(axis='y', linestyle='-')
-    collection_date = pd.to_datetime(collection_date)
-    # print((collection_date - day3).date(),(collection_date + day3).date())
-    axis[0].set_xlim(
-        pd.to_datetime(collection_date - day3).date(),
-        pd.to_datetime(collection_date + day3).date())
-    axis[1].set_ylim(0, 0.8)
-    axis[1].set_yticks([0.1, 0.3, 0.5, 0.7])
-    axis[1].set_yticklabels([
-        'Central line',
-        'Nursing unit',
-        'Blood sample',
-        'Organism',
-    ])
-    for label in axis[1].get_xticklabels():
-        label.set_ha('center')
-        label.set_rotation(90)
-    plt.tight_layout()
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png")
-    buf.seek(0)
-    image = buf.read()
-    s3_resource = boto3.resource("s3")
-    # saving the infection window time plots
-    #  to processed/images/patient/IWP/plots_{plot-number}.png
-    # filename = f'images/{patient}/IWP/plots_{plot_index}.png'
-    # Modify filename because ordering plot_index results:
-    #        1, 10, 11, 12, 2, 3 instead of 1, 2, 3, 10, 11, 12
-    filename = 'images/{patient}/IWP/plots_{index}.png'.format(**{
-        'patient': patient,
-        'index': str(plot_index).rjust(2, '0'),
-    })
+        self._set_temperature_window(*window)
+        self.axis[0].set_xlim(*window)
+        # The layout only depends on the static parts, compute it once
+        if not self._layout_done:
+            self.figure.tight_layout()
+            self._layout_done = True
+        buf = io.BytesIO()
+        self.figure.savefig(buf, format="png")
+        # saving the infection window time plots
+        #  to processed/images/patient/IWP/plots_{plot-number}.png
+        # Modify filename because ordering plot_index results:
+        #        1, 10, 11, 12, 2, 3 instead of 1, 2, 3, 10, 11, 12
+        filename = 'images/{patient}/IWP/plots_{index}.png'.format(**{
+            'patient': patient,
+            'index': str(plot_index).rjust(2, '0'),
+        })
+
+        return uploader.put(filename, buf.getvalue())
 
-    bucket = os.environ['patient_bucket']
-    s3_resource.Object(bucket, filename).put(
-        Body=image, ServerSideEncryption="aws:kms")
 
-    return True
+def generate_iwp_plot(dataframe, temperature, plot_index, patient, uploader):
+    """
+    Generate individual IWP plot for one positive blood collection,
+    the png is queued on the uploader and its upload future returned.
+    Use IwpRenderer directly to render all collections of a patient.
+    None is returned for a collection without date.
+    """
+    with IwpRenderer(temperature) as renderer:
+        return renderer.render(dataframe, plot_index, patient, uploader)
 
 
-def preprocess(obj):
+def preprocess(obj, bucket=None, key=None):
 
     '''
     Recieves s3 object from boto3, converts to excell sheet, 
@@ -517,42 +642,723 @@ def preprocess(obj):
     changes the dataframes column names to lower case, 
     and joins organism dataframe with patient dataframe.
 
+    When the bucket and key of the object are given, the parsed sheets
+    are cached, keyed by the bucket, key and ETag of the object,
+    if pyarrow is available. Without obj the ETag is read by a HEAD
+    request, the workbook is only downloaded when it is not cached.
+
     ----------
     fieldname : obj
 
-    fieldname: s3 object
+    fieldname: s3 object, or None to read it from bucket and key
+
+    fieldname: bucket, key
+        strings, location of the s3 object
 
 
     Returns
     -------
     dataframe for patients, dataframe for temperature    
     '''
-    
+    sheets = None
+    cache = bool(workbook_cache_prefix and pyarrow is not None
+                 and bucket and key)
+    if cache:
+        etag = (obj or storage.head_object(bucket, key)).get('ETag')
+        if etag:
+            sheets = load_cached_workbook(
+                workbook_cache_key(bucket, key, etag))
+    if sheets is None:
+        if obj is None:
+            obj = storage.get_object(bucket, key)
+        sheets = read_workbook(obj)
+        # Keyed by the ETag of the content read, the object may have
+        # been replaced since the HEAD request
+        if cache and obj.get('ETag'):
+            store_cached_workbook(
+                workbook_cache_key(bucket, key, obj['ETag']), sheets)
+    elif obj is not None:
+        obj['Body'].close()
+    dataframe_patients = sheets['Sheet1']
+    dataframe_temperature = sheets['Sheet2']
+    dataframe_organism = sheets['Sheet3']
+
+    dataframe_patients = normalize_dataframe(
+        dataframe_patients, schema.DATETIME_COLUMN_NAMES)
+    dataframe_temperature = normalize_dataframe(
+        dataframe_temperature, schema.TEMPERATURE_DATETIME_COLUMN_NAMES)
+    dataframe_organism = normalize_dataframe(dataframe_organism, [])
+    dataframe_patients = join_organisms(dataframe_patients, dataframe_organism)
+
+    return dataframe_patients, dataframe_temperature
+
+
+@metrics.timed('workbook_read')
+def read_workbook(obj):
+    """
+    Parse the three sheets of the workbook, column names are lower cased.
+    ----------
+    fieldname : obj
+        s3 object
+
+    Returns
+    -------
+    dictionary, key: sheet name, value: dataframe
+    """
     data = obj['Body'].read()
-    xls = pd.read_excel(data,None,engine='openpyxl')
-    dataframe_patients = xls['Sheet1']
-    dataframe_temperature = xls['Sheet2']
-    dataframe_organism = xls['Sheet3']
-    dataframe_patients.rename(str.lower, axis='columns',inplace=True)
-    dataframe_temperature.rename(str.lower, axis='columns',inplace=True)
-    dataframe_organism.rename(str.lower, axis='columns', inplace=True)
+    sheets = {}
+    with pd.ExcelFile(io.BytesIO(data), engine='openpyxl') as xls:
+        for sheet_name, used in SHEET_USECOLS.items():
+            sheets[sheet_name] = xls.parse(
+                sheet_name,
+                usecols=lambda name: used(str(name).lower())).rename(
+                    str.lower, axis='columns')
+    return sheets
+
+
+def workbook_cache_key(bucket, key, etag):
+    """
+    Cache location of a parsed workbook, the ETag changes
+    whenever the workbook object is overwritten.
+    """
+    digest = hashlib.sha256(
+        '/'.join((bucket, key, etag.strip('"'))).encode('utf-8')).hexdigest()
+    return f'{workbook_cache_prefix}{digest}'
+
+
+@metrics.timed('workbook_cache_load')
+def load_cached_workbook(cache_key):
+    """
+    Load the sheets of a cached workbook.
+
+    Returns
+    -------
+    dictionary, key: sheet name, value: dataframe,
+     None if the workbook is not cached
+    """
+    sheets = {}
+    for sheet_name in ('Sheet1', 'Sheet2', 'Sheet3'):
+        body = storage.read_bytes(
+            patient_processed, f'{cache_key}/{sheet_name}.parquet',
+            missing_ok=True)
+        if body is None:
+            workbook_cache_stats['miss'] += 1
+            print('Workbook cache miss {}, hits: {hit}, misses: {miss}'
+                  .format(cache_key, **workbook_cache_stats))
+            return None
+        sheets[sheet_name] = pd.read_parquet(io.BytesIO(body))
+    workbook_cache_stats['hit'] += 1
+    print('Workbook cache hit {}, hits: {hit}, misses: {miss}'
+          .format(cache_key, **workbook_cache_stats))
+    return sheets
+
+
+@metrics.timed('workbook_cache_store')
+def store_cached_workbook(cache_key, sheets):
+    """
+    Save the parsed sheets as Parquet files, a failure only skips caching.
+    Every sheet is converted before any is written, a workbook pyarrow
+    can not convert, e.g. a column mixing text and numbers, is not cached.
+    """
+    bodies = {}
+    for sheet_name, dataframe in sheets.items():
+        buf = io.BytesIO()
+        try:
+            dataframe.to_parquet(buf, index=False)
+        except (pyarrow.ArrowException, ValueError, TypeError) as error:
+            print('Workbook cache not written, sheet {}: {!r}'.format(
+                sheet_name, error))
+            return
+        bodies[sheet_name] = buf.getvalue()
+    for sheet_name, body in bodies.items():
+        try:
+            storage.write_bytes(
+                patient_processed, f'{cache_key}/{sheet_name}.parquet', body)
+        except ClientError as error:
+            print('Workbook cache not written: {!r}'.format(error))
+            return
+
+
+def iter_sheet_rows(workbook, sheet_name, column_names=None):
+    """
+    Read a sheet of a read-only openpyxl workbook row by row.
+    Column names are lower cased, unnamed columns are named like
+    pandas does ('unnamed: 0').
+    ----------
+    fieldname : workbook
+        openpyxl workbook opened in read-only mode
+    fieldname: sheet_name
+        string
+    fieldname: column_names
+        list of the columns to keep, a function selecting the columns
+         in the sheet order, e.g. schema.usecols, None keeps all of them
+
+    Returns
+    -------
+    column names, generator of the row tuples
+    """
+    rows = workbook[sheet_name].iter_rows(values_only=True)
+    header = list(next(rows, ()))
+    # Formatted but empty cells extend the header with trailing blanks
+    while header and header[-1] is None:
+        header.pop()
+    header = [
+        f'unnamed: {index}' if name is None else str(name).lower()
+        for index, name in enumerate(header)
+    ]
+    if column_names is None:
+        column_names = header
+    elif callable(column_names):
+        column_names = [name for name in header if column_names(name)]
+    positions = [header.index(name) for name in column_names]
+
+    def generator():
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            row = row[:len(header)] + (None,) * (len(header) - len(row))
+            yield tuple(row[position] for position in positions)
+    return column_names, generator()
+
+
+def spool_workbook(obj, directory, buckets=None):
+    """
+    Stream the workbook of an s3 object to disk and split the patient
+    and temperature sheets into buckets of patients, thus at most one
+    bucket of rows is held in memory at a time.
+    The S3 body is copied to a temporary file in chunks and read in
+    openpyxl read-only mode, every sheet is projected to the columns
+    used by the later stages (SHEET_USECOLS).
+    The memory is bounded by the rows of a bucket, about the workbook
+    rows divided by the number of buckets, not by the largest patient:
+    all rows of a patient are in one bucket. More buckets hold fewer
+    rows, but each bucket is loaded and parsed on its own, which costs
+    time on small workbooks, so the number is sized from the rows.
+    ----------
+    fieldname : obj
+        s3 object
+    fieldname: directory
+        string, temporary directory for the spool files
+    fieldname: buckets
+        int, number of patient buckets, default: see bucket_count
+
+    Returns
+    -------
+    dictionary describing the spool, input of iter_spooled_partitions
+    """
+    workbook_path = os.path.join(directory, 'workbook.xlsx')
+    with open(workbook_path, 'wb') as workbook_file:
+        shutil.copyfileobj(obj['Body'], workbook_file, 1024 * 1024)
+    workbook = openpyxl.load_workbook(
+        workbook_path, read_only=True, data_only=True)
+    try:
+        if not buckets:
+            buckets = bucket_count(
+                [workbook['Sheet1'].max_row, workbook['Sheet2'].max_row])
+        spool = {'directory': directory, 'buckets': buckets, 'columns': {},
+                 'written': set()}
+        column_names, rows = iter_sheet_rows(
+            workbook, 'Sheet3', SHEET_USECOLS['Sheet3'])
+        spool['organism'] = normalize_dataframe(
+            pd.DataFrame(list(rows), columns=column_names), [])
+        for sheet_name, name in (
+                ('Sheet1', 'patients'), ('Sheet2', 'temperature')):
+            column_names, rows = iter_sheet_rows(
+                workbook, sheet_name, SHEET_USECOLS[sheet_name])
+            spool['columns'][name] = column_names
+            written = _spool_rows(
+                rows, column_names.index('mrn'),
+                os.path.join(directory, name), buckets)
+            if name == 'patients':
+                spool['written'] = written
+    finally:
+        workbook.close()
+        os.remove(workbook_path)
+    return spool
+
+
+def bucket_count(sheet_rows, workers=None):
+    """
+    Number of patient buckets of a spooled workbook, each holding about
+    WORKBOOK_BUCKET_ROWS rows, and at least one per render worker,
+    which read separate buckets. WORKBOOK_BUCKETS overrides it.
+    ----------
+    fieldname : sheet_rows
+        list of the row counts of the spooled sheets, None when a sheet
+         does not record its dimension
+    fieldname: workers
+        int, number of render workers, default: RENDER_WORKERS
+
+    Returns
+    -------
+    int
+    """
+    if workbook_buckets:
+        return workbook_buckets
+    if workers is None:
+        workers = render_workers
+    if any(rows is None for rows in sheet_rows):
+        # Unsized sheet, assume a large workbook
+        return max(64, workers)
+    return max(-(-sum(sheet_rows) // workbook_bucket_rows), workers, 1)
+
+
+def _spool_rows(rows, mrn_position, prefix, buckets, batch_size=1000):
+    """
+    Append the rows to bucket files by the hash of their mrn,
+    rows are pickled in batches.
+
+    Returns
+    -------
+    set of the buckets written
+    """
+    batches = [[] for _ in range(buckets)]
+    written = set()
+
+    def flush(bucket):
+        with open(f'{prefix}-{bucket}.pickle', 'ab') as bucket_file:
+            pickle.dump(batches[bucket], bucket_file)
+        batches[bucket] = []
+        written.add(bucket)
+
+    for row in rows:
+        bucket = hash(row[mrn_position]) % buckets
+        batches[bucket].append(row)
+        if len(batches[bucket]) >= batch_size:
+            flush(bucket)
+    for bucket in range(buckets):
+        if batches[bucket]:
+            flush(bucket)
+    return written
+
+
+def _load_bucket(spool, name, bucket):
+    """
+    Load one bucket of a spooled sheet as a dataframe.
+    """
+    rows = []
+    try:
+        with open(f'{spool["directory"]}/{name}-{bucket}.pickle',
+                  'rb') as bucket_file:
+            while True:
+                rows.extend(pickle.load(bucket_file))
+    except (FileNotFoundError, EOFError):
+        pass
+    dataframe = pd.DataFrame(rows, columns=spool['columns'][name])
+    # Empty cells are None, the pandas excel reader gives NaN
+    for column_name in dataframe.select_dtypes(include='object').columns:
+        dataframe[column_name] = dataframe[column_name].where(
+            dataframe[column_name].notna(), np.nan)
+    return dataframe
+
+
+def iter_spooled_partitions(spool, worker_index=0, workers=1):
+    """
+    Lazily yield the per patient dataframes of a spooled workbook,
+    one bucket of patients is loaded at a time.
+    ----------
+    fieldname : spool
+        dictionary returned by spool_workbook
+    fieldname: worker_index, workers
+        int, only every workers-th bucket starting
+         from worker_index is read
+
+    Returns
+    -------
+    generator of (patient, data, temperature), like partition_patients
+    """
+    for bucket in range(worker_index, spool['buckets'], workers):
+        # Buckets without patients are not loaded
+        if bucket not in spool['written']:
+            continue
+        dataframe_patients = _load_bucket(spool, 'patients', bucket)
+        if dataframe_patients.empty:
+            continue
+        dataframe_temperature = _load_bucket(spool, 'temperature', bucket)
+        dataframe_patients = normalize_dataframe(
+            dataframe_patients, schema.DATETIME_COLUMN_NAMES)
+        dataframe_temperature = normalize_dataframe(
+            dataframe_temperature, schema.TEMPERATURE_DATETIME_COLUMN_NAMES)
+        dataframe_patients = join_organisms(
+            dataframe_patients, spool['organism'])
+        yield from partition_patients(
+            *sort_sheets(dataframe_patients, dataframe_temperature))
+
+
+def normalize_dataframe(dataframe, datetime_column_names):
+    """
+    Give the columns of a sheet their compact dtypes, once per workbook:
+    categorical text, downcast integers and datetime64 (see ipac.schema).
+    Columns already typed by the excel reader are left untouched,
+    text columns are parsed, unparsable values become NaT.
+    ----------
+    fieldname : dataframe
+        Pandas dataframe
+    fieldname: datetime_column_names
+        list of column names
+
+    Returns
+    -------
+    dataframe with typed columns
+    """
+    return schema.apply_schema(dataframe, datetime_column_names)
+
+
+def join_organisms(dataframe_patients, dataframe_organism):
+    """
+    Add the organism column to the patient dataframe.
+    All organisms found for an encounter are aggregated once per
+    (mrn, encntr_num) and joined back onto the patient rows.
+    ----------
+    fieldname : dataframe_patients
+        Pandas dataframe, Sheet1
+    fieldname: dataframe_organism
+        Pandas dataframe, Sheet3
+
+    Returns
+    -------
+    dataframe for patients with the organism column,
+     encounters without organism rows get an empty string
+    """
+    organisms = dataframe_organism.groupby(
+        ['mrn', 'encntr_num'], sort=False)['organism_desc_src'].agg(
+            lambda values: ",\n".join(values.dropna().astype(str).unique()))
+    organisms.name = 'organism'
+    dataframe_patients = dataframe_patients.drop(
+        columns='organism', errors='ignore').join(
+            organisms, on=['mrn', 'encntr_num'])
+    dataframe_patients['organism'] = dataframe_patients[
+        'organism'].fillna('')
+    return dataframe_patients
     
-    dataframe_organism.set_index(['mrn','encntr_num'], inplace=True)
 
-    for i in dataframe_patients.index:
-        mrn = dataframe_patients.loc[i,'mrn']
-        enct_num = dataframe_patients.loc[i, 'encntr_num']
-        dataframe_patients.loc[i, 'organism'] = ",\n".join(dataframe_organism.loc[(mrn,enct_num),'organism_desc_src'].unique())
-        
+def sort_sheets(dataframe_patients, dataframe_temperature):
+    """
+    Sort both sheets once by mrn and collection date, thus the rows of
+    each patient are a contiguous block for partition_patients.
+    ----------
+    fieldname : dataframe_patients
+        Pandas dataframe
+    fieldname: dataframe_temperature
+        Pandas dataframe
+
+    Returns
+    -------
+    sorted dataframe for patients, sorted dataframe for temperature
+    """
+    dataframe_patients = dataframe_patients.sort_values(
+        ['mrn', 'collection_dt_tm'], kind='mergesort').reset_index(drop=True)
+    dataframe_temperature = dataframe_temperature.sort_values(
+        ['mrn', 'collection_dt_tm'], kind='mergesort').reset_index(drop=True)
     return dataframe_patients, dataframe_temperature
-    
 
+
+def partition_patients(dataframe_patients, dataframe_temperature,
+                       worker_index=0, workers=1):
+    """
+    Lazily split the sorted sheets into per patient dataframes.
+    The block of each patient is found by the mrn boundaries,
+    so the work per patient is proportional to that patient's rows.
+    ----------
+    fieldname : dataframe_patients
+        Pandas dataframe, sorted by sort_sheets
+    fieldname: dataframe_temperature
+        Pandas dataframe, sorted by sort_sheets
+    fieldname: worker_index, workers
+        int, only every workers-th patient starting
+         from worker_index is yielded
+
+    Returns
+    -------
+    generator of (patient, data, temperature), rows of every patient
+     sorted by collection date and indexed from 0
+    """
+    patient_mrns = dataframe_patients['mrn'].to_numpy()
+    temperature_mrns = dataframe_temperature['mrn'].to_numpy()
+    starts = np.flatnonzero(
+        np.concatenate(([True], patient_mrns[1:] != patient_mrns[:-1])))
+    stops = np.append(starts[1:], len(patient_mrns))
+    for start, stop in list(zip(starts, stops))[worker_index::workers]:
+        patient = patient_mrns[start]
+        data = dataframe_patients.iloc[start:stop].reset_index(drop=True)
+        temperature = dataframe_temperature.iloc[
+            np.searchsorted(temperature_mrns, patient, side='left'):
+            np.searchsorted(temperature_mrns, patient, side='right')
+        ].reset_index(drop=True)
+        yield patient, data, temperature
+
+
+def plot_index_document(patient, timeline, iwp_plots, labels, bucket):
+    """
+    Plot index of a patient, see ipac.schema.PLOT_INDEX_KEY.
+    ----------
+    fieldname : timeline, iwp_plots
+        Uploader futures of the timeline plot and of the IWP plots,
+         one per row of the patient data, None for a row without plot
+    fieldname: labels
+        collection labels of the rows (ipac.schema.collection_labels)
+    fieldname: bucket
+        string, bucket of the plots
+
+    Returns
+    -------
+    dictionary
+    """
+    def entry(upload):
+        return {'uri': f's3://{bucket}/{upload.key}', 'sha256': upload.sha256}
+
+    # Like the manifest table, a later row replaces a repeated label
+    return {
+        'mrn': str(patient),
+        'timeline': entry(timeline),
+        'iwp_plots': {
+            label: entry(upload) for label, upload in zip(labels, iwp_plots)
+            if upload is not None},
+    }
+
+
+def process_patient(patient, data, temperature, uploader):
+    """
+    Generate the timeline plot and the IWP plots of one patient,
+    then write the plot index (ipac.schema.PLOT_INDEX_KEY) and the
+    patient csv that triggers job creation.
+    The csv carries only the columns of the later stages
+    (ipac.schema.PATIENT_CSV_COLUMN_NAMES).
+    The csv upload starts only after all plots and the index are uploaded.
+
+    Returns
+    -------
+    concurrent.futures.Future of the csv upload
+    """
+    # Generate timeline plot
+    timeline = plot_timeline(data, patient, uploader)
+    # Generate IWP plots, one per each collection date
+    with IwpRenderer(temperature) as renderer:
+        iwp_plots = [
+            renderer.render(data, plot_index, patient, uploader)
+            for plot_index in data.index]
+    plots = [timeline] + [plot for plot in iwp_plots if plot is not None]
+    # Index the plots by the collection labels of the manifest table,
+    # job_creation reads it instead of listing the plots
+    index = plot_index_document(
+        patient, timeline, iwp_plots,
+        schema.collection_labels(data['collection_dt_tm']), uploader.bucket)
+    index_upload = uploader.put(
+        schema.PLOT_INDEX_KEY.format(mrn=patient),
+        json.dumps(index).encode('utf-8'), after=tuple(plots))
+    # Generate the CSV file to trigger job creation
+    with metrics.span('patient_csv'):
+        body = schema.project(data, schema.PATIENT_CSV_COLUMN_NAMES).to_csv(
+            index=False).encode('utf-8')
+    return uploader.put(
+        f'{os.environ["patient_folder"]}/{patient}.csv', body,
+        after=plots + [index_upload])
+
+
+def process_partitions(partitions, worker_index=0, workers=1):
+    """
+    Process every patient of a partition, a failing patient
+    does not stop the others. Returns after all uploads finished.
+    ----------
+    fieldname : partitions
+        callable (worker_index, workers) returning
+         a generator of (patient, data, temperature)
+
+    Returns
+    -------
+    dictionary of failed patients, key: mrn, value: error message
+    """
+    failures = {}
+    uploads = {}
+    uploader = Uploader(patient_processed, upload_workers)
+    patients = partitions(worker_index, workers)
+    try:
+        while True:
+            # The partitions are split lazily, measured per patient
+            with metrics.span('partition'):
+                partition = next(patients, None)
+            if partition is None:
+                break
+            patient, data, temperature = partition
+            try:
+                uploads[str(patient)] = process_patient(
+                    patient, data, temperature, uploader)
+            except Exception as error:
+                print('Processing patient {} failed: {!r}'.format(
+                    patient, error))
+                failures[str(patient)] = repr(error)
+    finally:
+        try:
+            uploader.wait()
+        except RuntimeError as error:
+            print(error)
+    for patient, upload in uploads.items():
+        if upload.exception() is not None:
+            failures[patient] = repr(upload.exception())
+    return failures
+
+
+def _process_worker(partitions, worker_index, workers, connection):
+    """
+    Worker process entry point, sends the failures and
+    the metrics of the worker back to the parent.
+    """
+    # The forked process starts with its own copy of the pyplot state
+    plt.close('all')
+    try:
+        with profiling.capture(f'worker-{worker_index}'):
+            failures = process_partitions(
+                partitions, worker_index, workers)
+    except Exception as error:
+        failures = {f'worker-{worker_index}': repr(error)}
+    connection.send((failures, metrics.snapshot()))
+    connection.close()
+
+
+def process_patients(partitions, workers=1):
+    """
+    Process all patients, either serially or spread over a pool of
+    worker processes, each worker takes every workers-th patient.
+    Processes are forked and report through pipes, because AWS Lambda
+    does not provide the shared memory multiprocessing.Pool relies on.
+    ----------
+    fieldname : partitions
+        callable (worker_index, workers) returning
+         a generator of (patient, data, temperature)
+    fieldname: workers
+        int, number of worker processes, 1 processes serially
+
+    Returns
+    -------
+    dictionary of failed patients, key: mrn, value: error message
+    """
+    if workers <= 1:
+        return process_partitions(partitions)
+    context = multiprocessing.get_context('fork')
+    pool = []
+    for worker_index in range(workers):
+        parent_connection, child_connection = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_process_worker,
+            args=(partitions, worker_index, workers, child_connection),
+        )
+        process.start()
+        child_connection.close()
+        pool.append((worker_index, process, parent_connection))
+    failures = {}
+    for worker_index, process, connection in pool:
+        try:
+            worker_failures, worker_metrics = connection.recv()
+            failures.update(worker_failures)
+            metrics.merge(worker_metrics)
+        except EOFError:
+            failures[f'worker-{worker_index}'] = \
+                'worker exited without reporting'
+        process.join()
+    return failures
+
+
+def select_patients(partitions, patients, worker_index=0, workers=1):
+    """
+    Partitions of the selected patients only, e.g. the failed patients
+    of an earlier invocation.
+    ----------
+    fieldname : partitions
+        callable (worker_index, workers) returning
+         a generator of (patient, data, temperature)
+    fieldname: patients
+        list of mrns, None selects every patient
+
+    Returns
+    -------
+    generator of (patient, data, temperature)
+    """
+    if patients is not None:
+        patients = {str(patient) for patient in patients}
+    for partition in partitions(worker_index, workers):
+        if patients is None or str(partition[0]) in patients:
+            yield partition
+
+
+def patient_retry_record(record, failures):
+    """
+    Event record replaying only the failed patients of a record,
+    the other patients are not written again.
+    A worker that failed as a whole did not report its patients,
+    then the record is replayed as it is.
+    ----------
+    fieldname : record
+        one element of event['Records']
+    fieldname: failures
+        dictionary of failed patients, see process_patients
+
+    Returns
+    -------
+    event record
+    """
+    if any(patient.startswith('worker-') for patient in failures):
+        return record
+    return dict(record, patients=sorted(failures))
+
+
+def process_workbook_record(record):
+    """
+    Process the workbook of one S3 event record, see lambda_handler.
+    A record with a 'patients' list processes only these mrns,
+    see patient_retry_record.
+    ----------
+    fieldname : record
+        one element of event['Records']
+
+    Returns
+    -------
+    dictionary, 'failed_patients': key: mrn, value: error message.
+     A failed patient does not fail the record, thus the patients
+     already written are not written again when the record is retried
+    """
+    bucket, key = events.s3_location(record)
+    if workbook_reader == 'stream':
+        with tempfile.TemporaryDirectory() as directory:
+            with metrics.span('workbook_parse'):
+                spool = spool_workbook(
+                    storage.get_object(bucket, key), directory)
+            failures = process_patients(
+                functools.partial(
+                    select_patients,
+                    functools.partial(iter_spooled_partitions, spool),
+                    record.get('patients')),
+                render_workers,
+            )
+    else:
+        with metrics.span('workbook_parse'):
+            # The workbook is downloaded only when it is not cached
+            dataframe_patients, dataframe_temperature = sort_sheets(
+                *preprocess(None, bucket, key))
+        failures = process_patients(
+            functools.partial(
+                select_patients,
+                functools.partial(
+                    partition_patients,
+                    dataframe_patients, dataframe_temperature),
+                record.get('patients')),
+            render_workers,
+        )
+    if failures:
+        print('Failed patients:', failures)
+        metrics.count('Patients.failed', len(failures))
+    return {'failed_patients': failures}
+
+
+@profiling.profile('preprocess')
+@metrics.instrument('preprocess')
 def lambda_handler(event, context):
     '''
     Recieves event, by getting triggered with
     the upload of the excell file from storage gateway
     sends individual patient file and
     uploads to source-csv and patient plots to the clabsi bucket .
+    Every record of the event is processed, a failing workbook
+    does not stop the others.
 
     ----------
     fieldname : Event
@@ -572,43 +1378,24 @@ def lambda_handler(event, context):
 
     Returns
     -------
-        Sagemaker labeling job status description
+        statusCode and the per record summary of ipac.events.dispatch,
+         the stage metrics are printed as one line (ipac.metrics).
+        The failed patients are listed in the result of their record,
+         the 'retry' event of the summary replays only these patients,
+         it is re-driven by ipac.events.redrive
     '''
     print(context)
-    s3_client = boto3.client('s3')
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    obj = s3_client.get_object(Bucket=bucket, Key=key)
-    dataframe_patients, dataframe_temperature = preprocess(obj)
-    try:
-        for patient in dataframe_patients['mrn'].unique():
-
-            data = dataframe_patients[dataframe_patients['mrn']
-                                      == patient].copy()
-            data.sort_values(
-                ['collection_dt_tm'], inplace=True, ascending=True)
-            data.reset_index(inplace=True)
-            data.drop('index', axis=1, inplace=True)
-
-            temperature = dataframe_temperature[
-                dataframe_temperature['mrn'] == patient].copy()
-            temperature.sort_values(
-                ['collection_dt_tm'], inplace=True, ascending=True)
-            temperature.reset_index(inplace=True)
-            temperature.drop('index', axis=1, inplace=True)
-            # Generate timeline plot
-            plot_timeline(data, patient)
-            # Generate IWP plots, one per each collection date
-            for plot_index in data.index:
-                generate_iwp_plot(data, temperature, plot_index, patient)
-            # Generate the CSV file to trigger job creation
-            write_dataframe_to_csv_on_s3(
-                data,
-                f'{os.environ["patient_folder"]}/{patient}.csv',
-                patient_processed)
-    except Exception as error:
-        print(error)
-        raise error
+    summary = events.dispatch(
+        event, process_workbook_record, workers=event_workers)
+    for record, result in zip(event.get('Records', []), summary['records']):
+        failures = (result.get('result') or {}).get('failed_patients')
+        if failures:
+            summary['retry']['Records'].append(
+                patient_retry_record(record, failures))
+    if summary['retry']['Records']:
+        print('Failed patients, replay with: {}'.format(
+            json.dumps(summary['retry'])))
+    events.redrive(event, summary, context)
     return {
         'statusCode': 200,
-        'body': json.dumps('Hello from Lambda!')}
+        'body': json.dumps(summary)}
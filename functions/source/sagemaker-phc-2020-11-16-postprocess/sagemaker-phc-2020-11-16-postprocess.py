@@ -1,13 +1,16 @@
 import json
-import boto3
 from urllib.parse import urlparse
+from ipac import backends
+from ipac import metrics
+from ipac import profiling
 
+@profiling.profile('postprocess')
+@metrics.instrument('postprocess')
 def lambda_handler(event, context):
     consolidated_labels = []
 
     parsed_url = urlparse(event['payload']['s3Uri']);
-    s3 = boto3.client('s3')
-    textFile = s3.get_object(Bucket = parsed_url.netloc, Key = parsed_url.path[1:])
+    textFile = backends.get_backend().get_object(parsed_url.netloc, parsed_url.path[1:])
     filecont = textFile['Body'].read()
     annotations = json.loads(filecont);
     
@@ -0,0 +1,80 @@
+"""
+Shared fixtures of the IPAC-CLABSI tests.
+
+The lambda functions are single directory packages, their directories
+and the ipac layer are put on sys.path as they are in the Lambda runtime,
+and the synthetic workbooks come from tools/benchmarks.
+"""
+import os
+import sys
+import types
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, 'functions', 'source')
+for directory in ('ipaclayer/python', 'preprocess', 'job-creation', 'loop'):
+    sys.path.insert(0, os.path.join(SOURCE, directory))
+sys.path.insert(0, os.path.join(ROOT, 'tools', 'benchmarks'))
+
+from ipac import backends  # noqa: E402
+from ipac import clients  # noqa: E402
+import workbook_generator  # noqa: E402
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    """
+    Storage of the test in a temporary directory (ipac.backends.LocalBackend).
+    """
+    backend = backends.LocalBackend(str(tmp_path))
+    previous = backends._backend
+    backends.set_backend(backend)
+    yield backend
+    backends.set_backend(previous)
+
+
+class RecordingLambda:
+    """
+    Stand-in lambda client, the invokes are recorded.
+    """
+
+    def __init__(self):
+        self.invokes = []
+
+    def invoke(self, **kwargs):
+        self.invokes.append(kwargs)
+        return {'StatusCode': 202}
+
+
+@pytest.fixture
+def lambda_context(monkeypatch):
+    """
+    Lambda context of an invocation, the asynchronous invokes of the
+    function (ipac.events.redrive) are recorded in context.invokes.
+    """
+    client = RecordingLambda()
+    monkeypatch.setitem(clients._clients, 'lambda', client)
+    return types.SimpleNamespace(
+        invoked_function_arn='arn:aws:lambda:ca-central-1:1:function:ipac',
+        invokes=client.invokes)
+
+
+@pytest.fixture
+def workbook_event(local_backend, tmp_path):
+    """
+    S3 event of a synthetic workbook of 3 patients with 2 collections
+    each, stored in the 'landing' bucket.
+
+    Returns
+    -------
+    event, sheets of the workbook
+    """
+    sheets = workbook_generator.generate_workbook(
+        3, collections=2, temperatures=20)
+    path = tmp_path / 'workbook.xlsx'
+    workbook_generator.write_workbook(sheets, str(path))
+    key = 'ipac-clabsi/workbook.xlsx'
+    local_backend.put_object('landing', key, path.read_bytes())
+    event = {'Records': [{'s3': {
+        'bucket': {'name': 'landing'}, 'object': {'key': key}}}]}
+    return event, sheets
@@ -0,0 +1,43 @@
+"""
+Tests of the storage backends, ipac.backends.
+"""
+import hashlib
+import pytest
+from ipac import backends
+from ipac import storage
+
+
+def test_local_backend_round_trip(local_backend):
+    body = b'mrn,organism\n1,E. coli\n'
+    local_backend.put_object('processing', 'source-csv/1.csv', body)
+    local_backend.put_object('processing', 'images/1/timeline.png', b'png')
+    obj = local_backend.get_object('processing', 'source-csv/1.csv')
+    with obj['Body'] as stream:
+        assert stream.read() == body
+    assert obj['ETag'] == '"{}"'.format(hashlib.md5(body).hexdigest())
+    assert obj['ContentLength'] == len(body)
+    assert list(local_backend.list_keys('processing')) == [
+        'images/1/timeline.png', 'source-csv/1.csv']
+    assert list(local_backend.list_keys('processing', 'source-csv/')) == [
+        'source-csv/1.csv']
+    # A replaced object leaves no temporary file behind
+    local_backend.put_object('processing', 'source-csv/1.csv', 'replaced')
+    assert list(local_backend.list_keys('processing', 'source-csv/')) == [
+        'source-csv/1.csv']
+    assert storage.read_bytes('processing', 'source-csv/1.csv') == \
+        b'replaced'
+
+
+def test_local_backend_missing_objects(local_backend):
+    with pytest.raises(backends.NoSuchKey):
+        local_backend.get_object('processing', 'source-csv/1.csv')
+    assert storage.read_bytes(
+        'processing', 'source-csv/1.csv', missing_ok=True) is None
+    with pytest.raises(ValueError):
+        local_backend.put_object('processing', '../landing/workbook', b'')
+
+
+def test_storage_uses_the_backend(local_backend):
+    storage.write_json('processing', 'manifests/1.json', {'mrn': 1})
+    assert storage.read_json('processing', 'manifests/1.json') == {'mrn': 1}
+    assert list(storage.list_keys('processing')) == ['manifests/1.json']
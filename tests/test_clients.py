@@ -0,0 +1,27 @@
+"""
+Tests of the pooled AWS clients, ipac.clients.
+"""
+import os
+from ipac import clients
+
+
+def test_clients_are_reset_after_fork():
+    """
+    A forked process does not share the connection pools of its parent.
+    """
+    client = object()
+    clients._clients['s3'] = client
+    try:
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            os.write(write, b'shared' if clients._clients else b'reset')
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read, 'rb') as reader:
+            assert reader.read() == b'reset'
+        os.waitpid(pid, 0)
+        assert clients.get_client('s3') is client
+    finally:
+        clients.reset()
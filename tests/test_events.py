@@ -0,0 +1,107 @@
+"""
+Tests of ipac.events.dispatch.
+"""
+import json
+import pytest
+from ipac import events
+
+
+def record(key):
+    return {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}}}
+
+
+def handle(record):
+    bucket, key = events.s3_location(record)
+    if key.startswith('bad'):
+        raise RuntimeError(f'{key} failed')
+    return key.upper()
+
+
+def test_s3_location_decodes_the_key():
+    assert events.s3_location(record('source-csv/a+b%3D.csv')) == (
+        'bucket', 'source-csv/a b=.csv')
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_every_record_is_processed(workers):
+    event = {'Records': [record('a'), record('b'), record('c')]}
+    summary = events.dispatch(event, handle, workers=workers)
+    assert summary['succeeded'] == 3
+    assert summary['failed'] == 0
+    assert [result['result'] for result in summary['records']] == \
+        ['A', 'B', 'C']
+    assert summary['retry'] == {'Records': []}
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_partial_failure_returns_after_every_record(workers):
+    handled = []
+
+    def handle_and_track(record):
+        handled.append(events.s3_location(record)[1])
+        return handle(record)
+
+    event = {'Records': [record('a'), record('bad-1'), record('b'),
+                         record('bad-2')]}
+    summary = events.dispatch(event, handle_and_track, workers=workers)
+    assert sorted(handled) == ['a', 'b', 'bad-1', 'bad-2']
+    assert summary['succeeded'] == summary['failed'] == 2
+    assert summary['retry'] == {'Records': [record('bad-1'),
+                                            record('bad-2')]}
+
+
+def test_partial_failure_summary():
+    event = {'Records': [record('a'), record('bad'), record('b')]}
+    summary = events.dispatch(event, handle)
+    assert summary['succeeded'] == 2
+    assert summary['failed'] == 1
+    assert [result['status'] for result in summary['records']] == \
+        ['succeeded', 'failed', 'succeeded']
+    assert "RuntimeError('bad failed')" == summary['records'][1]['error']
+    assert summary['retry'] == {'Records': [record('bad')]}
+
+
+def test_raise_on_failure():
+    with pytest.raises(RuntimeError, match='bad failed'):
+        events.dispatch({'Records': [record('a'), record('bad')]}, handle,
+                        raise_on_failure=True)
+
+
+def test_redrive_invokes_the_failed_records(lambda_context):
+    event = {'Records': [record('a'), record('bad')]}
+    summary = events.redrive(
+        event, events.dispatch(event, handle), lambda_context)
+    assert summary['redrive'] == 1
+    invoke, = lambda_context.invokes
+    assert invoke['FunctionName'] == lambda_context.invoked_function_arn
+    assert invoke['InvocationType'] == 'Event'
+    assert json.loads(invoke['Payload']) == {
+        'Records': [record('bad')], 'redrive': 1}
+
+
+def test_redrive_without_failures(lambda_context):
+    event = {'Records': [record('a')]}
+    summary = events.redrive(
+        event, events.dispatch(event, handle), lambda_context)
+    assert 'redrive' not in summary
+    assert lambda_context.invokes == []
+
+
+def test_exhausted_redrives_raise(monkeypatch, lambda_context):
+    monkeypatch.setattr(events, 'event_redrives', 2)
+    event = {'Records': [record('bad')], 'redrive': 2}
+    with pytest.raises(RuntimeError, match='after 2 re-drives'):
+        events.redrive(event, events.dispatch(event, handle), lambda_context)
+    assert lambda_context.invokes == []
+
+
+def test_redrive_outside_lambda_raises():
+    event = {'Records': [record('bad')]}
+    with pytest.raises(RuntimeError, match='1 records failed'):
+        events.redrive(event, events.dispatch(event, handle), None)
+
+
+def test_empty_event():
+    summary = events.dispatch({}, handle)
+    assert summary['records'] == []
+    assert summary['succeeded'] == summary['failed'] == 0
@@ -0,0 +1,255 @@
+"""
+Tests of the job_creation lambda function.
+"""
+import json
+import pandas as pd
+import pytest
+from ipac import schema
+from ipac import storage
+import job_creation
+import scheduler
+
+BUCKET = 'processing'
+TEMPLATE_PATH = 'ui-template/reference.liquid.html'
+REFERENCE = b'<crowd-form>@@table@@</crowd-form>'
+
+
+@pytest.fixture(autouse=True)
+def environment(local_backend, monkeypatch):
+    """
+    Job creation configuration, reference template and job creation
+    time file of the processing bucket, every job is queued.
+    """
+    for name, value in {
+        'PRODUCTION': BUCKET,
+        'TEMPLATE_PATH': TEMPLATE_PATH,
+        'CREATIONTIME_JOBS': 'JobCreationTime.csv',
+        'POST_LABEL_ARN': 'arn:post',
+        'PRE_LABEL_ARN': 'arn:pre',
+        'MAX_CONCURRENT_TASK_COUNT': '200',
+        'NUMBER_OF_HUMAN_WORKERS_PER_DATA_OBJECT': '1',
+        'TASK_AVAILABILITY_LIFE_TIME_IN_SECONDS': '864000',
+        'TASK_TIME_LIMIT_IN_SECONDS': '28800',
+        'PRIVATE_WORK_TEAM_ARN': 'arn:workteam',
+        'GROUNDTRUTH_ROLE': 'arn:role',
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(scheduler, 'submit_direct', False)
+    monkeypatch.setattr(job_creation, 'template_cache', {})
+    storage.write_bytes(BUCKET, TEMPLATE_PATH, REFERENCE)
+    storage.write_bytes(
+        BUCKET, 'JobCreationTime.csv',
+        b'MRN,PR,CreationTime,SourceCSV,status,JobName\n')
+
+
+def patient_csv(mrn, collection_dates):
+    """
+    Write a patient csv, returns the S3 event record of its creation.
+    """
+    key = f'source-csv/{mrn}.csv'
+    storage.write_csv(BUCKET, key, pd.DataFrame({
+        'mrn': mrn,
+        'name_first': 'Given',
+        'organism': 'Escherichia coli',
+        'collection_dt_tm': collection_dates,
+        'clabsi': True,
+    }))
+    return {'s3': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}
+
+
+def queued_template_uris():
+    return [entry['request']['HumanTaskConfig']['UiConfig']['UiTemplateS3Uri']
+            for _, entry in scheduler.pending(BUCKET)]
+
+
+def rendered_templates():
+    return sorted(storage.list_keys(
+        BUCKET, job_creation.template_render_prefix))
+
+
+def test_same_layout_shares_the_rendered_template():
+    dates = ['2021-02-23 10:00', '2021-02-25 09:00']
+    for mrn in (1001, 1002):
+        assert job_creation.create_job(patient_csv(mrn, dates)) == 'Queued'
+    first, second = queued_template_uris()
+    assert first == second
+    rendered, = rendered_templates()
+    assert first == f's3://{BUCKET}/{rendered}'
+    html = storage.read_bytes(BUCKET, rendered).decode('utf-8')
+    assert html.startswith('<crowd-form>')
+    assert '{% for field in task.input.table.2021-02-23_1 %}' in html
+    assert '{% for field in task.input.table.2021-02-25_1 %}' in html
+
+
+def test_rendered_template_is_written_once(local_backend, monkeypatch):
+    writes = []
+    put_object = local_backend.put_object
+
+    def counting_put_object(bucket, key, body, **kwargs):
+        writes.append(key)
+        return put_object(bucket, key, body, **kwargs)
+
+    monkeypatch.setattr(local_backend, 'put_object', counting_put_object)
+    for mrn in (1001, 1002, 1003):
+        job_creation.create_job(patient_csv(mrn, ['2021-02-23 10:00']))
+    assert len([key for key in writes
+                if key.startswith(job_creation.template_render_prefix)]) == 1
+
+
+def test_other_layout_has_its_own_template():
+    job_creation.create_job(patient_csv(1001, ['2021-02-23 10:00']))
+    job_creation.create_job(patient_csv(
+        1002, ['2021-02-23 10:00', '2021-02-23 14:00']))
+    first, second = queued_template_uris()
+    assert first != second
+    assert len(rendered_templates()) == 2
+
+
+def test_changed_reference_template_is_rendered_again(monkeypatch):
+    monkeypatch.setattr(job_creation, 'template_cache_ttl', 0)
+    job_creation.create_job(patient_csv(1001, ['2021-02-23 10:00']))
+    storage.write_bytes(BUCKET, TEMPLATE_PATH, b'<div>@@table@@</div>')
+    job_creation.create_job(patient_csv(1002, ['2021-02-23 10:00']))
+    first, second = queued_template_uris()
+    assert first != second
+    html = storage.read_bytes(BUCKET, second[len(f's3://{BUCKET}/'):])
+    assert html.startswith(b'<div>')
+
+
+def test_batch_template_has_the_keys_of_every_patient(monkeypatch):
+    monkeypatch.setattr(job_creation, 'job_batch_size', 2)
+    job_creation.create_job(patient_csv(1001, ['2021-02-23 10:00']))
+    job_creation.create_job(patient_csv(1002, ['2021-03-01 10:00']))
+    job_creation.flush_pending(BUCKET)
+    uri, = queued_template_uris()
+    html = storage.read_bytes(BUCKET, uri[len(f's3://{BUCKET}/'):])
+    assert b'{% if task.input.table.2021-02-23_1 %}' in html
+    assert b'{% if task.input.table.2021-03-01_1 %}' in html
+
+
+def patient_dataframe(mrn, collection_dates):
+    return pd.DataFrame({
+        'mrn': mrn,
+        'name_first': 'Given',
+        'organism': 'Escherichia coli',
+        'collection_dt_tm': collection_dates,
+    })
+
+
+def test_gen_data_dict_reads_the_plot_index(local_backend):
+    """
+    The plots are matched by collection label, plots not in the index,
+    e.g. of an earlier run, are not used.
+    """
+    uri = f's3://{BUCKET}/images/1/IWP/plots_{{:02}}.png'
+    storage.write_bytes(BUCKET, 'images/1/IWP/plots_05.png', b'stale')
+    storage.write_json(BUCKET, schema.PLOT_INDEX_KEY.format(mrn=1), {
+        'mrn': '1',
+        'timeline': {'uri': f's3://{BUCKET}/images/1/timeline.png'},
+        'iwp_plots': {
+            '2021-03-02_1': {'uri': uri.format(0)},
+            '2021-03-01_1': {'uri': uri.format(1)},
+            '2021-03-01_2': {'uri': uri.format(2)},
+        },
+    })
+    data = job_creation.gen_data_dict(patient_dataframe(1, [
+        '2021-03-02 09:00', '2021-03-01 08:00', '2021-03-01 20:00']), BUCKET)
+    assert list(data['table']) == [
+        '2021-03-01_1', '2021-03-01_2', '2021-03-02_1']
+    assert data['sourcetimelineimg'] == \
+        f's3://{BUCKET}/images/1/timeline.png'
+    assert data['iwp_plots'] == {
+        '2021-03-01_1': uri.format(1),
+        '2021-03-01_2': uri.format(2),
+        '2021-03-02_1': uri.format(0),
+    }
+
+
+def test_gen_data_dict_lists_the_plots_without_index(local_backend):
+    """
+    A patient preprocessed before the plot index has its plots listed
+    and matched to the sorted collection labels by position.
+    """
+    for plot in range(3):
+        storage.write_bytes(
+            BUCKET, f'images/1/IWP/plots_{plot:02}.png', b'png')
+    data = job_creation.gen_data_dict(patient_dataframe(1, [
+        '2021-03-01 08:00', '2021-03-02 09:00', '2021-03-01 20:00']), BUCKET)
+    assert data['sourcetimelineimg'] == \
+        f's3://{BUCKET}/images/1/timeline.png'
+    assert data['iwp_plots'] == {
+        '2021-03-01_1': f's3://{BUCKET}/images/1/IWP/plots_00.png',
+        '2021-03-01_2': f's3://{BUCKET}/images/1/IWP/plots_01.png',
+        '2021-03-02_1': f's3://{BUCKET}/images/1/IWP/plots_02.png',
+    }
+
+
+def ledger():
+    return storage.read_csv(BUCKET, 'JobCreationTime.csv')
+
+
+def test_replayed_record_is_written_to_the_ledger_once():
+    record = dict(patient_csv(1001, ['2021-02-23 10:00']),
+                  eventTime='2021-02-23T18:04:05.123Z')
+    job_creation.create_job(record)
+    job_creation.create_job(record)
+    names = [entry['request']['LabelingJobName']
+             for _, entry in scheduler.pending(BUCKET)]
+    assert names == ['MRN-1001-reviewed-0-times-2021-02-23-18-04-05'] * 2
+    assert ledger()[['MRN', 'JobName']].values.tolist() == [
+        [1001, names[0]]]
+
+
+def failing_queue(*args):
+    raise RuntimeError('queue unavailable')
+
+
+def test_failed_submission_is_not_written_to_the_ledger(monkeypatch):
+    monkeypatch.setattr(scheduler, 'submit', failing_queue)
+    with pytest.raises(RuntimeError):
+        job_creation.create_job(patient_csv(1001, ['2021-02-23 10:00']))
+    assert ledger().empty
+
+
+def test_batch_flushed_again_is_written_to_the_ledger_once(monkeypatch):
+    monkeypatch.setattr(job_creation, 'job_batch_size', 2)
+    job_creation.create_job(patient_csv(1001, ['2021-02-23 10:00']))
+    job_creation.create_job(patient_csv(1002, ['2021-03-01 10:00']))
+    enqueue = scheduler.enqueue
+    monkeypatch.setattr(scheduler, 'enqueue', failing_queue)
+    failed, = job_creation.flush_pending(BUCKET).values()
+    assert failed != 'Queued'
+    assert ledger().empty
+
+    # The ledger write fails after the first patient of the batch
+    write_timeline = job_creation.write_timeline
+    writes = []
+
+    def failing_write_timeline(*args):
+        writes.append(args)
+        if len(writes) == 2:
+            raise RuntimeError('ledger unavailable')
+        return write_timeline(*args)
+
+    monkeypatch.setattr(scheduler, 'enqueue', enqueue)
+    monkeypatch.setattr(job_creation, 'write_timeline', failing_write_timeline)
+    first, = job_creation.flush_pending(BUCKET).items()
+    assert first[1] != 'Queued'
+    second, = job_creation.flush_pending(BUCKET).items()
+    assert second == (first[0], 'Queued')
+    assert sorted(ledger()['MRN']) == [1001, 1002]
+    assert set(ledger()['JobName']) == {first[0]}
+    assert not list(storage.list_keys(BUCKET, job_creation.job_pending_prefix))
+
+
+def test_failed_record_is_redriven_alone(lambda_context):
+    good = patient_csv(1001, ['2021-02-23 10:00'])
+    missing = {'s3': {'bucket': {'name': BUCKET},
+                      'object': {'key': 'source-csv/1002.csv'}}}
+    summary = job_creation.lambda_handler(
+        {'Records': [good, missing]}, lambda_context)
+    assert summary['succeeded'] == summary['failed'] == 1
+    invoke, = lambda_context.invokes
+    assert json.loads(invoke['Payload']) == {
+        'Records': [missing], 'redrive': 1}
+    assert len(scheduler.pending(BUCKET)) == 1
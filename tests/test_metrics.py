@@ -0,0 +1,71 @@
+"""
+Tests of the per invocation metrics, ipac.metrics.
+"""
+import json
+import types
+import pytest
+from ipac import metrics
+
+
+def emitted(capsys):
+    """
+    The EMF document, the last printed line.
+    """
+    return json.loads(capsys.readouterr().out.splitlines()[-1])
+
+
+def test_one_emf_line_per_invocation(capsys):
+    @metrics.instrument('preprocess')
+    def handler(event, context):
+        with metrics.span('workbook_parse'):
+            metrics.count_s3('GetObject', 1024)
+        metrics.count_s3('ListObjectsV2')
+        return 'done'
+
+    context = types.SimpleNamespace(aws_request_id='request-1')
+    assert handler({}, context) == 'done'
+    document = emitted(capsys)
+    assert document['Function'] == 'preprocess'
+    assert document['RequestId'] == 'request-1'
+    assert document['invocation.count'] == 1
+    assert document['workbook_parse.count'] == 1
+    assert document['S3.GetObject.requests'] == 1
+    assert document['S3.GetObject.bytes'] == 1024
+    assert document['S3.ListObjectsV2.requests'] == 1
+    assert 'S3.ListObjectsV2.bytes' not in document
+    directive, = document['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == metrics.metrics_namespace
+    assert directive['Dimensions'] == [['Function']]
+    # Every defined metric has its value in the document
+    names = [metric['Name'] for metric in directive['Metrics']]
+    assert len(names) == len(set(names))
+    for metric in directive['Metrics']:
+        assert isinstance(document[metric['Name']], (int, float))
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units['workbook_parse.wall'] == 'Milliseconds'
+    assert units['S3.GetObject.bytes'] == 'Bytes'
+    assert units['PeakRSS'] == 'Megabytes'
+
+
+def test_metrics_are_emitted_when_the_handler_raises(capsys):
+    @metrics.instrument('job_creation')
+    def handler(event, context):
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        handler({}, None)
+    document = emitted(capsys)
+    assert document['Function'] == 'job_creation'
+    assert document['RequestId'] is None
+    assert document['invocation.count'] == 1
+
+
+def test_at_most_100_metrics_per_directive(capsys):
+    metrics.reset()
+    for index in range(30):
+        metrics.record(f'stage{index}', 0.1, 0.1)
+    document = metrics.emit('loop')
+    directives = document['_aws']['CloudWatchMetrics']
+    assert [len(directive['Metrics']) for directive in directives] == [
+        100, 21]
+    assert emitted(capsys) == document
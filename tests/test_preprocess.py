@@ -0,0 +1,707 @@
+"""
+Tests of the preprocess lambda function.
+"""
+from concurrent.futures import Future
+import hashlib
+import json
+import tempfile
+import threading
+import time
+import pandas as pd
+import pytest
+from ipac import events
+from ipac import schema
+from ipac import storage
+import job_creation
+import preprocess
+import workbook_generator
+
+
+def test_join_organisms():
+    """
+    The organisms of an encounter are joined once, without duplicates,
+    in the order of the organism sheet, onto every row of the encounter.
+    """
+    patients = pd.DataFrame({
+        'mrn': [1, 1, 1, 2],
+        'encntr_num': [10, 10, 11, 20],
+        'organism': ['stale', 'stale', 'stale', 'stale'],
+    })
+    organisms = pd.DataFrame({
+        'mrn': [1, 1, 1, 1, 2],
+        'encntr_num': [10, 10, 10, 11, 21],
+        'organism_desc_src': [
+            'E. coli', 'S. aureus', 'E. coli', None, 'K. pneumoniae'],
+    })
+    joined = preprocess.join_organisms(patients, organisms)
+    assert list(joined.columns) == ['mrn', 'encntr_num', 'organism']
+    assert joined['organism'].tolist() == [
+        'E. coli,\nS. aureus', 'E. coli,\nS. aureus', '', '']
+    assert len(joined) == len(patients)
+
+
+def test_partition_patients():
+    """
+    Every patient is yielded once with its own rows, sorted by collection
+    date and indexed from 0, and the workers split the patients.
+    """
+    patients = pd.DataFrame({
+        'mrn': [3, 1, 3, 2, 1],
+        'collection_dt_tm': pd.to_datetime([
+            '2021-01-05', '2021-01-02', '2021-01-01', '2021-01-03',
+            '2021-01-01']),
+    })
+    temperature = pd.DataFrame({
+        'mrn': [2, 3, 3, 2],
+        'collection_dt_tm': pd.to_datetime([
+            '2021-01-03', '2021-01-05', '2021-01-01', '2021-01-03']),
+        'result_val': [37.0, 38.5, 39.0, 37.5],
+    })
+    patients, temperature = preprocess.sort_sheets(patients, temperature)
+    partitions = list(preprocess.partition_patients(patients, temperature))
+    assert [patient for patient, _, _ in partitions] == [1, 2, 3]
+    for patient, data, temperature_data in partitions:
+        assert (data['mrn'] == patient).all()
+        assert data['collection_dt_tm'].is_monotonic_increasing
+        assert list(data.index) == list(range(len(data)))
+        assert (temperature_data['mrn'] == patient).all()
+        assert list(temperature_data.index) == list(
+            range(len(temperature_data)))
+    assert [len(data) for _, data, _ in partitions] == [2, 1, 2]
+    assert [len(data) for _, _, data in partitions] == [0, 2, 2]
+    assert partitions[1][2]['result_val'].tolist() == [37.0, 37.5]
+    assert partitions[2][2]['result_val'].tolist() == [39.0, 38.5]
+    split = [
+        [patient for patient, _, _ in preprocess.partition_patients(
+            patients, temperature, worker_index, 2)]
+        for worker_index in range(2)]
+    assert split == [[1, 3], [2]]
+
+
+def test_datetime_columns_are_parsed_once(monkeypatch):
+    """
+    The text dates are parsed once, unparsable values become NaT, and
+    typed columns are not parsed again.
+    """
+    dataframe = pd.DataFrame({
+        'mrn': [1, 2],
+        'collection_dt_tm': ['2021-01-04 08:00:00', 'not a date'],
+        'admit_dt_tm': pd.to_datetime(['2021-01-01', '2021-01-02']),
+    })
+    columns = ['collection_dt_tm', 'admit_dt_tm', 'disch_dt_tm']
+    dataframe = preprocess.normalize_dataframe(dataframe, columns)
+    assert pd.api.types.is_datetime64_any_dtype(dataframe['collection_dt_tm'])
+    assert dataframe['collection_dt_tm'][0] == pd.Timestamp(
+        '2021-01-04 08:00:00')
+    assert pd.isna(dataframe['collection_dt_tm'][1])
+    assert 'disch_dt_tm' not in dataframe.columns
+
+    def parse(*args, **kwargs):
+        raise AssertionError('parsed again')
+
+    monkeypatch.setattr(pd, 'to_datetime', parse)
+    preprocess.normalize_dataframe(dataframe, columns)
+
+
+@pytest.fixture
+def s3_writes(monkeypatch):
+    """
+    Record the uploads of preprocess.Uploader instead of writing to S3.
+
+    Returns
+    -------
+    list of the written keys in write order, set of keys that fail,
+     dictionary of key: threading.Event the write of that key waits for
+    """
+    writes, failing, blocked = [], set(), {}
+
+    def write_bytes(bucket, key, body, **kwargs):
+        if key in blocked:
+            blocked[key].wait(5)
+        if key in failing:
+            raise IOError(f'{key} failed')
+        writes.append(key)
+
+    monkeypatch.setattr(storage, 'write_bytes', write_bytes)
+    return writes, failing, blocked
+
+
+def test_csv_waits_for_its_plots(s3_writes):
+    writes, _, blocked = s3_writes
+    blocked['images/1/timeline.png'] = threading.Event()
+    uploader = preprocess.Uploader('processing', workers=4)
+    plot = uploader.put('images/1/timeline.png', b'png')
+    csv = uploader.put('source-csv/1.csv', b'csv', after=[plot])
+    time.sleep(0.1)
+    assert not csv.done()
+    blocked['images/1/timeline.png'].set()
+    uploader.wait()
+    assert writes == ['images/1/timeline.png', 'source-csv/1.csv']
+
+
+def test_failed_upload_fails_the_patient(monkeypatch, s3_writes):
+    """
+    A failed plot upload fails its patient and the csv of that patient
+    is not written, the other patients are written.
+    """
+    writes, failing, _ = s3_writes
+    failing.add('images/1/timeline.png')
+
+    def process_patient(patient, data, temperature, uploader):
+        plot = uploader.put(f'images/{patient}/timeline.png', b'png')
+        return uploader.put(f'source-csv/{patient}.csv', b'csv', after=[plot])
+
+    monkeypatch.setattr(preprocess, 'process_patient', process_patient)
+    failures = preprocess.process_partitions(
+        lambda worker_index, workers: iter([(1, None, None), (2, None, None)]))
+    assert list(failures) == ['1']
+    assert sorted(writes) == ['images/2/timeline.png', 'source-csv/2.csv']
+
+
+class RecordingUploader:
+    """
+    Stand-in of preprocess.Uploader, keeps the uploaded keys.
+    """
+
+    def __init__(self):
+        self.keys = []
+
+    def put(self, key, body, after=()):
+        self.keys.append(key)
+        return key
+
+
+@pytest.fixture
+def timeline(monkeypatch):
+    """
+    Render a timeline, keeping the figure open for its artists.
+
+    Returns
+    -------
+    function (dataframe, **kwargs) returning (figure, axis, uploaded keys)
+    """
+    figures = []
+    subplots = preprocess.plt.subplots
+
+    def recording_subplots(*args, **kwargs):
+        figures.append(subplots(*args, **kwargs))
+        return figures[-1]
+
+    monkeypatch.setattr(preprocess.plt, 'subplots', recording_subplots)
+
+    def render(dataframe, **kwargs):
+        uploader = RecordingUploader()
+        preprocess.plot_timeline(dataframe, 1, uploader, **kwargs)
+        fig, axis = figures[-1]
+        return fig, axis, uploader.keys
+
+    return render
+
+
+def timeline_rows(collections, days=19):
+    """
+    Rows of one patient staying for days, with two nursing unit stays,
+    one central line and the given collection dates.
+    """
+    collections = pd.to_datetime(collections)
+    half = (len(collections) + 1) // 2
+    dataframe = pd.DataFrame({
+        'mrn': 1,
+        'admit_dt_tm': pd.Timestamp('2021-01-01'),
+        'disch_dt_tm': pd.Timestamp('2021-01-01') + pd.Timedelta(days=days),
+        'beg_effective_dt_tm': pd.to_datetime(
+            ['2021-01-02'] * half + ['2021-01-05'] * (
+                len(collections) - half)),
+        'end_effective_dt_tm': pd.to_datetime(
+            ['2021-01-05'] * half + ['2021-01-09'] * (
+                len(collections) - half)),
+        'nursing_unit_short_desc': ['ICU'] * half + ['CCU'] * (
+            len(collections) - half),
+        'first_activity_start_dt_tm': pd.Timestamp('2021-01-03'),
+        'last_activity_end_dt_tm': pd.Timestamp('2021-01-10'),
+        'collection_dt_tm': collections,
+        'organism': 'E. coli',
+    })
+    return dataframe
+
+
+def bars(axis):
+    """
+    (start, width) of the bars of every track, keyed by the track y,
+    drawn either as bar patches or as broken_barh collections.
+    """
+    periods = [
+        (patch.get_y(), patch.get_x(), patch.get_width())
+        for patch in axis.patches]
+    for collection in axis.collections:
+        for path in collection.get_paths():
+            extents = path.get_extents()
+            periods.append((extents.y0, extents.x0, extents.width))
+    tracks = {}
+    for y, start, width in periods:
+        tracks.setdefault(round(y - 0.1), []).append((start, width))
+    return tracks
+
+
+def markers(axis, marker, markersize):
+    return sorted(
+        day for line in axis.get_lines()
+        if line.get_marker() == marker and line.get_markersize() == markersize
+        for day in line.get_xdata())
+
+
+def test_timeline_of_a_small_patient(timeline):
+    fig, axis, keys = timeline(timeline_rows(
+        ['2021-01-04 08:00', '2021-01-07']))
+    assert keys == ['images/1/timeline.png']
+    assert fig.dpi == 300
+    assert tuple(fig.get_size_inches()) == (12, 3.5)
+    assert bars(axis) == {0: [(0, 19)], 1: [(1, 3), (4, 4)], 2: [(2, 7)]}
+    assert [label.get_text() for label in axis.get_yticklabels()] == [
+        'Patient visit', 'ICU', 'Central line', 'CCU']
+    # Start and stop markers of every period, a collection marker per day
+    assert markers(axis, '>', 6) == [0, 1, 2, 4]
+    assert markers(axis, '<', 6) == [4, 8, 9, 19]
+    assert markers(axis, 'o', 14) == [3, 6]
+    assert markers(axis, 'o', 5) == [3, 6]
+    assert axis.get_legend_handles_labels()[1] == ['E. coli']
+    assert len(axis.texts) == 0
+    ticks = dict(zip(axis.get_xticks(), [
+        label.get_text() for label in axis.get_xticklabels()]))
+    assert ticks == {
+        0: '2021-01-01', 19: '2021-01-20', 1: '2021-01-02',
+        4: '2021-01-05', 2: '2021-01-03', 9: '2021-01-10',
+        3: '2021-01-04', 8: '2021-01-09', 6: '2021-01-07'}
+
+
+def test_timeline_of_a_long_stay_patient(monkeypatch, timeline):
+    """
+    Above TIMELINE_LOD_THRESHOLD collections the same day collections
+    share a marker labelled with their count, the figure is capped and
+    the tick labels are thinned to TIMELINE_MAX_TICKS.
+    """
+    monkeypatch.setattr(preprocess, 'timeline_max_ticks', 10)
+    start = pd.Timestamp('2021-01-01')
+    collections = [
+        start + pd.Timedelta(days=day, hours=hours)
+        for day in range(60) for hours in (8, 20)][:-1]
+    fig, axis, keys = timeline(timeline_rows(collections, days=70))
+    assert keys == ['images/1/timeline.png']
+    assert fig.dpi == 150
+    assert tuple(fig.get_size_inches()) == (12, 12)
+    assert bars(axis) == {0: [(0, 70)], 1: [(1, 3), (4, 4)], 2: [(2, 7)]}
+    assert markers(axis, 'o', 14) == list(range(60))
+    # The count replaces the inner marker of the merged collections
+    assert markers(axis, 'o', 5) == [59]
+    assert [(text.get_position()[0], text.get_text())
+            for text in axis.texts] == [(day, '2') for day in range(59)]
+    ticks = list(axis.get_xticks())
+    assert 0 < len(ticks) <= 10
+    assert ticks == sorted(ticks) and ticks[0] == 0
+
+
+def test_timeline_level_of_detail_is_optional(timeline):
+    rows = timeline_rows(['2021-01-04 08:00', '2021-01-04 20:00'])
+    fig, axis, _ = timeline(rows)
+    assert fig.dpi == 300
+    assert markers(axis, 'o', 5) == [3]
+    assert len(axis.texts) == 0
+    fig, axis, _ = timeline(rows, lod=True)
+    assert fig.dpi == 150
+    assert markers(axis, 'o', 5) == []
+    assert [text.get_text() for text in axis.texts] == ['2']
+
+
+def test_plot_index_of_same_day_collections(monkeypatch, local_backend,
+                                            tmp_path):
+    """
+    preprocess indexes the IWP plots by collection label, same day
+    collections are numbered, and gen_data_dict resolves the labels
+    of the manifest table from that index.
+    """
+    sheets = workbook_generator.generate_workbook(
+        1, collections=3, temperatures=20)
+    day = sheets['Sheet1']['collection_dt_tm'].min().normalize()
+    sheets['Sheet1']['collection_dt_tm'] = [
+        day + pd.Timedelta(hours=20), day + pd.Timedelta(hours=6),
+        day + pd.Timedelta(days=2, hours=9)]
+    mrn = sheets['Sheet1']['mrn'][0]
+    path = tmp_path / 'workbook.xlsx'
+    workbook_generator.write_workbook(sheets, str(path))
+    local_backend.put_object('landing', 'workbook.xlsx', path.read_bytes())
+    monkeypatch.setenv('patient_folder', 'source-csv')
+    monkeypatch.setattr(preprocess, 'patient_processed', 'processing')
+    monkeypatch.setattr(preprocess, 'workbook_cache_prefix', '')
+    preprocess.lambda_handler({'Records': [{'s3': {
+        'bucket': {'name': 'landing'},
+        'object': {'key': 'workbook.xlsx'}}}]}, None)
+
+    index = storage.read_json(
+        'processing', schema.PLOT_INDEX_KEY.format(mrn=mrn))
+    labels = [
+        day.strftime('%Y-%m-%d_1'), day.strftime('%Y-%m-%d_2'),
+        (day + pd.Timedelta(days=2)).strftime('%Y-%m-%d_1')]
+    assert index['mrn'] == str(mrn)
+    assert list(index['iwp_plots']) == labels
+    for position, label in enumerate(labels):
+        key = f'images/{mrn}/IWP/plots_{position:02}.png'
+        assert index['iwp_plots'][label] == {
+            'uri': f's3://processing/{key}',
+            'sha256': hashlib.sha256(
+                storage.read_bytes('processing', key)).hexdigest()}
+    assert index['timeline']['uri'] == \
+        f's3://processing/images/{mrn}/timeline.png'
+
+    data = job_creation.gen_data_dict(
+        storage.read_csv('processing', f'source-csv/{mrn}.csv'),
+        'processing')
+    assert data['iwp_plots'] == {
+        label: plot['uri'] for label, plot in index['iwp_plots'].items()}
+
+
+@pytest.fixture
+def failing_patient(monkeypatch, workbook_event):
+    """
+    Replace the rendering of a patient, the first patient fails.
+
+    Returns
+    -------
+    event, mrn of the failing patient, mrns of all patients
+    """
+    event, sheets = workbook_event
+    mrns = sorted({str(mrn) for mrn in sheets['Sheet1']['mrn']})
+
+    def process_patient(patient, data, temperature, uploader):
+        if str(patient) == mrns[0]:
+            raise ValueError('rendering failed')
+        upload = Future()
+        upload.set_result(None)
+        return upload
+
+    monkeypatch.setattr(preprocess, 'process_patient', process_patient)
+    monkeypatch.setattr(preprocess, 'workbook_cache_prefix', '')
+    return event, mrns[0], mrns
+
+
+@pytest.mark.parametrize('render_workers', [1, 2])
+def test_failed_patient_is_reported(monkeypatch, failing_patient,
+                                    lambda_context, render_workers):
+    """
+    A failed patient does not fail its workbook, the summary lists it
+    and its retry event, re-driven, replays that patient only.
+    """
+    event, failed, mrns = failing_patient
+    monkeypatch.setattr(preprocess, 'render_workers', render_workers)
+    response = preprocess.lambda_handler(event, lambda_context)
+    summary = json.loads(response['body'])
+    assert summary['failed'] == 0
+    result, = summary['records']
+    assert list(result['result']['failed_patients']) == [failed]
+    retry = {'Records': [dict(event['Records'][0], patients=[failed])]}
+    assert summary['retry'] == retry
+    invoke, = lambda_context.invokes
+    assert json.loads(invoke['Payload']) == dict(retry, redrive=1)
+
+
+def test_failed_patient_does_not_stop_the_others(monkeypatch,
+                                                 failing_patient,
+                                                 lambda_context):
+    event, failed, mrns = failing_patient
+    processed = []
+    process_patient = preprocess.process_patient
+
+    def track(patient, *args):
+        processed.append(str(patient))
+        return process_patient(patient, *args)
+
+    monkeypatch.setattr(preprocess, 'process_patient', track)
+    summary = json.loads(
+        preprocess.lambda_handler(event, lambda_context)['body'])
+    assert sorted(processed) == mrns
+    assert summary['retry']['Records'][0]['patients'] == [failed]
+
+    # The retry event processes the failed patient only
+    processed.clear()
+    preprocess.lambda_handler(summary['retry'], lambda_context)
+    assert processed == [failed]
+
+
+def test_failed_worker_replays_the_record(failing_patient):
+    event, failed, mrns = failing_patient
+    record = dict(event['Records'][0], patients=mrns[:2])
+    assert preprocess.patient_retry_record(
+        record, {'worker-1': 'worker exited without reporting'}) == record
+
+
+def test_succeeded_workbook(monkeypatch, failing_patient):
+    event, failed, mrns = failing_patient
+    upload = Future()
+    upload.set_result(None)
+    monkeypatch.setattr(
+        preprocess, 'process_patient', lambda *args: upload)
+    response = preprocess.lambda_handler(event, None)
+    assert response['statusCode'] == 200
+
+
+def cached_objects(bucket='processing'):
+    return sorted(storage.list_keys(bucket, preprocess.workbook_cache_prefix))
+
+
+@pytest.fixture
+def workbook_object(monkeypatch, workbook_event):
+    """
+    Open the synthetic workbook, the patient bucket is 'processing'.
+    """
+    monkeypatch.setattr(preprocess, 'patient_processed', 'processing')
+    monkeypatch.setattr(preprocess, 'workbook_cache_stats',
+                        {'hit': 0, 'miss': 0})
+    event, _ = workbook_event
+    bucket, key = events.s3_location(event['Records'][0])
+    return lambda: (storage.get_object(bucket, key), bucket, key)
+
+
+def test_workbook_cache_is_parquet(workbook_object):
+    patients, temperature = preprocess.preprocess(*workbook_object())
+    assert [key.rsplit('/', 1)[1] for key in cached_objects()] == [
+        'Sheet1.parquet', 'Sheet2.parquet', 'Sheet3.parquet']
+    cached_patients, cached_temperature = preprocess.preprocess(
+        *workbook_object())
+    assert preprocess.workbook_cache_stats == {'hit': 1, 'miss': 1}
+    pd.testing.assert_frame_equal(patients, cached_patients)
+    pd.testing.assert_frame_equal(temperature, cached_temperature)
+
+
+def test_cached_workbook_is_not_downloaded(monkeypatch, workbook_object):
+    """
+    Without an opened object the cache is looked up by a HEAD request,
+    the workbook is read only on a cache miss.
+    """
+    _, bucket, key = workbook_object()
+    get_object = storage.get_object
+    downloads = []
+
+    def counting_get_object(*args):
+        if args == (bucket, key):
+            downloads.append(args)
+        return get_object(*args)
+
+    monkeypatch.setattr(storage, 'get_object', counting_get_object)
+    patients, _ = preprocess.preprocess(None, bucket, key)
+    assert downloads == [(bucket, key)]
+    cached_patients, _ = preprocess.preprocess(None, bucket, key)
+    assert downloads == [(bucket, key)]
+    assert preprocess.workbook_cache_stats == {'hit': 1, 'miss': 1}
+    pd.testing.assert_frame_equal(patients, cached_patients)
+
+
+def test_workbook_cache_needs_pyarrow(monkeypatch, workbook_object):
+    monkeypatch.setattr(preprocess, 'pyarrow', None)
+    preprocess.preprocess(*workbook_object())
+    preprocess.preprocess(*workbook_object())
+    assert cached_objects() == []
+    assert preprocess.workbook_cache_stats == {'hit': 0, 'miss': 0}
+
+
+def test_unconvertible_workbook_is_not_cached(monkeypatch, workbook_object):
+    read_workbook = preprocess.read_workbook
+
+    def mixed_column(obj):
+        sheets = read_workbook(obj)
+        sheets['Sheet3']['organism_desc_src'] = [
+            1 if index % 2 else 'text'
+            for index in range(len(sheets['Sheet3']))]
+        return sheets
+
+    monkeypatch.setattr(preprocess, 'read_workbook', mixed_column)
+    preprocess.preprocess(*workbook_object())
+    assert cached_objects() == []
+
+
+@pytest.mark.parametrize('reader', ['pandas', 'stream'])
+def test_patient_csv_columns(monkeypatch, workbook_event, reader):
+    """
+    The patient csv has the columns of the patient sheet, in the sheet
+    order, and the joined organisms, as the reporting files need them.
+    """
+    event, sheets = workbook_event
+    monkeypatch.setenv('patient_folder', 'source-csv')
+    monkeypatch.setattr(preprocess, 'patient_processed', 'processing')
+    monkeypatch.setattr(preprocess, 'workbook_cache_prefix', '')
+    monkeypatch.setattr(preprocess, 'workbook_reader', reader)
+    preprocess.lambda_handler(event, None)
+    mrns = sorted({str(mrn) for mrn in sheets['Sheet1']['mrn']})
+    assert sorted(storage.list_keys('processing', 'source-csv/')) == [
+        f'source-csv/{mrn}.csv' for mrn in mrns]
+    for mrn in mrns:
+        header = storage.read_bytes(
+            'processing', f'source-csv/{mrn}.csv').decode().splitlines()[0]
+        assert header.split(',') == \
+            list(sheets['Sheet1'].columns) + ['organism']
+
+
+def test_unused_columns_are_not_read(local_backend, tmp_path):
+    """
+    Both readers only read the used columns of every sheet, in the
+    sheet order.
+    """
+    sheets = workbook_generator.generate_workbook(2, temperatures=5)
+    sheets['Sheet1']['unused_patient_column'] = 'x'
+    sheets['Sheet2']['unused_temperature_column'] = 'x'
+    path = tmp_path / 'workbook.xlsx'
+    workbook_generator.write_workbook(sheets, str(path))
+    local_backend.put_object('landing', 'workbook.xlsx', path.read_bytes())
+    used = {
+        'Sheet1': schema.PATIENT_CSV_COLUMN_NAMES,
+        'Sheet2': schema.TEMPERATURE_COLUMN_NAMES,
+        'Sheet3': schema.ORGANISM_COLUMN_NAMES,
+    }
+    expected = {
+        name: [column.lower() for column in sheets[name].columns
+               if column.lower() in used[name]]
+        for name in used}
+    read = preprocess.read_workbook(
+        storage.get_object('landing', 'workbook.xlsx'))
+    assert {name: list(sheet.columns) for name, sheet in read.items()} == \
+        expected
+    spool = preprocess.spool_workbook(
+        storage.get_object('landing', 'workbook.xlsx'),
+        str(tmp_path), buckets=2)
+    assert spool['columns'] == {
+        'patients': expected['Sheet1'], 'temperature': expected['Sheet2']}
+    assert list(spool['organism'].columns) == expected['Sheet3']
+
+
+def workbook_with_missing_collection_date(local_backend, tmp_path):
+    """
+    Store a workbook of one patient with two collections, the second
+    without collection date.
+
+    Returns
+    -------
+    event, mrn
+    """
+    sheets = workbook_generator.generate_workbook(
+        1, collections=2, temperatures=20)
+    sheets['Sheet1']['collection_dt_tm'] = [
+        sheets['Sheet1']['collection_dt_tm'].min(), pd.NaT]
+    path = tmp_path / 'workbook.xlsx'
+    workbook_generator.write_workbook(sheets, str(path))
+    local_backend.put_object('landing', 'workbook.xlsx', path.read_bytes())
+    event = {'Records': [{'s3': {
+        'bucket': {'name': 'landing'}, 'object': {'key': 'workbook.xlsx'}}}]}
+    return event, sheets['Sheet1']['mrn'][0]
+
+
+def test_iwp_plot_without_collection_date(local_backend, tmp_path):
+    event, mrn = workbook_with_missing_collection_date(
+        local_backend, tmp_path)
+    patients, temperature = preprocess.sort_sheets(*preprocess.preprocess(
+        storage.get_object('landing', 'workbook.xlsx')))
+    assert pd.isna(patients['collection_dt_tm'][1])
+    uploader = RecordingUploader()
+    with preprocess.IwpRenderer(temperature) as renderer:
+        assert renderer.render(patients, 1, mrn, uploader) is None
+        assert renderer.render(patients, 0, mrn, uploader) is not None
+    assert uploader.keys == [f'images/{mrn}/IWP/plots_00.png']
+
+
+def test_patient_with_missing_collection_date(monkeypatch, local_backend,
+                                              tmp_path):
+    """
+    The collection without date has no IWP plot and no plot index entry,
+    the other plots, the index and the csv are written.
+    """
+    event, mrn = workbook_with_missing_collection_date(
+        local_backend, tmp_path)
+    monkeypatch.setenv('patient_folder', 'source-csv')
+    monkeypatch.setattr(preprocess, 'patient_processed', 'processing')
+    monkeypatch.setattr(preprocess, 'workbook_cache_prefix', '')
+    summary = json.loads(preprocess.lambda_handler(event, None)['body'])
+    assert summary['records'][0]['result'] == {'failed_patients': {}}
+    assert sorted(storage.list_keys('processing', f'images/{mrn}/')) == [
+        f'images/{mrn}/IWP/plots_00.png',
+        f'images/{mrn}/plot_index.json',
+        f'images/{mrn}/timeline.png',
+    ]
+    index = storage.read_json(
+        'processing', schema.PLOT_INDEX_KEY.format(mrn=mrn))
+    assert schema.NO_COLLECTION_LABEL not in index['iwp_plots']
+    assert len(index['iwp_plots']) == 1
+    assert list(storage.list_keys('processing', 'source-csv/')) == [
+        f'source-csv/{mrn}.csv']
+
+
+def test_temperature_window_includes_its_edges():
+    """
+    The readings at the window start and end are drawn, like the
+    baseline which drew every reading and clipped at the axis limits.
+    """
+    start, end = pd.Timestamp('2021-01-01'), pd.Timestamp('2021-01-07')
+    temperature = pd.DataFrame({
+        'mrn': 1,
+        'event_end_dt_tm': [
+            start - pd.Timedelta(minutes=1), start,
+            start + pd.Timedelta(days=3), end,
+            end + pd.Timedelta(minutes=1)],
+        'result_val': [36.0, 37.0, 38.5, 39.0, 40.0],
+    })
+    with preprocess.IwpRenderer(temperature) as renderer:
+        renderer._set_temperature_window(
+            preprocess.mdates.date2num(start),
+            preprocess.mdates.date2num(end))
+        offsets = renderer._temperature_markers.get_offsets()
+        colors = renderer._temperature_markers.get_edgecolors()
+    assert list(preprocess.mdates.num2date(offsets[:, 0])) == [
+        date.tz_localize('UTC') for date in (
+            start, start + pd.Timedelta(days=3), end)]
+    assert offsets[:, 1].tolist() == [37.0, 38.5, 39.0]
+    assert [tuple(color) for color in colors] == [
+        preprocess.IwpRenderer.normal_color,
+        preprocess.IwpRenderer.fever_color,
+        preprocess.IwpRenderer.fever_color]
+
+
+def test_bucket_count_is_sized_from_the_rows(monkeypatch):
+    monkeypatch.setattr(preprocess, 'workbook_buckets', 0)
+    monkeypatch.setattr(preprocess, 'workbook_bucket_rows', 1000)
+    assert preprocess.bucket_count([5, 201], workers=1) == 1
+    assert preprocess.bucket_count([5, 201], workers=4) == 4
+    assert preprocess.bucket_count([1500, 48000], workers=2) == 50
+    assert preprocess.bucket_count([1500, None], workers=2) == 64
+    monkeypatch.setattr(preprocess, 'workbook_buckets', 8)
+    assert preprocess.bucket_count([5, 201], workers=1) == 8
+
+
+def test_spooled_workbook_buckets(monkeypatch, workbook_event):
+    """
+    A small workbook is spooled into one bucket per worker, buckets
+    without patients are not read, and every patient is yielded once.
+    """
+    event, sheets = workbook_event
+    monkeypatch.setattr(preprocess, 'workbook_buckets', 0)
+    monkeypatch.setattr(preprocess, 'render_workers', 2)
+    with tempfile.TemporaryDirectory() as directory:
+        spool = preprocess.spool_workbook(
+            storage.get_object('landing', 'ipac-clabsi/workbook.xlsx'),
+            directory)
+        assert spool['buckets'] == 2
+        patients = [
+            str(patient)
+            for worker_index in range(2)
+            for patient, _, _ in preprocess.iter_spooled_partitions(
+                spool, worker_index, 2)]
+        spool = preprocess.spool_workbook(
+            storage.get_object('landing', 'ipac-clabsi/workbook.xlsx'),
+            directory, buckets=64)
+        loaded = []
+        load_bucket = preprocess._load_bucket
+
+        def counting_load_bucket(spool, name, bucket):
+            loaded.append(bucket)
+            return load_bucket(spool, name, bucket)
+
+        monkeypatch.setattr(preprocess, '_load_bucket', counting_load_bucket)
+        assert len(list(preprocess.iter_spooled_partitions(spool))) == 3
+    assert sorted(patients) == sorted(
+        {str(mrn) for mrn in sheets['Sheet1']['mrn']})
+    assert set(loaded) == spool['written'] and len(spool['written']) <= 3
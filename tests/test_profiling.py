@@ -0,0 +1,57 @@
+"""
+Tests of the on demand profiling, ipac.profiling.
+"""
+import types
+import pytest
+from ipac import profiling
+
+
+@pytest.fixture
+def profiled_handler(monkeypatch):
+    monkeypatch.setattr(profiling, 'profile_enabled', False)
+    monkeypatch.setattr(profiling, 'profile_tracemalloc', False)
+    monkeypatch.setattr(profiling, 'profile_bucket', None)
+
+    @profiling.profile('preprocess')
+    def handler(event, context):
+        return sum(range(1000))
+
+    return handler
+
+
+def test_profiling_is_off_by_default(capsys, profiled_handler):
+    assert profiling.requested({'Records': []}) is None
+    assert profiling.requested({'Records': [], 'profile': False}) is None
+    assert profiled_handler({'Records': []}, None) == 499500
+    assert capsys.readouterr().out == ''
+
+
+def test_profiling_flags(monkeypatch, profiled_handler):
+    assert profiling.requested({'profile': True}) == {'tracemalloc': False}
+    assert profiling.requested({'profile': {'tracemalloc': True}}) == {
+        'tracemalloc': True}
+    monkeypatch.setattr(profiling, 'profile_enabled', True)
+    assert profiling.requested({}) == {'tracemalloc': False}
+    monkeypatch.setattr(profiling, 'profile_tracemalloc', True)
+    assert profiling.requested({}) == {'tracemalloc': True}
+
+
+def test_profile_is_printed_without_bucket(capsys, profiled_handler):
+    context = types.SimpleNamespace(aws_request_id='request-1')
+    assert profiled_handler({'profile': True}, context) == 499500
+    out = capsys.readouterr().out
+    assert 'PROFILE_BUCKET is not set, profile of preprocess request-1' in out
+    assert 'function calls' in out
+    assert profiling._active is None
+
+
+def test_profile_is_written_to_the_bucket(monkeypatch, local_backend,
+                                          profiled_handler):
+    monkeypatch.setattr(profiling, 'profile_bucket', 'profiles')
+    context = types.SimpleNamespace(aws_request_id='request-1')
+    profiled_handler({'profile': {'tracemalloc': True}}, context)
+    assert sorted(local_backend.list_keys('profiles')) == [
+        'profiles/preprocess/request-1/handler-allocations.txt',
+        'profiles/preprocess/request-1/handler.pstats',
+        'profiles/preprocess/request-1/handler.txt',
+    ]
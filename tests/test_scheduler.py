@@ -0,0 +1,179 @@
+"""
+Tests of the labeling job submission queue of job_creation (scheduler).
+"""
+import pytest
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from ipac import storage
+import scheduler
+
+BUCKET = 'processing'
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code},
+         'ResponseMetadata': {'HTTPStatusCode': status}},
+        'CreateLabelingJob')
+
+
+def request(name):
+    return {'LabelingJobName': name}
+
+
+class Submitter:
+    """
+    create_labeling_job stand-in, raises the queued errors of a job
+    before accepting it.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = []
+
+    def __call__(self, request):
+        name = request['LabelingJobName']
+        self.calls.append(name)
+        errors = self.errors.get(name)
+        if errors:
+            raise errors.pop(0)
+        return f'arn:{name}'
+
+
+@pytest.fixture(autouse=True)
+def queue(local_backend, monkeypatch):
+    """
+    Unlimited rate and no backoff delay.
+    """
+    monkeypatch.setattr(scheduler, 'token_bucket',
+                        scheduler.TokenBucket(1e9, 1000))
+    monkeypatch.setattr(scheduler, 'backoff_base', 0)
+    monkeypatch.setattr(scheduler, 'submit_direct', False)
+
+
+def queued():
+    return [entry['request']['LabelingJobName']
+            for _, entry in scheduler.pending(BUCKET)]
+
+
+def dead_letters():
+    return [storage.read_json(BUCKET, key) for key in sorted(
+        storage.list_keys(BUCKET, scheduler.job_dead_letter_prefix))]
+
+
+@pytest.mark.parametrize('error, kind', [
+    (client_error('ThrottlingException'), 'throttled'),
+    (client_error('ResourceLimitExceeded'), 'throttled'),
+    (client_error('InternalFailure', 500), 'transient'),
+    (client_error('SomethingElse', 503), 'transient'),
+    (EndpointConnectionError(endpoint_url='https://sagemaker'), 'transient'),
+    (client_error('ValidationException'), 'permanent'),
+    (client_error('AccessDeniedException', 403), 'permanent'),
+    (KeyError('LabelingJobName'), 'permanent'),
+])
+def test_error_kind(error, kind):
+    assert scheduler.error_kind(error) == kind
+
+
+def test_submit_queues_without_direct_submission():
+    submitter = Submitter()
+    assert scheduler.submit(BUCKET, request('a'), submitter) == 'Queued'
+    assert submitter.calls == []
+    assert queued() == ['a']
+
+
+def test_direct_submission(monkeypatch):
+    monkeypatch.setattr(scheduler, 'submit_direct', True)
+    submitter = Submitter()
+    assert scheduler.submit(BUCKET, request('a'), submitter) == 'arn:a'
+    assert queued() == []
+
+
+def test_drain_submits_oldest_first():
+    for name in ('a', 'b', 'c'):
+        scheduler.enqueue(BUCKET, request(name))
+    submitter = Submitter()
+    summary = scheduler.drain(BUCKET, submitter)
+    assert submitter.calls == ['a', 'b', 'c']
+    assert summary == {'submitted': ['a', 'b', 'c'], 'dead_lettered': [],
+                       'queued': 0}
+    assert queued() == []
+
+
+def test_throttled_request_stays_queued():
+    scheduler.enqueue(BUCKET, request('a'))
+    submitter = Submitter({'a': [client_error('ThrottlingException')] * 10})
+    for attempt in range(1, 11):
+        summary = scheduler.drain(BUCKET, submitter, budget=1)
+        assert summary['queued'] == 1
+        (_, entry), = scheduler.pending(BUCKET)
+        assert entry['attempts'] == attempt
+        assert 'ThrottlingException' in entry['last_error']
+    assert dead_letters() == []
+    summary = scheduler.drain(BUCKET, submitter)
+    assert summary['submitted'] == ['a']
+    assert queued() == []
+
+
+def test_backoff_delays_the_next_attempt(monkeypatch):
+    monkeypatch.setattr(scheduler, 'backoff_delay', lambda attempts: 3600)
+    scheduler.enqueue(BUCKET, request('a'))
+    submitter = Submitter({'a': [client_error('ThrottlingException')]})
+    scheduler.drain(BUCKET, submitter, budget=0.1)
+    summary = scheduler.drain(BUCKET, submitter, budget=0.1)
+    assert submitter.calls == ['a']
+    assert summary['queued'] == 1
+
+
+def test_permanent_error_is_dead_lettered():
+    scheduler.enqueue(BUCKET, request('a'))
+    scheduler.enqueue(BUCKET, request('b'))
+    submitter = Submitter({'a': [client_error('ValidationException')]})
+    summary = scheduler.drain(BUCKET, submitter)
+    assert summary == {'submitted': ['b'], 'dead_lettered': ['a'],
+                       'queued': 0}
+    assert queued() == []
+    entry, = dead_letters()
+    assert entry['request'] == request('a')
+    assert entry['attempts'] == 1
+    assert 'ValidationException' in entry['last_error']
+    # It is not submitted again
+    scheduler.drain(BUCKET, submitter)
+    assert submitter.calls == ['a', 'b']
+
+
+def test_transient_error_is_retried_then_dead_lettered(monkeypatch):
+    monkeypatch.setattr(scheduler, 'job_max_attempts', 3)
+    scheduler.enqueue(BUCKET, request('a'))
+    submitter = Submitter({'a': [client_error('InternalFailure', 500)] * 3})
+    for _ in range(2):
+        summary = scheduler.drain(BUCKET, submitter)
+        assert summary['queued'] == 1
+    summary = scheduler.drain(BUCKET, submitter)
+    assert summary['dead_lettered'] == ['a']
+    assert summary['queued'] == 0
+    assert dead_letters()[0]['attempts'] == 3
+
+
+def test_transient_error_then_accepted():
+    scheduler.enqueue(BUCKET, request('a'))
+    submitter = Submitter({'a': [client_error('ServiceUnavailable', 503)]})
+    scheduler.drain(BUCKET, submitter)
+    assert scheduler.drain(BUCKET, submitter)['submitted'] == ['a']
+    assert dead_letters() == []
+
+
+def test_duplicate_job_is_submitted():
+    scheduler.enqueue(BUCKET, request('a'))
+    submitter = Submitter({'a': [client_error('ResourceInUse')]})
+    summary = scheduler.drain(BUCKET, submitter)
+    assert summary['submitted'] == ['a']
+    assert queued() == []
+    assert dead_letters() == []
+
+
+def test_token_bucket():
+    bucket = scheduler.TokenBucket(rate=0.001, capacity=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
@@ -0,0 +1,76 @@
+"""
+Tests of the column contract shared by the stages, ipac.schema.
+"""
+import io
+import pandas as pd
+from ipac import schema
+
+
+def test_apply_schema_dtypes():
+    dataframe = pd.DataFrame({
+        'mrn': [1, 2, 3],
+        'encntr_num': [10.0, None, 12.0],
+        'collection_dt_tm': ['2021-03-01 08:00', 'unknown', None],
+        'nursing_unit_short_desc': ['ICU', 'CCU', 'ICU'],
+        'unknown_column': ['a', 'b', 'c'],
+    })
+    dataframe = schema.apply_schema(dataframe)
+    assert dataframe['mrn'].dtype == 'int8'
+    # Integers with missing values are left as they are
+    assert dataframe['encntr_num'].dtype == 'float64'
+    assert pd.api.types.is_datetime64_any_dtype(dataframe['collection_dt_tm'])
+    assert dataframe['collection_dt_tm'].isna().tolist() == [
+        False, True, True]
+    assert dataframe['nursing_unit_short_desc'].dtype == 'category'
+    assert dataframe['unknown_column'].dtype == object
+
+
+def test_apply_schema_datetime_columns():
+    dataframe = pd.DataFrame({
+        'collection_dt_tm': ['2021-03-01 08:00'],
+        'admit_dt_tm': ['2021-03-01'],
+    })
+    dataframe = schema.apply_schema(
+        dataframe, schema.TEMPERATURE_DATETIME_COLUMN_NAMES)
+    assert pd.api.types.is_datetime64_any_dtype(dataframe['collection_dt_tm'])
+    assert dataframe['admit_dt_tm'].dtype == object
+
+
+def test_read_csv_and_fillna():
+    dataframe = schema.read_csv(io.StringIO(
+        'mrn,nursing_unit_short_desc,admit_dt_tm\n'
+        '1,ICU,2021-03-01\n'
+        '2,,2021-03-02\n'))
+    assert dataframe['mrn'].dtype == 'int8'
+    assert dataframe['nursing_unit_short_desc'].dtype == 'category'
+    assert pd.api.types.is_datetime64_any_dtype(dataframe['admit_dt_tm'])
+    filled = schema.fillna(dataframe, 'none')
+    assert filled['nursing_unit_short_desc'].tolist() == ['ICU', 'none']
+
+
+def test_collection_labels_number_the_collections_of_a_day():
+    collection_dt_tm = pd.Series(pd.to_datetime([
+        '2021-03-01 08:00', '2021-03-01 20:00', '2021-03-02 09:00',
+        '2021-03-01 08:00', None]), index=[5, 6, 7, 8, 9])
+    labels = schema.collection_labels(collection_dt_tm)
+    assert labels.tolist() == [
+        '2021-03-01_1', '2021-03-01_2', '2021-03-02_1', '2021-03-01_3',
+        schema.NO_COLLECTION_LABEL]
+    assert list(labels.index) == [5, 6, 7, 8, 9]
+
+
+def test_collection_labels_of_text_dates():
+    """
+    Dates read back from a patient csv are text, rows without
+    a date are labelled DateNotAvailable.
+    """
+    labels = schema.collection_labels(pd.Series(
+        ['2021-03-01 08:00:00', '', '2021-03-01 09:30:00', None]))
+    assert labels.tolist() == [
+        '2021-03-01_1', 'DateNotAvailable', '2021-03-01_2',
+        'DateNotAvailable']
+
+
+def test_collection_labels_without_dates():
+    labels = schema.collection_labels(pd.Series([pd.NaT, pd.NaT]))
+    assert labels.tolist() == ['DateNotAvailable'] * 2
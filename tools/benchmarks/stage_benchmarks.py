@@ -0,0 +1,208 @@
+"""
+Micro-benchmarks of the IPAC-CLABSI pipeline stages
+Purpose
+-------
+Time the stages of the lambda functions on synthetic workbooks
+(workbook_generator.py) over a grid of sizes, off-cloud: the objects are
+written to a temporary directory by the local storage backend.
+
+* preprocess - workbook parse, schema and organism join (preprocess)
+* plot_timeline - one timeline plot per patient (preprocess)
+* generate_iwp_plot - one plot per collection (preprocess)
+* get_table - UI table of the input manifest (job_creation)
+* gen_data_dict - input manifest content (job_creation)
+* write_json_on_s3 - output manifest into the patient csv (loop_lambda)
+
+Results are written as JSON, so runs can be compared for regressions:
+
+    python tools/benchmarks/stage_benchmarks.py results.json \
+        --patients 10 100 --collections 1 5 --temperatures 200
+"""
+import argparse
+import gc
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+for directory in ('ipaclayer/python', 'preprocess', 'job-creation', 'loop'):
+    sys.path.insert(0, os.path.join(ROOT, 'functions', 'source', directory))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import matplotlib  # noqa: E402
+matplotlib.use('Agg')
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from ipac import backends  # noqa: E402
+from ipac import schema  # noqa: E402
+import preprocess  # noqa: E402
+import job_creation  # noqa: E402
+import loop_lambda  # noqa: E402
+import workbook_generator  # noqa: E402
+
+BUCKET = 'benchmark'
+
+
+def summarize(times):
+    """
+    Statistics of a list of durations in seconds.
+    """
+    times = np.asarray(times)
+    return {
+        'calls': len(times),
+        'total': float(times.sum()),
+        'mean': float(times.mean()),
+        'median': float(np.median(times)),
+        'p95': float(np.percentile(times, 95)),
+        'max': float(times.max()),
+    }
+
+
+def timed(function, *args, **kwargs):
+    """
+    Duration in seconds and result of one call.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def output_manifest(table):
+    """
+    Review result of a patient, like the loop lambda receives it.
+    """
+    return {
+        'category': {
+            'caseInfo': {
+                'decision': {'case': True, 'nocase': False},
+                'collection_class': {
+                    collection: index == 0
+                    for index, collection in enumerate(table)},
+                'comment': 'benchmark',
+                'pathogen': 'p15',
+            },
+            'workerId': 'benchmark',
+        },
+        'category-metadata': {'creation-date': '2021-01-01T00:00:00'},
+    }
+
+
+def benchmark_size(size, repeat):
+    """
+    Time every stage on one synthetic workbook.
+
+    Returns
+    -------
+    dictionary, key: stage, value: statistics of the calls
+    """
+    sheets = workbook_generator.generate_workbook(**size)
+    buffer = io.BytesIO()
+    workbook_generator.write_workbook(sheets, buffer)
+    workbook = buffer.getvalue()
+    times = {stage: [] for stage in (
+        'preprocess', 'plot_timeline', 'generate_iwp_plot', 'get_table',
+        'gen_data_dict', 'write_json_on_s3')}
+
+    for _ in range(repeat):
+        duration, sheets = timed(
+            preprocess.preprocess, {'Body': io.BytesIO(workbook)})
+        times['preprocess'].append(duration)
+    dataframe_patients, dataframe_temperature = preprocess.sort_sheets(
+        *sheets)
+
+    uploader = preprocess.Uploader(BUCKET)
+    csv_files = {}
+    for patient, data, temperature in preprocess.partition_patients(
+            dataframe_patients, dataframe_temperature):
+        duration, _ = timed(preprocess.plot_timeline, data, patient, uploader)
+        times['plot_timeline'].append(duration)
+        for plot_index in data.index:
+            duration, _ = timed(
+                preprocess.generate_iwp_plot,
+                data, temperature, plot_index, patient, uploader)
+            times['generate_iwp_plot'].append(duration)
+        csv_files[patient] = schema.project(
+            data, schema.PATIENT_CSV_COLUMN_NAMES).to_csv(index=False)
+    uploader.wait()
+
+    for patient, csv_file in csv_files.items():
+        # The patient csv as job_creation reads it
+        dataframe = schema.fillna(schema.read_csv(
+            io.StringIO(csv_file), usecols=schema.usecols(
+                schema.TABLE_COLUMN_NAMES, schema.REVIEW_COLUMN_NAMES)),
+            'None')
+        dataframe['PR'] = 0
+        duration, table = timed(job_creation.get_table, dataframe.copy())
+        times['get_table'].append(duration)
+        duration, _ = timed(job_creation.gen_data_dict, dataframe, BUCKET)
+        times['gen_data_dict'].append(duration)
+        # The patient csv as loop_lambda reads it
+        dataframe = schema.read_csv(io.StringIO(csv_file))
+        dataframe['PR'] = 1
+        duration, _ = timed(
+            loop_lambda.write_json_on_s3, BUCKET,
+            f'reporting/{patient}.csv', output_manifest(table), dataframe)
+        times['write_json_on_s3'].append(duration)
+    return {stage: summarize(durations)
+            for stage, durations in times.items() if durations}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('output', help='JSON file of the results')
+    parser.add_argument('--patients', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--collections', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--temperatures', type=int, nargs='+', default=[100])
+    parser.add_argument('--organisms', type=int, nargs='+', default=[1])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of the preprocess stage per size')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__,
+        },
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': [],
+    }
+    # Silence the per call prints of the stages
+    log = sys.stdout
+    with tempfile.TemporaryDirectory() as directory:
+        backends.set_backend(backends.LocalBackend(directory))
+        for patients, collections, temperatures, organisms in \
+                itertools.product(
+                    arguments.patients, arguments.collections,
+                    arguments.temperatures, arguments.organisms):
+            size = {'patients': patients, 'collections': collections,
+                    'temperatures': temperatures, 'organisms': organisms,
+                    'seed': arguments.seed}
+            print('Benchmarking', size, file=log, flush=True)
+            gc.collect()
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                stages = benchmark_size(size, arguments.repeat)
+            finally:
+                sys.stdout.close()
+                sys.stdout = log
+            for stage, statistics in stages.items():
+                print('  {:<18} {:>6} calls {:>10.4f} s mean'.format(
+                    stage, statistics['calls'], statistics['mean']))
+            results['runs'].append({'size': size, 'stages': stages})
+    with open(arguments.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print('Results written to', arguments.output)
+
+
+if __name__ == '__main__':
+    main()
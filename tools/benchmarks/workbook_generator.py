@@ -0,0 +1,196 @@
+"""
+Synthetic IPAC-CLABSI workbook generator
+Purpose
+-------
+Write three-sheet workbooks shaped like the Cerner extract read by the
+preprocess lambda (see assets/test_ipac_CLABSI.xlsx), at any size:
+
+* Sheet1 - one row per positive blood collection
+* Sheet2 - temperature readings
+* Sheet3 - organisms found per encounter
+
+Usage
+-----
+    python tools/benchmarks/workbook_generator.py synthetic.xlsx \
+        --patients 500 --collections 3 --temperatures 200 --organisms 2
+"""
+import argparse
+import numpy as np
+import pandas as pd
+
+NURSING_UNITS = ['ICU', 'CCU', 'NICU', 'PICU', 'CSICU', 'Ward 4A', 'Ward 5B']
+FACILITIES = ['Hospital A', 'Hospital B', 'Hospital C']
+MEDICAL_SERVICES = ['Critical Care', 'General Medicine', 'Cardiology',
+                    'Nephrology', 'General Surgery']
+DISCHARGE_DISPOSITIONS = ['Discharged Home without Support Services',
+                          'Discharged Home with Support Services',
+                          'Transferred to another facility', 'Deceased']
+CATHETER_TYPES = ['PICC', 'Central venous catheter', 'Hemodialysis catheter',
+                  None]
+DRESSING_TYPES = ['Chlorhexidine gel', 'Transparent', None]
+SITES = ['Right internal jugular', 'Left subclavian', 'Right basilic', None]
+ORGANISMS = ['Staphylococcus epidermidis', 'Escherichia coli',
+             'Klebsiella pneumoniae', 'Staphylococcus aureus (MSSA, MRSA)',
+             'Candida albicans', 'Enterococcus faecalis',
+             'Pseudomonas aeruginosa', 'Gram negative bacilli']
+
+
+def generate_workbook(patients, collections=1, temperatures=100,
+                      organisms=1, seed=0):
+    """
+    Generate the three sheets of a synthetic workbook.
+    Every patient has one encounter (stay) with the given number of
+    collections, temperature readings and organisms.
+    ----------
+    fieldname : patients
+        int, number of patients
+    fieldname: collections
+        int, positive blood collections per patient
+    fieldname: temperatures
+        int, temperature readings per patient
+    fieldname: organisms
+        int, organisms per encounter
+    fieldname: seed
+        int, random seed, the same parameters give the same workbook
+
+    Returns
+    -------
+    dictionary, key: sheet name, value: dataframe
+    """
+    random = np.random.default_rng(seed)
+    mrn = 200000000000 + random.choice(
+        99999999999, size=patients, replace=False)
+    encntr_num = 100000000 + np.arange(patients)
+    encntr_id = 300000000 + np.arange(patients)
+    admit = (pd.Timestamp('2021-01-01')
+             + pd.to_timedelta(random.integers(0, 365 * 24 * 60, patients),
+                               unit='min'))
+    stay_days = random.integers(5, 60, patients)
+    discharge = admit + pd.to_timedelta(stay_days, unit='D')
+
+    # Sheet1, one row per collection
+    rows = np.repeat(np.arange(patients), collections)
+    count = len(rows)
+    collection = admit[rows] + pd.to_timedelta(
+        random.uniform(1, stay_days[rows] - 1) * 24 * 60, unit='min')
+    collection = collection.floor('min')
+    unit_begin = collection - pd.to_timedelta(
+        random.uniform(0, 3, count) * 24 * 60, unit='min').floor('min')
+    unit_end = collection + pd.to_timedelta(
+        random.uniform(0, 3, count) * 24 * 60, unit='min').floor('min')
+    line_start = admit[rows] + pd.to_timedelta(
+        random.uniform(0, 1, count) * 24 * 60, unit='min').floor('min')
+    line_end = collection + pd.to_timedelta(
+        random.uniform(-1, 5, count) * 24 * 60, unit='min').floor('min')
+    units = random.choice(NURSING_UNITS, count)
+    patients_sheet = pd.DataFrame({
+        'encntr_num': encntr_num[rows],
+        'mrn': mrn[rows],
+        'collection_dt_tm': collection,
+        'nursing_unit_short_desc': units,
+        'beg_effective_dt_tm': unit_begin,
+        'end_effective_dt_tm': unit_end,
+        'facility_name_src': random.choice(FACILITIES, count),
+        'encntr_type_desc_src_at_collection': 'Inpatient',
+        'admit_dt_tm': admit[rows],
+        'clinical_event_code_desc_src': 'Blood Culture',
+        'collection_date_id': collection.strftime('%Y%m%d').astype(int),
+        'loc_room_desc_src_at_collection': [
+            f'{unit} {room}' for unit, room in zip(
+                units, random.integers(1000, 4000, count))],
+        'loc_bed_desc_src_at_collection': random.integers(1, 5, count),
+        'disch_dt_tm': discharge[rows],
+        'disch_disp_desc_src': random.choice(DISCHARGE_DISPOSITIONS, count),
+        'lab_result': ' ',
+        'med_service_desc_src_at_collection': random.choice(
+            MEDICAL_SERVICES, count),
+        'nursing_unit_desc_at_collection': units,
+        'nursing_unit_short_desc_at_collection': units,
+        'result_interpretation_desc_src': 'Positive',
+        'specimen_type_desc_src': 'Blood',
+        'transfer_in_to_collect': (collection - unit_begin).days,
+        'transfer_out_to_collect': (collection - unit_end).days,
+        'ce_dynamic_label_id': 4000000000 + np.arange(count),
+        'doc_set_name_result': 'Central Lines',
+        'encntr_id': encntr_id[rows],
+        'first_activity_start_dt_tm': line_start,
+        'first_catheter_type_result': random.choice(CATHETER_TYPES, count),
+        'first_dressing_type_result': random.choice(DRESSING_TYPES, count),
+        'first_site_result': random.choice(SITES, count),
+        'last_activity_end_dt_tm': line_end,
+        'line_tube_drain_insertion_seq': 1,
+        'line_insert_to_collection': (collection - line_start).days,
+        'line_remove_to_collect': (collection - line_end).days,
+        'name_last': [f'last_name_{index}' for index in rows],
+        'name_first': [f'first_name_{index}' for index in rows],
+        'birth_date_id': random.integers(
+            19300101, 20001231, patients)[rows],
+        'gender_desc_src': random.choice(['Male', 'Female'], patients)[rows],
+        'home_addr_patient_postal_code_forward_sortation_area': random.choice(
+            ['V5K', 'V6B', 'V8W', 'V2L'], patients)[rows],
+    })
+
+    # Sheet2, temperature readings over the stay
+    rows = np.repeat(np.arange(patients), temperatures)
+    count = len(rows)
+    event_end = admit[rows] + pd.to_timedelta(
+        random.uniform(0, stay_days[rows]) * 24 * 60, unit='min')
+    temperature_sheet = pd.DataFrame({
+        'encntr_num': encntr_num[rows],
+        'MRN': mrn[rows],
+        'encntr_id': encntr_id[rows],
+        'accession_nbr': [f'X{index:09}' for index in range(count)],
+        'collection_dt_tm': collection[rows * collections],
+        'event_end_dt_tm': event_end.floor('min'),
+        'result_val': np.round(random.normal(37.4, 0.7, count), 1),
+    })
+
+    # Sheet3, organisms of every encounter
+    rows = np.repeat(np.arange(patients), organisms)
+    count = len(rows)
+    organism_sheet = pd.DataFrame({
+        'encntr_num': encntr_num[rows],
+        'encntr_id': encntr_id[rows],
+        'mrn': mrn[rows],
+        'accession_nbr': [f'X{index:08}' for index in range(count)],
+        'organism_desc_src': random.choice(ORGANISMS, count),
+    })
+    return {
+        'Sheet1': patients_sheet,
+        'Sheet2': temperature_sheet,
+        'Sheet3': organism_sheet,
+    }
+
+
+def write_workbook(sheets, path):
+    """
+    Write the sheets to an xlsx file, with the index column
+    of the extract ('Unnamed: 0' once read back).
+    """
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        for sheet_name, dataframe in sheets.items():
+            dataframe.to_excel(writer, sheet_name=sheet_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path', help='xlsx file to write')
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--collections', type=int, default=1,
+                        help='collections per patient')
+    parser.add_argument('--temperatures', type=int, default=100,
+                        help='temperature readings per patient')
+    parser.add_argument('--organisms', type=int, default=1,
+                        help='organisms per encounter')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    sheets = generate_workbook(
+        arguments.patients, arguments.collections, arguments.temperatures,
+        arguments.organisms, arguments.seed)
+    write_workbook(sheets, arguments.path)
+    for sheet_name, dataframe in sheets.items():
+        print(sheet_name, len(dataframe), 'rows')
+
+
+if __name__ == '__main__':
+    main()
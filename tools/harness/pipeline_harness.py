@@ -0,0 +1,497 @@
+"""
+End-to-end offline harness of the IPAC-CLABSI pipeline
+Purpose
+-------
+Run the whole pipeline in process, without AWS:
+
+    workbook upload -> preprocess -> source-csv/{mrn}.csv -> job_creation
+    -> labeling job -> output manifest -> loop -> reporting and aggregates
+
+* S3 is a local directory (ipac.backends.LocalBackend) which fires the
+  s3:ObjectCreated:Put notifications wired in
+  templates/functions.template.yaml, and counts the requests and bytes
+  of every stage
+* SageMaker is a stand-in for create_labeling_job and
+  describe_labeling_job, every labeling job completes with a synthetic
+  review ('case') and writes its output manifest
+
+Events are processed one at a time in FIFO order, like a Lambda
+concurrency of 1. The patients are rendered in process: the forked
+workers of RENDER_WORKERS above 1 would write through their own copy
+of the backend, their notifications and requests would be lost.
+With --batch-size the patients are batched into labeling jobs, the
+scheduled flush runs whenever the queue is empty.
+With the default review every patient goes through two rounds: ICP
+review, then physician review and reporting.
+
+The report gives the patients per minute, the S3 requests per patient
+and the latency histogram of every stage, printed and written as JSON:
+
+    python tools/harness/pipeline_harness.py report.json --patients 50
+    python tools/harness/pipeline_harness.py report.json \
+        --workbook assets/test_ipac_CLABSI.xlsx
+"""
+import argparse
+import bisect
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+LANDING_BUCKET = 'ipac-landing'
+PROCESSING_BUCKET = 'ipac-processing'
+REPORTING_BUCKET = 'ipac-reporting'
+CREATIONTIME_JOBS = 'JobCreationTime.csv'
+# Lambda configuration of the deployed functions
+os.environ.update({
+    'IPAC_STORAGE_BACKEND': 'local',
+    'S3_raw': LANDING_BUCKET,
+    'patient_bucket': PROCESSING_BUCKET,
+    'patient_folder': 'source-csv',
+    'PRODUCTION': PROCESSING_BUCKET,
+    'CREATIONTIME_JOBS': CREATIONTIME_JOBS,
+    'TEMPLATE_PATH': 'templates/ipac-clabsi.liquid.html',
+    'POST_LABEL_ARN': 'arn:aws:lambda:::function:postprocess',
+    'PRE_LABEL_ARN': 'arn:aws:lambda:::function:preprocess',
+    'MAX_CONCURRENT_TASK_COUNT': '200',
+    'NUMBER_OF_HUMAN_WORKERS_PER_DATA_OBJECT': '1',
+    'TASK_AVAILABILITY_LIFE_TIME_IN_SECONDS': '864000',
+    'TASK_TIME_LIMIT_IN_SECONDS': '28800',
+    'PRIVATE_WORK_TEAM_ARN': 'arn:aws:sagemaker:::workteam/private/ipac',
+    'GROUNDTRUTH_ROLE': 'arn:aws:iam:::role/groundtruth',
+    'FEEDBACK_BUCKET': PROCESSING_BUCKET,
+    'FEEDBACK_FOLDER': 'source-csv',
+    'REPORTING_BUCKET': REPORTING_BUCKET,
+    'REPORTING_FOLDER': 'reporting',
+})
+for directory in ('ipaclayer/python', 'preprocess', 'job-creation', 'loop'):
+    sys.path.insert(0, os.path.join(ROOT, 'functions', 'source', directory))
+sys.path.insert(0, os.path.join(ROOT, 'tools', 'benchmarks'))
+
+import matplotlib  # noqa: E402
+matplotlib.use('Agg')
+from botocore.exceptions import ClientError  # noqa: E402
+from ipac import backends  # noqa: E402
+from ipac import clients  # noqa: E402
+from ipac import storage  # noqa: E402
+import preprocess  # noqa: E402
+import job_creation  # noqa: E402
+import loop_lambda  # noqa: E402
+import scheduler  # noqa: E402
+import workbook_generator  # noqa: E402
+
+# S3 notifications of templates/functions.template.yaml:
+# bucket, prefix, suffix, stage
+NOTIFICATIONS = [
+    (LANDING_BUCKET, 'ipac-clabsi/', '.xlsx', 'preprocess'),
+    (PROCESSING_BUCKET, 'source-csv/', '.csv', 'job_creation'),
+    (PROCESSING_BUCKET, 'output/', '.manifest', 'loop'),
+]
+# Upper bounds of the latency histogram buckets, in seconds
+HISTOGRAM_BOUNDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 150.0, 900.0]
+
+
+class NotifyingBackend(backends.LocalBackend):
+    """
+    Local storage backend standing in for S3: counts the requests and
+    bytes per stage and fires the notifications of the written objects.
+    """
+
+    def __init__(self, root, harness):
+        super().__init__(root)
+        self.harness = harness
+
+    def _count(self, operation, size=0):
+        stage = self.harness.current_stage
+        self.harness.requests[stage][operation] += 1
+        self.harness.transferred[stage][operation] += size
+
+    def get_object(self, bucket, key):
+        response = super().get_object(bucket, key)
+        self._count('GetObject', response['ContentLength'])
+        return response
+
+    def head_object(self, bucket, key):
+        self._count('HeadObject')
+        return super().head_object(bucket, key)
+
+    def delete_object(self, bucket, key):
+        self._count('DeleteObject')
+        return super().delete_object(bucket, key)
+
+    def put_object(self, bucket, key, body, **kwargs):
+        response = super().put_object(bucket, key, body, **kwargs)
+        size = len(body)
+        self._count('PutObject', size)
+        self.harness.notify(bucket, key, response['ETag'], size)
+        return response
+
+    def list_keys(self, bucket, prefix=''):
+        keys = list(super().list_keys(bucket, prefix))
+        for _ in range(max(1, -(-len(keys) // 1000))):
+            self._count('ListObjectsV2')
+        return iter(keys)
+
+
+class FakeSageMaker:
+    """
+    Stand-in of the SageMaker client for Ground Truth labeling jobs.
+    A created job is queued, when the harness completes it every data
+    object of its input manifest gets the review of review_data_object
+    and the output manifest is written.
+    """
+
+    def __init__(self, harness, throttle_every=0):
+        self.harness = harness
+        self.jobs = {}
+        self.throttle_every = throttle_every
+        self.calls = 0
+
+    def create_labeling_job(self, **request):
+        self.calls += 1
+        if self.throttle_every and self.calls % self.throttle_every == 0:
+            raise ClientError(
+                {'Error': {'Code': 'ThrottlingException',
+                           'Message': 'Rate exceeded'}},
+                'CreateLabelingJob')
+        name = request['LabelingJobName']
+        if name in self.jobs:
+            raise ClientError(
+                {'Error': {'Code': 'ResourceInUse',
+                           'Message': f'Labeling job {name} exists'}},
+                'CreateLabelingJob')
+        self.jobs[name] = {'request': request, 'status': 'InProgress'}
+        self.harness.queue.append(('labeling', name))
+        return {'LabelingJobArn': f'arn:aws:sagemaker:::labeling-job/{name}'}
+
+    def describe_labeling_job(self, LabelingJobName):
+        job = self.jobs[LabelingJobName]
+        return {'LabelingJobName': LabelingJobName,
+                'LabelingJobStatus': job['status']}
+
+    def complete_job(self, name):
+        """
+        Review the data objects and write the output manifest.
+        """
+        job = self.jobs[name]
+        request = job['request']
+        input_uri = urllib.parse.urlparse(
+            request['InputConfig']['DataSource']['S3DataSource'][
+                'ManifestS3Uri'])
+        output_uri = urllib.parse.urlparse(
+            request['OutputConfig']['S3OutputPath'])
+        lines = storage.read_bytes(
+            input_uri.netloc, input_uri.path[1:]).decode('utf-8')
+        output = []
+        for line in lines.splitlines():
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            data[request['LabelAttributeName']] = review_data_object(data)
+            data[request['LabelAttributeName'] + '-metadata'] = {
+                'job-name': f'labeling-job/{name.lower()}',
+                'creation-date': datetime.datetime.utcnow().isoformat(),
+                'type': 'groundtruth/custom',
+                'human-annotated': 'yes',
+            }
+            output.append(json.dumps(data))
+        storage.write_bytes(
+            output_uri.netloc,
+            '{}/{}/manifests/output/output.manifest'.format(
+                output_uri.path.strip('/'), name),
+            '\n'.join(output).encode('utf-8'))
+        job['status'] = 'Completed'
+        return job['status']
+
+
+def review_data_object(data):
+    """
+    Synthetic review of a data object: a CLABSI case for the first
+    collection, without a notification, so the second round reports.
+    """
+    table = data.get('table', {})
+    return {
+        'workerId': 'harness-reviewer',
+        'caseInfo': {
+            'decision': {'case': True, 'nocase': False, 'notsure': False},
+            'collection_class': {
+                collection: index == 0
+                for index, collection in enumerate(sorted(table))},
+            'comment': 'harness review',
+            'pathogen': 'p15',
+            'send_to_physician': 'Do not send notification',
+        },
+    }
+
+
+def histogram(durations):
+    """
+    Count of the durations per bucket of HISTOGRAM_BOUNDS,
+    plus the durations above the last bound.
+    """
+    counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    for duration in durations:
+        counts[bisect.bisect_left(HISTOGRAM_BOUNDS, duration)] += 1
+    return counts
+
+
+def percentile(durations, fraction):
+    ordered = sorted(durations)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class PipelineHarness:
+    """
+    Runs the S3 notifications and labeling jobs through the handlers.
+    ----------
+    fieldname : root
+        directory of the local buckets
+    fieldname: verbose
+        show the output of the handlers
+    fieldname: throttle_every
+        int, every n-th create_labeling_job is throttled, 0 never
+    """
+
+    def __init__(self, root, verbose=False, throttle_every=0):
+        self.queue = collections.deque()
+        self.current_stage = 'upload'
+        self.requests = collections.defaultdict(collections.Counter)
+        self.transferred = collections.defaultdict(collections.Counter)
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.patients = set()
+        self.reported = set()
+        self.verbose = verbose
+        self.sagemaker = FakeSageMaker(self, throttle_every)
+        backends.set_backend(NotifyingBackend(root, self))
+        if preprocess.render_workers > 1:
+            print('RENDER_WORKERS={} is not supported, the patients are '
+                  'rendered in process'.format(preprocess.render_workers),
+                  file=sys.stderr)
+            preprocess.render_workers = 1
+        clients.set_client('sagemaker', self.sagemaker)
+        self.handlers = {
+            'preprocess': preprocess.lambda_handler,
+            'job_creation': job_creation.lambda_handler,
+            'job_flush': job_creation.lambda_handler,
+            'loop': loop_lambda.lambda_handler,
+            'labeling': self.sagemaker.complete_job,
+        }
+        # The job creation time file and the reference UI template
+        # are created at deployment
+        storage.write_bytes(
+            PROCESSING_BUCKET, CREATIONTIME_JOBS,
+            b'MRN,PR,CreationTime,SourceCSV,status,JobName\n')
+        storage.write_bytes(
+            PROCESSING_BUCKET, os.environ['TEMPLATE_PATH'],
+            b'<crowd-form>@@table@@</crowd-form>\n')
+
+    def notify(self, bucket, key, etag, size):
+        """
+        Queue the event of the notification rule matching an object.
+        """
+        if bucket == REPORTING_BUCKET and key.startswith('reporting/'):
+            self.reported.add(os.path.basename(key).split('.')[0])
+        for rule_bucket, prefix, suffix, stage in NOTIFICATIONS:
+            if (bucket == rule_bucket and key.startswith(prefix)
+                    and key.endswith(suffix)):
+                if stage == 'job_creation':
+                    self.patients.add(os.path.basename(key).split('.')[0])
+                self.queue.append((stage, {'Records': [{
+                    'eventVersion': '2.1',
+                    'eventSource': 'aws:s3',
+                    'eventName': 'ObjectCreated:Put',
+                    'eventTime': datetime.datetime.utcnow().strftime(
+                        '%Y-%m-%dT%H:%M:%S.%fZ'),
+                    's3': {
+                        'bucket': {'name': bucket},
+                        'object': {'key': urllib.parse.quote_plus(key),
+                                   'size': size, 'eTag': etag.strip('"')},
+                    },
+                }]}))
+
+    def invoke(self, stage, payload):
+        """
+        Run one handler invocation and record its latency.
+        """
+        self.current_stage = stage
+        output = sys.stdout if self.verbose else open(os.devnull, 'w')
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                if stage == 'labeling':
+                    self.handlers[stage](payload)
+                else:
+                    self.handlers[stage](payload, None)
+        except Exception as error:
+            self.failures[stage] += 1
+            print(f'{stage} failed: {error!r}', file=sys.stderr)
+        finally:
+            self.latencies[stage].append(time.perf_counter() - start)
+            if output is not sys.stdout:
+                output.close()
+            self.current_stage = 'harness'
+
+    def run(self, workbook, key='ipac-clabsi/workbook.xlsx'):
+        """
+        Upload a workbook and process every event it causes.
+
+        Returns
+        -------
+        wall time in seconds
+        """
+        start = time.perf_counter()
+        self.current_stage = 'upload'
+        storage.write_bytes(LANDING_BUCKET, key, workbook)
+        idle_flushes = 0
+        while idle_flushes < 20:
+            while self.queue:
+                self.invoke(*self.queue.popleft())
+            if not self.flush():
+                break
+            # Stop retrying jobs which keep failing
+            idle_flushes = 0 if self.queue else idle_flushes + 1
+        return time.perf_counter() - start
+
+    def flush(self):
+        """
+        Submit the staged patients of the batching mode and the queued
+        labeling jobs, like the scheduled rule of job creation.
+
+        Returns
+        -------
+        bool, False when nothing is left to submit
+        """
+        self.current_stage = 'job_flush'
+        waiting = any(storage.list_keys(
+            PROCESSING_BUCKET, job_creation.job_pending_prefix)) or any(
+                storage.list_keys(
+                    PROCESSING_BUCKET, scheduler.job_queue_prefix))
+        if waiting:
+            self.invoke('job_flush', {'flush': True})
+        return waiting
+
+    def report(self, elapsed):
+        """
+        Throughput, S3 requests and latencies of the run.
+        """
+        patients = len(self.patients)
+        requests = collections.Counter()
+        for counter in self.requests.values():
+            requests.update(counter)
+        return {
+            'elapsed_seconds': elapsed,
+            'patients': patients,
+            'patients_reported': len(self.reported),
+            'patients_per_minute': (
+                len(self.reported) / elapsed * 60 if elapsed else 0),
+            's3_requests': {
+                stage: dict(counter)
+                for stage, counter in self.requests.items()},
+            's3_bytes': {
+                stage: dict(counter)
+                for stage, counter in self.transferred.items()},
+            's3_requests_per_patient': {
+                operation: count / patients
+                for operation, count in requests.items()} if patients else {},
+            'failures': dict(self.failures),
+            'stages': {
+                stage: {
+                    'invocations': len(durations),
+                    'total': sum(durations),
+                    'p50': percentile(durations, 0.5),
+                    'p95': percentile(durations, 0.95),
+                    'max': max(durations),
+                    'histogram_bounds': HISTOGRAM_BOUNDS,
+                    'histogram': histogram(durations),
+                }
+                for stage, durations in self.latencies.items()},
+        }
+
+
+def print_report(report):
+    print('Patients: {patients}, reported: {patients_reported}, '
+          'elapsed: {elapsed_seconds:.1f} s, '
+          'patients/minute: {patients_per_minute:.1f}'.format(**report))
+    print('S3 requests per patient:', ', '.join(
+        f'{operation} {count:.1f}' for operation, count in
+        sorted(report['s3_requests_per_patient'].items())))
+    if report['failures']:
+        print('Failed invocations:', report['failures'])
+    for stage, statistics in report['stages'].items():
+        print('{:<13} {:>5} invocations  p50 {:.3f} s  p95 {:.3f} s  '
+              'max {:.3f} s'.format(
+                  stage, statistics['invocations'], statistics['p50'],
+                  statistics['p95'], statistics['max']))
+        bounds = [f'{bound:g}' for bound in HISTOGRAM_BOUNDS] + ['inf']
+        for bound, count in zip(bounds, statistics['histogram']):
+            if count:
+                print('    <= {:>6} s {:>5} {}'.format(
+                    bound, count, '#' * min(count, 60)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('output', help='JSON file of the report')
+    parser.add_argument('--workbook', help='xlsx file, default: synthetic')
+    parser.add_argument('--patients', type=int, default=20)
+    parser.add_argument('--collections', type=int, default=2)
+    parser.add_argument('--temperatures', type=int, default=100)
+    parser.add_argument('--organisms', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='patients per labeling job (JOB_BATCH_SIZE)')
+    parser.add_argument('--submit-rate', type=float, default=0,
+                        help='labeling jobs per second (JOB_SUBMIT_RATE), '
+                        'default: unlimited')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='throttle every n-th labeling job creation')
+    parser.add_argument('--root', help='directory of the local buckets, '
+                        'default: a temporary directory')
+    parser.add_argument('--verbose', action='store_true')
+    arguments = parser.parse_args()
+    job_creation.job_batch_size = arguments.batch_size
+    if arguments.submit_rate:
+        scheduler.token_bucket = scheduler.TokenBucket(
+            arguments.submit_rate, scheduler.submit_burst)
+    else:
+        scheduler.token_bucket = scheduler.TokenBucket(1e9, 1)
+    # Retry the throttled jobs on the next flush, without waiting
+    scheduler.backoff_base = scheduler.backoff_cap = 0
+
+    if arguments.workbook:
+        with open(arguments.workbook, 'rb') as workbook_file:
+            workbook = workbook_file.read()
+    else:
+        buffer = io.BytesIO()
+        workbook_generator.write_workbook(
+            workbook_generator.generate_workbook(
+                arguments.patients, arguments.collections,
+                arguments.temperatures, arguments.organisms, arguments.seed),
+            buffer)
+        workbook = buffer.getvalue()
+
+    with contextlib.ExitStack() as stack:
+        root = arguments.root or stack.enter_context(
+            tempfile.TemporaryDirectory())
+        harness = PipelineHarness(
+            os.path.abspath(root), arguments.verbose,
+            arguments.throttle_every)
+        report = harness.report(harness.run(workbook))
+    print_report(report)
+    with open(arguments.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Report written to', arguments.output)
+
+
+if __name__ == '__main__':
+    main()